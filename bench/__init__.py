@@ -0,0 +1,4 @@
+"""
+Local stand-ins for Rocket.Chat and Zabbix and harnesses to measure zbx-rc against them.
+Run from repository root, e.g. 'python -m bench.stress_db'.
+"""
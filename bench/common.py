@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+from configparser import RawConfigParser
+
+ZBX_RC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "zbx-rc.py")
+
+
+def write_config(path, workdir, rocketchat, zabbix=None, sections=None):
+    """
+    Writes zbx-rc config which keeps database, socket and temporary files in workdir.
+
+    :param path: Path to config file
+    :param workdir: Directory for database and temporary files
+    :param rocketchat: FakeRocketChat object
+    :param zabbix: FakeZabbix object or None
+    :param sections: Dict of additional sections {section: {option: value}}
+    """
+    cfg = RawConfigParser()
+    cfg["RCHAT"] = rocketchat.config()
+    cfg["ZABBIX"] = zabbix.config() if zabbix is not None else {"zbx_server": "http://127.0.0.1:9",
+                                                                 "zbx_api_user": "bench",
+                                                                 "zbx_api_pass": "bench"}
+    cfg["ZABBIX"]["zbx_tmp_dir"] = workdir
+    cfg["ZABBIX"]["zbx_session_file"] = os.path.join(workdir, "zbx-session.json")
+    cfg["DB"] = {"file": os.path.join(workdir, "zbx-rc.sqlite")}
+    cfg["DAEMON"] = {"socket": os.path.join(workdir, "zbx-rc.sock")}
+    for section, values in (sections or {}).items():
+        if not cfg.has_section(section):
+            cfg.add_section(section)
+        for option, value in values.items():
+            cfg.set(section, option, str(value))
+    with open(path, "w") as file:
+        cfg.write(file)
+    return path
+
+
+def zbx_rc(config, *args):
+    """
+    Starts zbx-rc.py process with config, returns subprocess.Popen.
+    """
+    return subprocess.Popen([sys.executable, ZBX_RC, "-c", config] + list(args),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
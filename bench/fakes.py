@@ -0,0 +1,331 @@
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def iso_now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def make_png(width=900, height=200, seed=0):
+    """
+    Returns valid RGB PNG looking like chart: white field, grid and noisy line, about as big as real one.
+    """
+    rnd = random.Random(seed)
+    level = height // 2
+    rows = []
+    for y in range(height):
+        row = bytearray(b"\xff" * (width * 3))
+        if y % 40 == 0:
+            row[:] = b"\xdd" * (width * 3)
+        rows.append(row)
+    for x in range(width):
+        level = min(height - 1, max(0, level + rnd.randint(-3, 3)))
+        rows[level][x * 3:x * 3 + 3] = b"\x00\xcc\x00"
+    raw = b"".join(b"\x00" + bytes(row) for row in rows)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        self.server.fake.count(self.path, len(body))
+        return body
+
+    def reply(self, status, body, content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client gave up waiting, e.g. read timeout of slow server scenario
+            return
+        self.server.fake.bytes_out += len(body)
+
+    def do_GET(self):
+        self.read_body()
+        self.server.fake.handle(self, "GET", b"")
+
+    def do_POST(self):
+        body = self.read_body()
+        self.server.fake.handle(self, "POST", body)
+
+
+class FakeServer:
+    """
+    HTTP server running in background thread, counts requests and bytes per path.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.server = ThreadingHTTPServer((host, port), FakeHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def count(self, path, size):
+        with self.lock:
+            self.requests[urlparse(path).path] += 1
+            self.bytes_in += size
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, handler, method, body):
+        raise NotImplementedError
+
+
+class FakeRocketChat(FakeServer):
+    """
+    Rocket.Chat REST API stand-in: login, chat.postMessage, chat.update, chat.getMessage, chat.react,
+    chat.syncMessages and rooms.upload.
+    With rate_limit=(limit, interval) every endpoint answers limit requests per interval seconds
+    and 429 to the rest (counted in throttled), X-RateLimit-* headers are sent like Rocket.Chat does.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, rate_limit=None):
+        super().__init__(host, port, latency)
+        self.messages = {}
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.rate_limit = rate_limit
+        self.buckets = {}
+        self.throttled = Counter()
+
+    def limit(self, name):
+        """
+        Returns tuple (allowed, rate limit headers) for request to endpoint.
+        """
+        if not self.rate_limit:
+            return True, {}
+        limit, interval = self.rate_limit
+        now = time.time()
+        with self.lock:
+            reset, used = self.buckets.get(name, (0, 0))
+            if reset <= now:
+                reset, used = now + interval, 0
+            used += 1
+            self.buckets[name] = (reset, used)
+            headers = {"X-RateLimit-Limit": str(limit),
+                       "X-RateLimit-Remaining": str(max(0, limit - used)),
+                       "X-RateLimit-Reset": str(int(reset * 1000))}
+            if used > limit:
+                self.throttled[name] += 1
+                return False, headers
+        return True, headers
+
+    @property
+    def url(self):
+        return "http://{0}:{1}/api/v1/".format(self.host, self.port)
+
+    def config(self):
+        return {"protocol": "http", "server": self.host, "port": str(self.port), "uid": "bench", "token": "bench"}
+
+    def handle(self, handler, method, body):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(handler.path)
+        name = url.path.split("/api/v1/", 1)[-1].split("/")[0]
+        allowed, headers = self.limit(name)
+        if not allowed:
+            return handler.reply(429, {"success": False, "error": "Error, too many requests. Please slow down."},
+                                 headers=headers)
+        status, body = self.api(name, url, body)
+        return handler.reply(status, body, headers=headers)
+
+    def api(self, name, url, body):
+        if name == "login":
+            return 200, {"status": "success", "data": {"userId": "bench", "authToken": "bench"}}
+        if name == "chat.postMessage":
+            data = json.loads(body.decode("utf-8"))
+            with self.lock:
+                msg_id = "msg{0}".format(len(self.messages) + 1)
+                rid = "room-" + data["channel"].lstrip("#@")
+                self.messages[msg_id] = {"_id": msg_id, "rid": rid, "msg": data.get("text", ""),
+                                         "attachments": data.get("attachments", []), "updates": 0,
+                                         "_updatedAt": iso_now()}
+            return 200, {"success": True, "message": self.messages[msg_id]}
+        if name == "chat.update":
+            data = json.loads(body.decode("utf-8"))
+            with self.lock:
+                message = self.messages.get(data["msgId"])
+                if message is None:
+                    return 400, {"success": False, "error": "No message"}
+                message["msg"] = data["text"]
+                message["updates"] += 1
+                message["_updatedAt"] = iso_now()
+            return 200, {"success": True, "message": message}
+        if name == "chat.getMessage":
+            message = self.messages.get(parse_qs(url.query).get("msgId", [""])[0])
+            if message is None:
+                return 400, {"success": False, "error": "No message"}
+            return 200, {"success": True, "message": message}
+        if name == "chat.react":
+            data = json.loads(body.decode("utf-8"))
+            with self.lock:
+                message = self.messages.get(data["messageId"])
+                if message is None:
+                    return 400, {"success": False, "error": "No message"}
+                reactions = message.setdefault("reactions", {})
+                usernames = reactions.setdefault(data["emoji"], {"usernames": []})["usernames"]
+                username = data.get("username", "bench")
+                if data.get("shouldReact", username not in usernames):
+                    usernames.append(username)
+                elif username in usernames:
+                    usernames.remove(username)
+                message["_updatedAt"] = iso_now()
+            return 200, {"success": True}
+        if name == "chat.syncMessages":
+            query = parse_qs(url.query)
+            rid, last_update = query["roomId"][0], query["lastUpdate"][0]
+            with self.lock:
+                updated = [dict(message) for message in self.messages.values()
+                           if message["rid"] == rid and message["_updatedAt"] > last_update]
+            return 200, {"success": True, "result": {"updated": updated, "deleted": []}}
+        if name == "rooms.upload":
+            with self.lock:
+                self.uploads += 1
+                # Size of PNG file without multipart envelope
+                start = body.find(b"\x89PNG")
+                self.upload_bytes += body.find(b"IEND", start) + 8 - start if start >= 0 else 0
+            return 200, {"success": True}
+        return 404, {"success": False, "error": "Unknown method"}
+
+
+class FakeZabbix(FakeServer):
+    """
+    Zabbix frontend stand-in: login form sets session cookie, chart3.php answers PNG of requested size
+    after latency seconds or login page without valid cookie. api_jsonrpc.php answers user.login,
+    event.acknowledge and item.get, single or batch, acknowledge calls are kept in acknowledged.
+    API token is accepted in Authorization header (Zabbix 6.4+) and auth field.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, username="bench", password="bench"):
+        super().__init__(host, port, latency)
+        self.username = username
+        self.password = password
+        self.sessions = set()
+        self.api_token = "bench-token"
+        self.logins = 0
+        self.charts = 0
+        self.chart_bytes = 0
+        # (width, height) -> PNG
+        self.pngs = {}
+        self.api_requests = 0
+        self.acknowledged = []
+
+    @property
+    def url(self):
+        return "http://{0}:{1}/zabbix".format(self.host, self.port)
+
+    def config(self):
+        return {"zbx_server": self.url, "zbx_api_user": self.username, "zbx_api_pass": self.password}
+
+    def handle(self, handler, method, body):
+        url = urlparse(handler.path)
+        if method == "POST" and url.path in ("/zabbix/", "/zabbix/index.php"):
+            form = parse_qs(body.decode("utf-8"))
+            if form.get("name") != [self.username] or form.get("password") != [self.password]:
+                return handler.reply(200, b"<html>Login name or password is incorrect.</html>", "text/html")
+            with self.lock:
+                self.logins += 1
+                session = "bench{0}".format(self.logins)
+                self.sessions.add(session)
+            return handler.reply(200, b"<html>Dashboard</html>", "text/html",
+                                 {"Set-Cookie": "zbx_session={0}; Path=/zabbix".format(session)})
+        if url.path == "/zabbix/api_jsonrpc.php":
+            with self.lock:
+                self.api_requests += 1
+            request = json.loads(body.decode("utf-8"))
+            bearer = handler.headers.get("Authorization", "")[len("Bearer "):]
+            answers = ([self.api(call, bearer) for call in request] if isinstance(request, list)
+                       else self.api(request, bearer))
+            return handler.reply(200, answers)
+        if url.path == "/zabbix/chart3.php":
+            cookies = dict(part.strip().split("=", 1) for part in handler.headers.get("Cookie", "").split(";")
+                           if "=" in part)
+            if cookies.get("zbx_session") not in self.sessions:
+                return handler.reply(200, b"<html>Sign in</html>", "text/html")
+            if self.latency:
+                time.sleep(self.latency)
+            query = parse_qs(url.query)
+            size = (int(query.get("width", ["900"])[0]), int(query.get("height", ["200"])[0]))
+            with self.lock:
+                if size not in self.pngs:
+                    self.pngs[size] = make_png(*size)
+                png = self.pngs[size]
+                self.charts += 1
+                self.chart_bytes += len(png)
+            return handler.reply(200, png, "image/png")
+        return handler.reply(404, b"Not found", "text/html")
+
+    def api(self, call, bearer=""):
+        if call["method"] == "user.login":
+            params = call["params"]
+            if params.get("username") != self.username or params.get("password") != self.password:
+                return {"jsonrpc": "2.0", "error": {"code": -32602, "message": "Invalid params.",
+                                                    "data": "Incorrect user name or password."}, "id": call["id"]}
+            with self.lock:
+                self.logins += 1
+                session = "api{0}".format(self.logins)
+                self.sessions.add(session)
+            return {"jsonrpc": "2.0", "result": session, "id": call["id"]}
+        if call.get("auth") not in self.sessions and self.api_token not in (bearer, call.get("auth")):
+            return {"jsonrpc": "2.0", "error": {"code": -32602, "message": "Invalid params.",
+                                                "data": "Session terminated, re-login, please."}, "id": call["id"]}
+        if call["method"] == "event.acknowledge":
+            with self.lock:
+                self.acknowledged.append(call["params"])
+            return {"jsonrpc": "2.0", "result": {"eventids": call["params"]["eventids"]}, "id": call["id"]}
+        if call["method"] == "item.get":
+            # Every tenth item is text one, chart3.php can't draw it
+            items = [{"itemid": str(itemid), "name": "Item {0}".format(itemid),
+                      "key_": "bench.item[{0}]".format(itemid), "lastvalue": str(int(itemid) % 100), "units": "%",
+                      "value_type": "4" if int(itemid) % 10 == 9 else "0",
+                      "hosts": [{"host": "host{0}".format(int(itemid) % 10),
+                                 "name": "Host {0}".format(int(itemid) % 10)}]}
+                     for itemid in call["params"]["itemids"]]
+            return {"jsonrpc": "2.0", "result": items, "id": call["id"]}
+        return {"jsonrpc": "2.0", "error": {"code": -32601, "message": "Method not found."}, "id": call["id"]}
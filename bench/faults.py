@@ -0,0 +1,210 @@
+"""
+Runs 'zbx-rc.py' against local fake Rocket.Chat which misbehaves and checks that alerts are not lost
+or duplicated. Every scenario starts with fresh database and fake server:
+
+    slow-daemon  - delivery by 'serve' takes longer than client waits, daemon without outbox and breaker
+                   doesn't keep alert, client fails so Zabbix repeats it, daemon still posts it once
+    accepted     - the same with default breaker, daemon saves alert to outbox before answering 'accepted',
+                   posts it once and removes from outbox
+    daemon-crash - daemon is killed after answering 'accepted', alert waits in outbox for worker
+    shared-event - daemon caches problem sent to one room, other process sends it to another room,
+                   resolve through daemon updates both messages instead of posting a new one
+    slow-worker  - Rocket.Chat answers after read timeout, 'worker --once' puts message back with backoff
+    digest       - alerts of one digest are resolved at once by 'send --batch' and 'send' processes,
+                   every line of the digest is updated
+    open-circuit - Rocket.Chat is down and outbox is disabled, 'send' and 'send --batch' fail instead of
+                   queueing alerts which nothing would deliver
+
+    python -m bench.faults
+    python -m bench.faults --scenarios slow-daemon
+"""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from bench.common import ZBX_RC, write_config
+from bench.fakes import FakeRocketChat
+from bench.startup import wait_socket
+
+
+def alert(trigger, resolved=False):
+    return ["#faults", "{0}: Disk is full on host{1}".format("OK" if resolved else "PROBLEM", trigger),
+            "Disk is full tr_events.php?triggerid={0}&eventid={0}".format(trigger)]
+
+
+def batch_lines(triggers, resolved=False):
+    return "".join(json.dumps(dict(zip(("to", "subject", "message"), alert(trigger, resolved)))) + "\n"
+                   for trigger in triggers)
+
+
+def run(config, *args, stdin=None):
+    """
+    Runs zbx-rc.py, returns exit code, stdout and stderr.
+    """
+    proc = subprocess.run([sys.executable, ZBX_RC, "-c", config] + list(args), input=stdin,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    return proc.returncode, proc.stdout, proc.stderr.strip()
+
+
+def slow_send(workdir, outbox=False, crash=False):
+    """
+    Sends alert to daemon which can't deliver it before client timeout, returns exit code, seconds
+    of 'send', stderr, number of posts and outbox rows as (status, hidden from worker).
+    """
+    rocketchat = FakeRocketChat(latency=2).start()
+    # With breaker daemon drains outbox, 'send' with enabled outbox would queue alert without daemon
+    sections = {"DAEMON": {"timeout": 1}, "TRANSPORT": {"timeout": 5},
+                "BREAKER": {"enabled": "yes" if outbox else "no"}}
+    config = write_config(os.path.join(workdir, "zbx-rc.conf"), workdir, rocketchat, sections=sections)
+    daemon = subprocess.Popen([sys.executable, ZBX_RC, "-c", config, "serve"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_socket(os.path.join(workdir, "zbx-rc.sock"))
+        started = time.perf_counter()
+        code, _, stderr = run(config, "send", *alert(1))
+        elapsed = time.perf_counter() - started
+        if crash:
+            daemon.kill()
+        else:
+            # Daemon finishes delivery after client is gone
+            time.sleep(3)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        rocketchat.stop()
+    connection = sqlite3.connect(os.path.join(workdir, "zbx-rc.sqlite"))
+    rows = connection.execute("SELECT status, locked_until > ? FROM outbox;", (time.time(),)).fetchall()
+    connection.close()
+    return code, elapsed, stderr, rocketchat.requests["/api/v1/chat.postMessage"], rows
+
+
+def slow_daemon(workdir):
+    code, elapsed, stderr, posted, rows = slow_send(workdir)
+    return (code != 0 and elapsed < 2 and posted == 1 and not rows,
+            "exit={0} in {1:.1f}s posted={2} outbox={3} {4}".format(code, elapsed, posted, rows, stderr[-200:]))
+
+
+def accepted(workdir):
+    code, elapsed, stderr, posted, rows = slow_send(workdir, outbox=True)
+    return (code == 0 and elapsed < 2 and posted == 1 and not rows,
+            "exit={0} in {1:.1f}s posted={2} outbox={3} {4}".format(code, elapsed, posted, rows, stderr[-200:]))
+
+
+def daemon_crash(workdir):
+    code, elapsed, stderr, posted, rows = slow_send(workdir, outbox=True, crash=True)
+    return (code == 0 and posted <= 1 and rows == [("pending", 1)],
+            "exit={0} posted={1} outbox={2} {3}".format(code, posted, rows, stderr[-200:]))
+
+
+def shared_event(workdir):
+    rocketchat = FakeRocketChat().start()
+    config = write_config(os.path.join(workdir, "zbx-rc.conf"), workdir, rocketchat)
+    # Nothing listens on socket of this config, 'send' delivers alert itself
+    direct = write_config(os.path.join(workdir, "direct.conf"), workdir, rocketchat,
+                          sections={"DAEMON": {"socket": os.path.join(workdir, "none.sock")}})
+    daemon = subprocess.Popen([sys.executable, ZBX_RC, "-c", config, "serve"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_socket(os.path.join(workdir, "zbx-rc.sock"))
+        problem = alert(1)
+        codes = [run(config, "send", "#first", *problem[1:])[0], run(direct, "send", "#second", *problem[1:])[0],
+                 run(config, "send", "#first,#second", *alert(1, resolved=True)[1:])[0]]
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        rocketchat.stop()
+    posted = rocketchat.requests["/api/v1/chat.postMessage"]
+    updated = rocketchat.requests["/api/v1/chat.update"]
+    return (codes == [0, 0, 0] and posted == 2 and updated == 2,
+            "exit codes={0} posted={1} updated={2}".format(codes, posted, updated))
+
+
+def slow_worker(workdir):
+    rocketchat = FakeRocketChat(latency=1.5).start()
+    config = write_config(os.path.join(workdir, "zbx-rc.conf"), workdir, rocketchat,
+                          sections={"OUTBOX": {"enabled": "yes"}, "TRANSPORT": {"timeout": 0.5}})
+    try:
+        run(config, "send", *alert(1))
+        code, _, stderr = run(config, "worker", "--once")
+    finally:
+        rocketchat.stop()
+    connection = sqlite3.connect(os.path.join(workdir, "zbx-rc.sqlite"))
+    rows = connection.execute("SELECT status, attempts, next_attempt > ? FROM outbox;", (time.time(),)).fetchall()
+    connection.close()
+    return (code == 0 and "Traceback" not in stderr and rows == [("pending", 1, 1)],
+            "exit={0} outbox={1} {2}".format(code, rows, stderr.splitlines()[-1][-200:] if stderr else ""))
+
+
+def digest(workdir, alerts=10):
+    rocketchat = FakeRocketChat(latency=0.05).start()
+    queued = write_config(os.path.join(workdir, "queued.conf"), workdir, rocketchat,
+                          sections={"OUTBOX": {"enabled": "yes"}, "COALESCE": {"window": 1}})
+    config = write_config(os.path.join(workdir, "zbx-rc.conf"), workdir, rocketchat)
+    try:
+        run(queued, "send", "--batch", "-", stdin=batch_lines(range(alerts)))
+        time.sleep(1)
+        run(queued, "worker", "--once")
+        # Half of resolves goes through one batch, the rest through concurrent processes
+        batch = batch_lines(range(0, alerts, 2), resolved=True)
+        procs = [subprocess.Popen([sys.executable, ZBX_RC, "-c", config, "send"] + alert(trigger, True),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                 for trigger in range(1, alerts, 2)]
+        code, _, stderr = run(config, "send", "--batch", "-", stdin=batch)
+        for proc in procs:
+            _, proc_stderr = proc.communicate()
+            code = code or proc.returncode
+            stderr = stderr or proc_stderr.decode("utf-8", "replace").strip()
+    finally:
+        rocketchat.stop()
+    texts = [message["msg"] for message in rocketchat.messages.values()]
+    resolved = texts[0].count("- OK:") if len(texts) == 1 else 0
+    return (code == 0 and resolved == alerts,
+            "exit={0} messages={1} resolved lines={2}/{3} {4}".format(code, len(texts), resolved, alerts,
+                                                                      stderr[-200:]))
+
+
+def open_circuit(workdir):
+    rocketchat = FakeRocketChat()
+    config = write_config(os.path.join(workdir, "zbx-rc.conf"), workdir, rocketchat,
+                          sections={"BREAKER": {"failures": 1}, "TRANSPORT": {"retries": 0}})
+    # Nothing listens on port of fake server
+    rocketchat.server.server_close()
+    codes = [run(config, "send", *alert(1))[0], run(config, "send", *alert(2))[0],
+             run(config, "send", "--batch", "-", stdin=batch_lines(range(3, 5)))[0]]
+    connection = sqlite3.connect(os.path.join(workdir, "zbx-rc.sqlite"))
+    queued, = connection.execute("SELECT COUNT(*) FROM outbox;").fetchone()
+    state, = connection.execute("SELECT state FROM breaker WHERE backend = 'rocketchat';").fetchone()
+    connection.close()
+    return (all(code != 0 for code in codes) and queued == 0 and state == "open",
+            "exit codes={0} queued={1} circuit={2}".format(codes, queued, state))
+
+
+SCENARIOS = {"slow-daemon": slow_daemon, "accepted": accepted, "daemon-crash": daemon_crash,
+             "shared-event": shared_event, "slow-worker": slow_worker, "digest": digest, "open-circuit": open_circuit}
+
+
+def main():
+    parser = ArgumentParser(description="Fault scenarios of zbx-rc with misbehaving fake Rocket.Chat")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: {}".format(", ".join(sorted(unknown))))
+    failed = False
+    for name in names:
+        with tempfile.TemporaryDirectory() as workdir:
+            ok, details = SCENARIOS[name](workdir)
+        failed = failed or not ok
+        print("{0:<14} {1}  {2}".format(name, "OK" if ok else "FAIL", details))
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+End-to-end benchmark of 'zbx-rc.py' against local fake Rocket.Chat and Zabbix frontend.
+Every scenario starts with fresh database and fake servers, so counters belong to it only:
+
+    single   - sequential 'send' invocations of new problems
+    resolve  - sequential 'send' invocations updating messages of sent problems
+    graph    - sequential 'send' invocations of problems with graphs
+    storm    - alerts (problems, then resolves of them) piped to one 'send --batch -', with --daemon
+               handed to 'serve' over its socket by concurrent clients
+
+Latency of storm alert is time from start of the storm to its result. Graph scenario reports
+bytes of charts received from Zabbix and uploaded to Rocket.Chat, which --graph-profile and
+--recompress reduce. Results are saved as JSON to compare versions with each other:
+
+    python -m bench.run -n 20 --storm 1000 --rate-limit 100/1
+    python -m bench.run --compare bench/results/20261016-101500-39f9314.json
+    python -m bench.run --scenarios graph --graph-profile 600x150/2h --recompress
+"""
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.common import ZBX_RC, write_config
+from bench.fakes import FakeRocketChat, FakeZabbix
+from bench.startup import wait_socket
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+SCENARIOS = ("single", "resolve", "graph", "storm")
+# Metric -> True if bigger is better, used by --compare
+METRICS = {"p50_ms": False, "p99_ms": False, "alerts_per_s": True, "rc_bytes": False, "zbx_bytes": False,
+           "throttled": False, "chart_bytes": False, "upload_bytes": False}
+
+
+def percentile(values, p):
+    """
+    Returns nearest-rank percentile p of values.
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def alert(trigger, resolved=False, itemids=()):
+    subject = "{0}: Free space is low on host{1}".format("OK" if resolved else "PROBLEM", trigger)
+    message = "Free space is 5% tr_events.php?triggerid={0}&eventid={0}".format(trigger)
+    return {"to": "#bench", "subject": subject, "message": message, "itemids": list(itemids)}
+
+
+def send(config, request):
+    """
+    Runs one 'send' invocation, returns its wall time in seconds and error text or None.
+    """
+    message = request["message"] + "".join(" zbx;itemid:{}".format(itemid) for itemid in request["itemids"])
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, ZBX_RC, "-c", config, "send", request["to"], request["subject"], message],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - started
+    return elapsed, proc.stderr.decode("utf-8", "replace").strip() if proc.returncode else None
+
+
+def run_sequential(config, requests):
+    latencies, errors = [], []
+    for request in requests:
+        elapsed, error = send(config, request)
+        latencies.append(elapsed)
+        if error:
+            errors.append(error)
+    return latencies, errors
+
+
+def run_batch(config, requests):
+    """
+    Pipes requests to 'send --batch -', returns latencies of result lines and errors.
+    """
+    proc = subprocess.Popen([sys.executable, ZBX_RC, "-c", config, "send", "--batch", "-"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed():
+        for request in requests:
+            proc.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+        proc.stdin.close()
+
+    started = time.perf_counter()
+    threading.Thread(target=feed, daemon=True).start()
+    latencies, errors = [], []
+    for line in proc.stdout:
+        latencies.append(time.perf_counter() - started)
+        result = json.loads(line)
+        if result["status"] not in ("ok", "queued"):
+            errors.append(result.get("error") or result["status"])
+    stderr = proc.stderr.read().decode("utf-8", "replace").strip()
+    if proc.wait() and not errors:
+        errors.append(stderr or "exit code {}".format(proc.returncode))
+    return latencies, errors
+
+
+def run_daemon(socket_path, requests, concurrency=16):
+    """
+    Hands requests to running 'serve' over its socket by concurrent clients like many 'send' processes do,
+    alerts of one trigger/event one by one. Returns latencies of answers and errors.
+    """
+    import zbxdaemon
+
+    chains = {}
+    for request in requests:
+        chains.setdefault(request["message"], []).append(request)
+    started = time.perf_counter()
+    lock = threading.Lock()
+    latencies, errors = [], []
+
+    def submit(chain):
+        for request in chain:
+            message = request["message"] + "".join(" zbx;itemid:{}".format(itemid) for itemid in request["itemids"])
+            try:
+                result = zbxdaemon.submit(socket_path, {"to": request["to"], "subject": request["subject"],
+                                                        "message": message})
+            except SystemExit as e:
+                result = {"status": "error", "error": str(e)}
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                if result is None:
+                    errors.append("daemon is not running")
+                elif result["status"] not in ("ok", "queued", "accepted"):
+                    errors.append(result.get("error") or result["status"])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(submit, chains.values()))
+    return latencies, errors
+
+
+def run_scenario(name, args):
+    """
+    Runs scenario with fresh fake servers and database, returns dict of its results.
+    """
+    rocketchat = FakeRocketChat(latency=args.latency, rate_limit=args.rate_limit).start()
+    zabbix = FakeZabbix(latency=args.zabbix_latency).start()
+    daemon = None
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            graphs = {"zbx_graph_recompress": "yes" if args.recompress else "no"}
+            if args.graph_profile:
+                graphs["zbx_graph_recipients"] = "#bench:" + args.graph_profile
+            config = write_config(os.path.join(workdir, "zbx-rc.conf"), workdir, rocketchat, zabbix,
+                                  sections={"ZABBIX": graphs})
+            if args.daemon:
+                daemon = subprocess.Popen([sys.executable, ZBX_RC, "-c", config, "serve"],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                wait_socket(os.path.join(workdir, "zbx-rc.sock"))
+
+            if name == "single":
+                expected = {"posted": args.alerts}
+                started = time.perf_counter()
+                latencies, errors = run_sequential(config, [alert(i) for i in range(args.alerts)])
+            elif name == "resolve":
+                expected = {"posted": args.alerts, "updated": args.alerts}
+                _, errors = run_sequential(config, [alert(i) for i in range(args.alerts)])
+                started = time.perf_counter()
+                latencies, resolve_errors = run_sequential(config, [alert(i, True) for i in range(args.alerts)])
+                errors += resolve_errors
+            elif name == "graph":
+                graphs = 0 if (args.graph_profile or "").lower() == "off" else args.alerts
+                expected = {"posted": args.alerts, "uploads": graphs, "charts": graphs}
+                started = time.perf_counter()
+                latencies, errors = run_sequential(config, [alert(i, itemids=(100 + i * args.items + item
+                                                                              for item in range(args.items)))
+                                                            for i in range(args.alerts)])
+            else:
+                problems = args.storm - args.storm // 2
+                expected = {"posted": problems, "updated": args.storm - problems}
+                requests = [alert(i) for i in range(problems)] + [alert(i, True) for i in range(args.storm - problems)]
+                started = time.perf_counter()
+                if args.daemon:
+                    latencies, errors = run_daemon(os.path.join(workdir, "zbx-rc.sock"), requests)
+                else:
+                    latencies, errors = run_batch(config, requests)
+            elapsed = time.perf_counter() - started
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        rocketchat.stop()
+        zabbix.stop()
+
+    # Requests answered with 429 are repeated, count accepted ones only
+    counters = {"posted": rocketchat.requests["/api/v1/chat.postMessage"] - rocketchat.throttled["chat.postMessage"],
+                "updated": rocketchat.requests["/api/v1/chat.update"] - rocketchat.throttled["chat.update"],
+                "uploads": rocketchat.uploads,
+                "charts": zabbix.charts}
+    return {"alerts": len(latencies),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "alerts_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0,
+            "rc_bytes": rocketchat.bytes_in + rocketchat.bytes_out,
+            "zbx_bytes": zabbix.bytes_in + zabbix.bytes_out,
+            "throttled": sum(rocketchat.throttled.values()),
+            "chart_bytes": zabbix.chart_bytes,
+            "upload_bytes": rocketchat.upload_bytes,
+            "zbx_logins": zabbix.logins,
+            "counters": counters,
+            "errors": sorted(set(errors)),
+            "ok": not errors and all(counters[key] == value for key, value in expected.items())}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(ZBX_RC),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results, baseline=None):
+    print("{0:<8} {1:>6} {2:>9} {3:>9} {4:>9} {5:>10} {6:>10} {7:>5}".format(
+        "scenario", "alerts", "p50 ms", "p99 ms", "alerts/s", "RC bytes", "ZBX bytes", "429"))
+    for name, result in results.items():
+        print("{0:<8} {1[alerts]:>6} {1[p50_ms]:>9} {1[p99_ms]:>9} {1[alerts_per_s]:>9} "
+              "{1[rc_bytes]:>10} {1[zbx_bytes]:>10} {1[throttled]:>5}  {2}".format(
+                  name, result, "OK" if result["ok"] else "FAIL {}".format(result["counters"])))
+        if result.get("chart_bytes"):
+            print("\tcharts: {0} bytes from Zabbix, {1} bytes uploaded ({2:+.1f}%)".format(
+                result["chart_bytes"], result["upload_bytes"],
+                (result["upload_bytes"] - result["chart_bytes"]) / result["chart_bytes"] * 100))
+        for error in result["errors"][:5]:
+            print("\t" + error)
+        old = (baseline or {}).get(name)
+        if old:
+            deltas = []
+            for metric, bigger_better in METRICS.items():
+                if not old.get(metric):
+                    continue
+                delta = (result[metric] - old[metric]) / old[metric] * 100
+                better = delta > 0 if bigger_better else delta < 0
+                deltas.append("{0} {1:+.1f}%{2}".format(metric, delta, "" if abs(delta) < 5 or better else " !"))
+            print("\tvs baseline: " + ", ".join(deltas))
+
+
+def rate_limit(value):
+    """
+    Parses LIMIT/SECONDS argument.
+    """
+    limit, _, interval = value.partition("/")
+    return int(limit), float(interval or 1)
+
+
+def main():
+    parser = ArgumentParser(description="End-to-end benchmark with fake Rocket.Chat and Zabbix")
+    parser.add_argument("-n", "--alerts", type=int, default=20, help="Alerts of single, resolve and graph scenarios")
+    parser.add_argument("--storm", type=int, default=1000, help="Alerts of storm scenario")
+    parser.add_argument("--items", type=int, default=2, help="Graph items of alert in graph scenario")
+    parser.add_argument("--latency", type=float, default=0, help="Rocket.Chat response latency, seconds")
+    parser.add_argument("--zabbix-latency", type=float, default=0.2, help="chart3.php response latency, seconds")
+    parser.add_argument("--rate-limit", type=rate_limit, help="Rocket.Chat limit per endpoint, LIMIT/SECONDS")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Run 'serve', hand alerts of every scenario to it (storm over socket, not --batch)")
+    parser.add_argument("--graph-profile", help="Graph profile of bench recipient, e.g. 600x150/2h")
+    parser.add_argument("--recompress", action="store_true", help="Recompress graphs before upload")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument("--save", default=RESULTS_DIR, help="Directory for results file, empty to not save")
+    parser.add_argument("--compare", help="Results file of previous run to compare with")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: {}".format(", ".join(sorted(unknown))))
+    options = {key: value for key, value in vars(args).items() if key not in ("save", "compare")}
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            saved = json.load(file)
+        baseline = saved["scenarios"]
+        if saved["options"] != json.loads(json.dumps(options)):
+            print("WARNING: options differ from compared run {0}: {1}".format(saved["revision"], saved["options"]))
+
+    results = {}
+    for name in names:
+        results[name] = run_scenario(name, args)
+    print_results(results, baseline)
+
+    if args.save:
+        revision = git_revision()
+        os.makedirs(args.save, exist_ok=True)
+        path = os.path.join(args.save, "{0}-{1}.json".format(time.strftime("%Y%m%d-%H%M%S"), revision))
+        with open(path, "w") as file:
+            json.dump({"revision": revision, "time": int(time.time()), "options": options, "scenarios": results},
+                      file, indent=2)
+        print("results saved to {}".format(path))
+    raise SystemExit(0 if all(result["ok"] for result in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Measures start of short-lived 'zbx-rc.py' invocations with 'python -X importtime' and fails
+when imports of any of them take longer than budget. Zabbix runs one process per alert,
+so import time is paid by every message.
+
+    python -m bench.startup --budget 40
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from bench.common import ZBX_RC, write_config
+from bench.fakes import FakeRocketChat
+
+
+def parse_importtime(stderr):
+    """
+    Returns dict {module: cumulative microseconds} of top level imports made after interpreter start.
+    """
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip() == "site":
+            # Everything before is interpreter start, it doesn't depend on zbx-rc
+            imports = {}
+        elif not name.startswith("  "):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def measure(config, args, runs):
+    """
+    Runs zbx-rc.py runs times, returns median import time in ms, median wall time in ms and the heaviest imports.
+    """
+    import_times, wall_times, imports = [], [], {}
+    for _ in range(runs):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", ZBX_RC, "-c", config] + args,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        wall_times.append((time.perf_counter() - started) * 1000)
+        stderr = proc.stderr.decode("utf-8", "replace")
+        if proc.returncode != 0:
+            raise SystemExit("zbx-rc.py {} failed:\n{}".format(" ".join(args), stderr))
+        imports = parse_importtime(stderr)
+        import_times.append(sum(imports.values()) / 1000)
+    heaviest = sorted(imports.items(), key=lambda item: -item[1])[:5]
+    return statistics.median(import_times), statistics.median(wall_times), heaviest
+
+
+def wait_socket(path, timeout=10):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            raise SystemExit("Daemon didn't create socket {}".format(path))
+        time.sleep(0.05)
+
+
+def main():
+    parser = ArgumentParser(description="Import time budget of zbx-rc.py invocations")
+    parser.add_argument("-b", "--budget", type=float, default=40, help="Import time budget of invocation, ms")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="Runs of each invocation, median is reported")
+    args = parser.parse_args()
+
+    rocketchat = FakeRocketChat().start()
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        direct = write_config(os.path.join(workdir, "direct.conf"), workdir, rocketchat)
+        queued = write_config(os.path.join(workdir, "queued.conf"), workdir, rocketchat,
+                              sections={"OUTBOX": {"enabled": "yes"}})
+        daemon = subprocess.Popen([sys.executable, ZBX_RC, "-c", direct, "serve"],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_socket(os.path.join(workdir, "zbx-rc.sock"))
+            alert = ["send", "#bench", "PROBLEM", "tr_events.php?triggerid=1&eventid=1"]
+            scenarios = [("version", direct, ["--version"], None),
+                         ("send to daemon", direct, alert, args.budget),
+                         ("send to outbox", queued, alert, args.budget)]
+            for name, config, argv, budget in scenarios:
+                import_ms, wall_ms, heaviest = measure(config, argv, args.runs)
+                ok = budget is None or import_ms <= budget
+                failed = failed or not ok
+                print("{0:<16} imports {1:7.1f} ms  wall {2:7.1f} ms  {3}".format(
+                    name, import_ms, wall_ms, "" if budget is None else "OK" if ok else "OVER BUDGET"))
+                if not ok:
+                    for module, cumulative in heaviest:
+                        print("\t{0:<24} {1:7.1f} ms".format(module, cumulative / 1000))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+            rocketchat.stop()
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Runs N concurrent 'zbx-rc.py send' processes against local fake Rocket.Chat, starting from
+missing database, and checks that every trigger/event mapping is saved and found by resolve.
+
+    python -m bench.stress_db --processes 50
+"""
+import os
+import sqlite3
+import tempfile
+from argparse import ArgumentParser
+
+from bench.common import write_config, zbx_rc
+from bench.fakes import FakeRocketChat
+
+
+def run_wave(config, processes, subject, offset):
+    procs = [zbx_rc(config, "send", "#stress", "{0} {1}".format(subject, i),
+                    "tr_events.php?triggerid={0}&eventid={0}".format(offset + i))
+             for i in range(processes)]
+    errors = []
+    for proc in procs:
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            errors.append(stderr.decode("utf-8", "replace").strip())
+    return errors
+
+
+def main():
+    parser = ArgumentParser(description="Concurrent send stress test of zbx-rc database")
+    parser.add_argument("-n", "--processes", type=int, default=50, help="Concurrent send processes")
+    parser.add_argument("-r", "--rounds", type=int, default=3, help="Rounds, each starts from missing database")
+    args = parser.parse_args()
+
+    failed = False
+    for round_no in range(args.rounds):
+        rocketchat = FakeRocketChat().start()
+        with tempfile.TemporaryDirectory() as workdir:
+            config = write_config(os.path.join(workdir, "zbx-rc.conf"), workdir, rocketchat)
+            errors = run_wave(config, args.processes, "PROBLEM", 1000)
+            errors += run_wave(config, args.processes, "OK", 1000)
+
+            connection = sqlite3.connect(os.path.join(workdir, "zbx-rc.sqlite"))
+            mappings = connection.execute("SELECT COUNT(DISTINCT trigger_id) FROM msg;").fetchone()[0]
+            connection.close()
+        posted = rocketchat.requests["/api/v1/chat.postMessage"]
+        updated = rocketchat.requests["/api/v1/chat.update"]
+        rocketchat.stop()
+
+        ok = not errors and mappings == posted == updated == args.processes
+        failed = failed or not ok
+        print("round {0}: {1} processes, posted={2} mappings={3} updated={4} errors={5} {6}".format(
+            round_no + 1, args.processes, posted, mappings, updated, len(errors), "OK" if ok else "FAIL"))
+        for error in sorted(set(errors)):
+            print("\t" + error)
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
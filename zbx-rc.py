@@ -1,30 +1,48 @@
 #!/usr/bin/env python3
-import configparser
 import grp
+import json
 import logging
 import os
 import re
-import sqlite3
+import sys
+import threading
+import time
 from argparse import ArgumentParser
-from configparser import RawConfigParser
+from configparser import Error as ConfigError, RawConfigParser
+from functools import partial
+from types import MappingProxyType
+from typing import TYPE_CHECKING
 
-import requests
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
+# requests, asyncio, sqlite3 and own modules are imported by functions which need them:
+# 'send' handed over to daemon or queued to outbox doesn't pay for HTTP stack import.
+# Annotations name classes by module, so functions import the classes under their own names.
+if TYPE_CHECKING:
+    import sqlite3
+    import zbxacks
+    import zbxapi
+    import zbxbreaker
+    import zbxgraphget
+    import zbxoutbox
+    import zbxratelimit
+    import zbxstore
+    import zbxtransport
 
-from zbxgraphget import graph_get
+logging.basicConfig(level=logging.ERROR)
 
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+# Subject of recovery message
+RESOLVE_PATTERN = r"^(OK|Resolved)"
 
-logging.basicConfig(level=logging.ERROR)
+# Line of digest message with subject of one alert, 'part' column keeps its index
+DIGEST_LINE = "- {}"
+
+# Seconds to connect and to read answer of graph upload, Rocket.Chat stores file before answering
+UPLOAD_TIMEOUT = (3, 60)
 
-BLANK_DB = """CREATE TABLE msg (
-                    id         VARCHAR  UNIQUE ON CONFLICT IGNORE
-                                        PRIMARY KEY,
-                    trigger_id INT,
-                    event_id   INT,
-                    timestamp  DATETIME DEFAULT (CURRENT_TIMESTAMP),
-                    rid        VARCHAR
-                );"""
+# Daemon answers 'accepted' this many seconds before 'send' client stops waiting for delivery
+DAEMON_ACCEPT_MARGIN = 1
+
+# Seconds while outbox worker skips accepted alert which daemon is still delivering
+DAEMON_ACCEPT_LEASE = 300
 
 # DB_FILE = os.path.dirname(os.path.abspath(__file__)) + "/zbx-rc.sqlite"
 DB_DIR = "/opt/zbx-rc/"
@@ -60,6 +78,79 @@ def install_script(conf_dir: str, group: str):
             cfg.set("ZABBIX", "zbx_api_user", "user")
             cfg.set("ZABBIX", "zbx_api_pass", "password")
             cfg.set("ZABBIX", "zbx_tmp_dir", "/tmp")
+            cfg.set("ZABBIX", "zbx_session_file", DB_DIR + "zbx-session.json")
+            cfg.set("ZABBIX", "zbx_session_ttl", "1800")
+            cfg.set("ZABBIX", "zbx_graph_cache_dir", DB_DIR + "graph-cache")
+            cfg.set("ZABBIX", "zbx_graph_cache_ttl", "60")
+            cfg.set("ZABBIX", "zbx_graph_cache_size", "52428800")
+            cfg.set("ZABBIX", "zbx_graph_in_memory", "no")
+            cfg.set("ZABBIX", "zbx_graph_max_series", "0")
+            cfg.set("ZABBIX", "zbx_graph_width", "900")
+            cfg.set("ZABBIX", "zbx_graph_height", "200")
+            cfg.set("ZABBIX", "zbx_graph_period", "4h")
+            cfg.set("ZABBIX", "zbx_graph_severities", "")
+            cfg.set("ZABBIX", "zbx_graph_recipients", "")
+            cfg.set("ZABBIX", "zbx_graph_recompress", "no")
+            cfg.set("ZABBIX", "zbx_api_token", "")
+            cfg.set("ZABBIX", "zbx_enrich", "no")
+            cfg.set("ZABBIX", "zbx_item_cache_ttl", "60")
+            cfg.set("ZABBIX", "zbx_timeout", "30")
+            # Message database retention info
+            cfg.add_section("DB")
+            cfg.set("DB", "file", DB_FILE)
+            cfg.set("DB", "retention", "30d")
+            cfg.set("DB", "max_rows", "0")
+            cfg.set("DB", "prune_interval", "1h")
+            cfg.set("DB", "cache_size", "10000")
+            # Resident daemon info
+            cfg.add_section("DAEMON")
+            cfg.set("DAEMON", "socket", DB_DIR + "zbx-rc.sock")
+            cfg.set("DAEMON", "timeout", "10")
+            cfg.set("DAEMON", "socket_mode", "660")
+            cfg.set("DAEMON", "socket_group", "")
+            # Durable outbox info
+            cfg.add_section("OUTBOX")
+            cfg.set("OUTBOX", "enabled", "no")
+            cfg.set("OUTBOX", "batch_size", "50")
+            cfg.set("OUTBOX", "poll_interval", "1")
+            cfg.set("OUTBOX", "max_attempts", "10")
+            cfg.set("OUTBOX", "backoff", "5")
+            cfg.set("OUTBOX", "max_backoff", "600")
+            # Alert-storm coalescing info
+            cfg.add_section("COALESCE")
+            cfg.set("COALESCE", "window", "0")
+            cfg.set("COALESCE", "recipients", "")
+            # Problem/resolve lifecycle info
+            cfg.add_section("LIFECYCLE")
+            cfg.set("LIFECYCLE", "resolved", "send")
+            cfg.set("LIFECYCLE", "resolve_pattern", RESOLVE_PATTERN)
+            # Rocket.Chat rate limits info
+            cfg.add_section("RATELIMIT")
+            cfg.set("RATELIMIT", "enabled", "yes")
+            cfg.set("RATELIMIT", "max_wait", "60")
+            cfg.set("RATELIMIT", "retries", "3")
+            # Concurrent I/O info of daemon and worker
+            cfg.add_section("TRANSPORT")
+            cfg.set("TRANSPORT", "workers", "16")
+            cfg.set("TRANSPORT", "pool_size", "16")
+            cfg.set("TRANSPORT", "retries", "2")
+            cfg.set("TRANSPORT", "connect_timeout", "1")
+            cfg.set("TRANSPORT", "timeout", "3")
+            # Phase timing output
+            cfg.add_section("METRICS")
+            cfg.set("METRICS", "log", "")
+            cfg.set("METRICS", "textfile", "")
+            cfg.set("METRICS", "interval", "10")
+            # Acknowledgement by reactions info
+            cfg.add_section("ACK")
+            cfg.set("ACK", "reactions", ":white_check_mark:")
+            cfg.set("ACK", "unacknowledge", "no")
+            cfg.set("ACK", "interval", "30")
+            # Circuit breaker info
+            cfg.add_section("BREAKER")
+            cfg.set("BREAKER", "enabled", "yes")
+            cfg.set("BREAKER", "failures", "3")
+            cfg.set("BREAKER", "cooldown", "30")
 
             # Create directory
             os.mkdir(conf_dir, mode=0o655)
@@ -79,26 +170,98 @@ def install_script(conf_dir: str, group: str):
         raise SystemExit('PERMISSION ERROR: You have no permissions to create "{}" directory.'.format(conf_dir))
 
 
-def read_config(path: str) -> configparser.RawConfigParser:
+class ConfigSnapshot:
+    """
+    Read-only copy of config file values taken once at start. Getters have the same signatures
+    as RawConfigParser ones, so code reading options doesn't depend on parser.
+    """
+    _UNSET = object()
+
+    def __init__(self, sections: dict):
+        self._sections = MappingProxyType({name: MappingProxyType(dict(values)) for name, values in sections.items()})
+
+    def sections(self) -> list:
+        return list(self._sections)
+
+    def get(self, section: str, option: str, fallback=_UNSET):
+        try:
+            return self._sections[section][option.lower()]
+        except KeyError:
+            if fallback is self._UNSET:
+                raise SystemExit('ERROR: Missing "{}" option in [{}] section of config file.'.format(option, section))
+            return fallback
+
+    def _convert(self, convert, section: str, option: str, fallback):
+        value = self.get(section, option, fallback=self._UNSET if fallback is self._UNSET else None)
+        if value is None:
+            return fallback
+        try:
+            return convert(value)
+        except ValueError:
+            raise SystemExit('ERROR: Wrong value "{}" of "{}" option in [{}] section of config file.'.format(
+                value, option, section))
+
+    def getint(self, section: str, option: str, fallback=_UNSET) -> int:
+        return self._convert(int, section, option, fallback)
+
+    def getfloat(self, section: str, option: str, fallback=_UNSET) -> float:
+        return self._convert(float, section, option, fallback)
+
+    def getboolean(self, section: str, option: str, fallback=_UNSET) -> bool:
+        def convert(value):
+            if value.lower() not in RawConfigParser.BOOLEAN_STATES:
+                raise ValueError(value)
+            return RawConfigParser.BOOLEAN_STATES[value.lower()]
+        return self._convert(convert, section, option, fallback)
+
+
+def read_config(path: str) -> ConfigSnapshot:
     """
-    Function read config file and returns RawConfigParser object.
+    Function reads config file once and returns its read-only snapshot.
 
     :param path: Path to config file
     :type: str
-    :return: configparser.RawConfigParser object
-    :rtype: configparser.RawConfigParser
+    :return: ConfigSnapshot object
+    :rtype: ConfigSnapshot
     """
     cfg = RawConfigParser()
-    if os.path.exists(path):
-        try:
-            with open(path, 'r') as file:
-                file.read()
-                cfg.read(path)
-                return cfg
-        except PermissionError:
-            raise SystemExit('ERROR: Cannot read config file "{}".'.format(path))
-    else:
+    try:
+        with open(path, 'r') as file:
+            cfg.read_file(file)
+    except FileNotFoundError:
         raise SystemExit('ERROR: Cannot find "{}" file.'.format(path))
+    except PermissionError:
+        raise SystemExit('ERROR: Cannot read config file "{}".'.format(path))
+    except ConfigError as e:
+        raise SystemExit('ERROR: Cannot parse config file "{}": {}'.format(path, e))
+    return ConfigSnapshot({section: cfg.items(section) for section in cfg.sections()})
+
+
+def http_client():
+    """
+    Function imports requests on first use, import of HTTP stack takes most of script start time.
+
+    :return: requests module
+    """
+    import requests
+    from requests.packages.urllib3.exceptions import InsecureRequestWarning
+    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    return requests
+
+
+def log_connections(transport: 'zbxtransport.Transport') -> None:
+    """
+    Function prints connection reuse of Rocket.Chat and Zabbix clients in debug mode.
+
+    :param transport: Transport owning HTTP clients
+    :type: Transport
+    :return: None
+    """
+    if not DEBUG:
+        return
+    for name, stats in transport.stats().items():
+        print("{0} connections: {1[connections]} opened, {1[requests]} requests, {1[reused]} reused".format(name,
+                                                                                                            stats))
 
 
 def update_config(path, section, values):
@@ -127,7 +290,114 @@ def update_config(path, section, values):
             return False
 
 
-def get_auth(url: str, login: str, password: str) -> tuple:
+def parse_windows(value: str) -> dict:
+    """
+    Function parses per-recipient coalescing windows like "#noc:30, @admin:0".
+
+    :param value: Comma separated recipient:seconds pairs
+    :type: str
+    :return: Dict with recipient as key and window seconds as value
+    :rtype: dict
+    """
+    windows = {}
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        recipient, _, seconds = pair.strip().rpartition(':')
+        try:
+            windows[recipient] = float(seconds)
+        except ValueError:
+            raise SystemExit('ERROR: Wrong coalescing window "{}".'.format(pair.strip()))
+    return windows
+
+
+def parse_graph_profile(value: str, default: tuple):
+    """
+    Function parses graph profile like "600x150/2h" (size and period, both optional) or "off".
+
+    :param value: Profile
+    :type: str
+    :param default: GraphProfile of omitted parts
+    :type: GraphProfile
+    :return: GraphProfile or None if graphs are disabled
+    :rtype: GraphProfile
+    """
+    from zbxstore import parse_age
+    value = value.strip().lower()
+    if value in ('off', 'no', 'none'):
+        return None
+    size, _, period = value.partition('/')
+    try:
+        width, height = (int(part) for part in size.split('x')) if size else default[:2]
+    except ValueError:
+        raise SystemExit('ERROR: Wrong graph profile "{}", use WIDTHxHEIGHT/PERIOD or off.'.format(value))
+    if period:
+        # Number without suffix is seconds like in chart3.php
+        period = int(float(period)) if period.replace('.', '', 1).isdigit() else int(parse_age(period))
+    return default._replace(width=width, height=height, period=period or default.period)
+
+
+def parse_graph_profiles(value: str, default: tuple, key=None) -> dict:
+    """
+    Function parses graph profiles of recipients or severities like "#noc:off, @admin:1200x300/1d".
+
+    :param value: Comma separated name:profile pairs
+    :type: str
+    :param default: GraphProfile of omitted parts
+    :type: GraphProfile
+    :param key: Function normalizing name
+    :return: Dict with name as key and GraphProfile or None as value
+    :rtype: dict
+    """
+    profiles = {}
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        name, _, profile = pair.strip().rpartition(':')
+        if not name:
+            raise SystemExit('ERROR: Wrong graph profile "{}", use name:profile.'.format(pair.strip()))
+        profiles[key(name) if key else name] = parse_graph_profile(profile, default)
+    return profiles
+
+
+def rc_request(http, limiter: 'zbxratelimit.RateLimiter', method: str, url: str,
+               breaker: 'zbxbreaker.CircuitBreaker' = None, **kwargs):
+    """
+    Function makes Rocket.Chat API request through rate limiter if it is set.
+    Connection errors and answers of proxy without Rocket.Chat behind it are counted by breaker.
+
+    :param http: HTTPClient, requests module or requests.Session object
+    :param limiter: RateLimiter object or None
+    :type: RateLimiter
+    :param method: HTTP method
+    :type: str
+    :param url: Rocket.Chat API URL
+    :type: str
+    :param breaker: CircuitBreaker object or None
+    :type: CircuitBreaker
+    :return: requests.Response
+    """
+    requests = http_client()
+    try:
+        if limiter is None:
+            resp = http.request(method, url, **kwargs)
+        else:
+            resp = limiter.request(http, method, url, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        if breaker is not None:
+            from zbxbreaker import ROCKETCHAT
+            breaker.failure(ROCKETCHAT)
+        raise
+    if breaker is not None:
+        from zbxbreaker import ROCKETCHAT
+        if resp.status_code in (502, 503, 504):
+            breaker.failure(ROCKETCHAT)
+        else:
+            breaker.success(ROCKETCHAT)
+    return resp
+
+
+def get_auth(url: str, login: str, password: str, limiter: 'zbxratelimit.RateLimiter' = None, http=None) -> tuple:
     """
     Function get authentication token and user ID from Rocket.Chat.
 
@@ -137,14 +407,27 @@ def get_auth(url: str, login: str, password: str) -> tuple:
     :type: str
     :param password: Rocket.Chat user password
     :type: str
+    :param limiter: Rate limiter for Rocket.Chat API
+    :type: RateLimiter
+    :param http: Rocket.Chat client, default one is created if it is not set
+    :type: HTTPClient
     :return: tuple with userID and authToken
     :rtype: tuple
     """
+    from zbxmetrics import METRICS
+    requests = http_client()
+    if http is None:
+        from zbxhttp import HTTPClient
+        http = HTTPClient('rocketchat', pool_size=1, timeout=(1, 3))
 
     try:
         headers = {'Content-Type': 'application/json'}
-        timeout = (1, 3)
-        resp = requests.post(url, headers=headers, json={'username': login, 'password': password}, timeout=timeout)
+        with METRICS.span('rc_login') as span:
+            resp = rc_request(http, limiter, 'POST', url, headers=headers,
+                              json={'username': login, 'password': password})
+            span['status'] = resp.status_code
+            if not resp:
+                span['outcome'] = 'failed'
 
         resp_json = resp.json()
 
@@ -160,6 +443,355 @@ def get_auth(url: str, login: str, password: str) -> tuple:
         raise SystemExit("ERROR: Cannot connect to Rocket.Chat API {}.".format(e))
 
 
+def parse_trigger_event(msg: str) -> tuple:
+    """
+    Function finds trigger and event ids in message text (URL like tr_events.php?triggerid=..&eventid=..).
+
+    :param msg: Message text
+    :type: str
+    :return: Tuple (trigger_id, event_id) or (None, None)
+    :rtype: tuple
+    """
+    tr_ev = re.findall(r"triggerid=(\d+)&eventid=(\d+)", msg)
+    return tr_ev[0] if tr_ev else (None, None)
+
+
+def parse_recipients(to: str) -> list:
+    """
+    Function splits comma separated recipients like "#noc, @admin", duplicates are removed.
+
+    :param to: Recipients
+    :type: str
+    :return: List of recipients
+    :rtype: list
+    """
+    recipients = []
+    for name in to.split(','):
+        name = name.strip()
+        if name and name not in recipients:
+            recipients.append(name)
+    return recipients
+
+
+def recipient_rows(rows: list, recipient: str) -> list:
+    """
+    Function selects messages of trigger/event sent to recipient. Messages saved by older versions
+    have no recipient, they are updated for any recipient.
+
+    :param rows: Result of lookup_message()
+    :type: list
+    :param recipient: Message recipient - user or channel
+    :type: str
+    :return: List of tuples (id, rid, part, recipient)
+    :rtype: list
+    """
+    return [row for row in rows if row[3] == recipient] or [row for row in rows if row[3] is None]
+
+
+async def load_items(transport: 'zbxtransport.Transport', zbx: 'zbxgraphget.ZabbixWeb',
+                     connection: 'sqlite3.Connection', itemids: list) -> dict:
+    """
+    Coroutine returns hosts, names, last values and value types of items. Items cached in database
+    by any invocation are not requested, missing ones are read from Zabbix API with one JSON-RPC batch
+    and cached for zbx.item_cache_ttl seconds. Errors are logged, alert is sent without items then.
+
+    :param zbx: ZabbixWeb object with api set
+    :type: ZabbixWeb
+    :param connection: Database connection used in database thread
+    :type: sqlite3.Connection
+    :param itemids: Item ids of alert
+    :type: list
+    :return: Dict {itemid: item}
+    :rtype: dict
+    """
+    from zbxapi import ZabbixAPIError
+    from zbxitems import cache_items, cached_items, item_calls, parse_items
+    from zbxmetrics import METRICS
+    requests = http_client()
+
+    items = await transport.db(cached_items, connection, itemids)
+    missing = [itemid for itemid in dict.fromkeys(itemids) if itemid not in items]
+    if DEBUG:
+        print("item cache: {} cached, {} missing".format(len(items), len(missing)))
+    if not missing:
+        return items
+    if zbx.breaker is not None:
+        from zbxbreaker import ZABBIX
+        if not await transport.db(zbx.breaker.allow, ZABBIX):
+            logging.warning("Zabbix is unavailable, items are not read")
+            return items
+    with METRICS.span('enrich', items=len(missing)) as span:
+        try:
+            result, = await transport.call(zbx.api.batch, item_calls(missing))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if zbx.breaker is not None:
+                await transport.db(zbx.breaker.failure, ZABBIX)
+            result = e
+        except (requests.exceptions.RequestException, ValueError, ZabbixAPIError) as e:
+            result = e
+        if zbx.breaker is not None and not isinstance(result, requests.exceptions.RequestException):
+            await transport.db(zbx.breaker.success, ZABBIX)
+        if isinstance(result, Exception):
+            span['outcome'] = 'failed'
+            logging.error("Cannot read items from Zabbix API: {}".format(result))
+            return items
+    fetched = parse_items(result)
+    await transport.db(cache_items, connection, fetched, zbx.item_cache_ttl)
+    items.update(fetched)
+    return items
+
+
+async def send_message_async(transport: 'zbxtransport.Transport',
+                             url: str,
+                             uid: str,
+                             token: str,
+                             to: str,
+                             msg: str,
+                             subj: str,
+                             zbx_server: str,
+                             zbx_api_user: str,
+                             zbx_api_pass: str,
+                             zbx_tmp_dir: str,
+                             session=None,
+                             connection: 'sqlite3.Connection' = None,
+                             zbx: 'zbxgraphget.ZabbixWeb' = None,
+                             limiter: 'zbxratelimit.RateLimiter' = None,
+                             graph_in_memory: bool = False,
+                             breaker: 'zbxbreaker.CircuitBreaker' = None,
+                             cache: 'zbxstore.MessageCache' = None) -> bool:
+    """
+    Coroutine sends message to Rocket.Chat, arguments are the same as of send_message().
+    Message goes to all recipients concurrently, graphs are rendered once while it is posted,
+    trigger/event mappings are saved while graphs are uploaded. Messages of the same trigger/event
+    are processed one by one.
+    """
+    import asyncio
+    from zbxmetrics import METRICS
+    from zbxstore import connect, lookup_message, save_message
+    from zbxtransport import DeliveryError
+    requests = http_client()
+
+    if DEBUG:
+        print("Sending message:\n"
+              "\tSending API URL: {}\n"
+              "\tRecipient name: {}\n"
+              "\tSending subject: {}\n"
+              "\tSending message: {}\n".format(url, to, subj, msg))
+    logging.info("Sending message:\n"
+                 "\tSending API URL: {}\n"
+                 "\tRecipient name: {}\n"
+                 "\tSending subject: {}\n"
+                 "\tSending message: {}\n".format(url, to, subj, msg))
+
+    recipients = parse_recipients(to)
+    if not recipients or any(name[0] not in ('@', '#') for name in recipients):
+        raise DeliveryError('ERROR: Recipient name must stars with "@" or "#" symbol.')
+
+    own_connection = connection is None
+    if own_connection:
+        connection = await transport.db(connect, DB_FILE, check_same_thread=False)
+    http = session or transport.rocketchat
+
+    trigger_id, event_id = parse_trigger_event(msg)
+    # get item id from msg
+    itemid = re.findall(r"zbx;itemid:(\d+)", msg)
+    if itemid:
+        msg = re.sub(r"zbx;itemid:(\d+)", ' ', msg)
+    # severity chooses graph profile, e.g. zbx;severity:{EVENT.NSEVERITY}
+    severity = re.search(r"zbx;severity:(\w+)", msg)
+    if severity:
+        msg = re.sub(r"zbx;severity:(\w+)", ' ', msg)
+        severity = severity.group(1)
+    # GraphProfile -> tasks rendering its graphs
+    graphs = {}
+    profiles = {}
+    headers = {'X-Auth-Token': token, 'X-User-Id': uid, 'Content-Type': 'application/json'}
+    text_data = "*{}*\n{}".format(subj, msg)
+
+    async def upload(graph, rid: str):
+        try:
+            img = await graph
+        except Exception as e:
+            # Message is already posted, it is delivered without graph
+            logging.error("Cannot get graph from Zabbix: {!r}".format(e))
+            return
+        if not img:
+            return
+        upload_headers = {'X-Auth-Token': token, 'X-User-Id': uid}
+        with METRICS.span('upload', rid=rid) as span:
+            if graph_in_memory:
+                files = {'file': ('graph.png', img, 'image/png')}
+                r = await transport.call(rc_request, http, limiter, 'POST', url + "rooms.upload/" + rid,
+                                         breaker=breaker, files=files, headers=upload_headers,
+                                         timeout=UPLOAD_TIMEOUT)
+            else:
+                with open(img, 'rb') as fd:
+                    files = {'file': (os.path.basename(img), fd, 'image/png')}
+                    r = await transport.call(rc_request, http, limiter, 'POST', url + "rooms.upload/" + rid,
+                                             breaker=breaker, files=files, headers=upload_headers,
+                                             timeout=UPLOAD_TIMEOUT)
+            span['status'] = r.status_code
+            if not r:
+                span['outcome'] = 'failed'
+        # stdout of 'send --batch' is JSON lines of results, answer goes to log only
+        logging.info('Upload result: {}'.format(r.text))
+
+    async def post(recipient: str):
+        # Make request and send new message
+        with METRICS.span('post', to=recipient) as span:
+            resp = await transport.call(rc_request, http, limiter, 'POST', url + 'chat.postMessage',
+                                        breaker=breaker, json={'channel': recipient, 'text': text_data},
+                                        headers=headers)
+            span['status'] = resp.status_code
+            if not resp:
+                span['outcome'] = 'failed'
+        if resp:
+            msg_id = resp.json()["message"]["_id"]
+            # ts = resp.json()["message"]["ts"] #  '2021-02-10T23:28:49.188Z'
+            rid = resp.json()["message"]["rid"]
+            logging.info("to={}, msg_id={}, trigger_id={}, event_id={}".format(recipient, msg_id, trigger_id,
+                                                                               event_id))
+        # Debug
+        logging.info('Result: {}'.format(resp.text))
+        if DEBUG:
+            print('Result: {}'.format(resp.text))
+        return (recipient, msg_id, rid) if resp else None
+
+    async def update(msg_id: str, rid: str, part: int):
+        # Digest is shared by alerts of several triggers/events, they rewrite it one by one
+        async with transport.exclusive(('digest', msg_id) if part is not None else None):
+            with METRICS.span('update', rid=rid) as span:
+                if part is None:
+                    updated = await transport.call(update_message, msg_id, rid)
+                else:
+                    updated = await transport.call(update_digest, msg_id, rid, part)
+                span['outcome'] = 'ok' if updated else 'failed'
+                return updated
+
+    def update_message(msg_id: str, rid: str) -> bool:
+        # Make request and update message
+        resp = rc_request(http, limiter, 'POST', url + "chat.update", breaker=breaker,
+                          json={"msgId": msg_id, 'roomId': rid, 'text': text_data}, headers=headers)
+        return bool(resp)
+
+    def update_digest(msg_id: str, rid: str, part: int) -> bool:
+        # Message is a digest, replace only line of this alert. Text is read and written back under lock
+        # of all processes, otherwise concurrent resolves overwrite lines of each other
+        from zbxstore import file_lock
+        with file_lock(DB_FILE + '.digest.lock'):
+            resp = rc_request(http, limiter, 'GET', url + 'chat.getMessage', breaker=breaker,
+                              params={'msgId': msg_id}, headers=headers)
+            if not resp:
+                return False
+            lines = resp.json()['message']['msg'].split('\n')
+            if part + 1 < len(lines):
+                lines[part + 1] = DIGEST_LINE.format(subj)
+            resp = rc_request(http, limiter, 'POST', url + "chat.update", breaker=breaker,
+                              json={"msgId": msg_id, 'roomId': rid, 'text': '\n'.join(lines)}, headers=headers)
+            return bool(resp)
+
+    def lookup(span: dict) -> list:
+        # Runs in database thread, so hit counter isn't changed by other lookups meanwhile
+        if cache is None:
+            return lookup_message(connection, trigger_id, event_id)
+        hits = cache.stats['hit']
+        rows = lookup_message(connection, trigger_id, event_id, cache, recipients)
+        span['cache'] = 'hit' if cache.stats['hit'] > hits else 'miss'
+        if DEBUG:
+            print("message cache stats: {}".format(cache.stats))
+        return rows
+
+    def save(sent: list):
+        # Mappings of all rooms are saved in one transaction
+        with METRICS.span('save'):
+            for recipient, msg_id, rid in sent:
+                save_message(connection, msg_id, trigger_id, event_id, rid, recipient=recipient, cache=cache)
+            connection.commit()
+
+    with METRICS.span('send', to=to, trigger_id=trigger_id, event_id=event_id, graphs=len(itemid)) as span:
+        try:
+            # Hosts, names and last values of items are added to text, items which can't be drawn are skipped
+            if itemid and zbx is not None and zbx.api is not None:
+                from zbxitems import chart_items, describe_items
+                items = await load_items(transport, zbx, connection, itemid)
+                if items:
+                    text_data = "{}\n{}".format(text_data.rstrip(), describe_items(items, itemid))
+                    itemid = chart_items(items, itemid)
+
+            async with transport.exclusive((trigger_id, event_id) if trigger_id else None):
+                if trigger_id:
+                    with METRICS.span('lookup') as lookup_span:
+                        res = await transport.db(lookup, lookup_span)
+                else:
+                    res = []
+
+                # Recipients which got message of this trigger/event get updates of every copy, the rest get new message
+                updates = list(dict.fromkeys(row[:3] for recipient in recipients
+                                             for row in recipient_rows(res, recipient)))
+                fresh = [recipient for recipient in recipients if not recipient_rows(res, recipient)]
+
+                # get img from zabbix once per graph profile of recipients, it is attached to new messages only
+                # and rendered while they are posted. Items are grouped into charts by zbx.max_series,
+                # charts are rendered concurrently
+                if itemid and fresh:
+                    from zbxgraphget import DEFAULT_PROFILE, graph_bytes, graph_get, group_items
+                    profiles = {recipient: DEFAULT_PROFILE if zbx is None else zbx.graph_profile(recipient, severity)
+                                for recipient in fresh}
+                    for profile in dict.fromkeys(profile for profile in profiles.values() if profile is not None):
+                        for items in group_items(itemid, zbx.max_series if zbx is not None else 0):
+                            if graph_in_memory:
+                                render = transport.call(graph_bytes, items, subj, zbx_server, zbx_api_user,
+                                                        zbx_api_pass, zbx=zbx, profile=profile)
+                            else:
+                                render = transport.call(graph_get, items, subj, zbx_server, zbx_api_user,
+                                                        zbx_api_pass, zbx_tmp_dir, zbx=zbx, profile=profile)
+                            graphs.setdefault(profile, []).append(transport.loop.create_task(render))
+
+                results = await asyncio.gather(*([post(recipient) for recipient in fresh] +
+                                                 [update(msg_id, rid, part) for msg_id, rid, part in updates]))
+                sent = [result for result in results[:len(fresh)] if result]
+
+                # send images to every room, save mappings meanwhile
+                tasks = [upload(graph, rid) for recipient, _, rid in sent
+                         for graph in graphs.get(profiles.get(recipient), [])]
+                if event_id and trigger_id and sent:
+                    tasks.append(transport.db(save, sent))
+                await asyncio.gather(*tasks)
+
+            # logging.info("resp.url=", resp.url)
+            # logging.info("resp.json=", resp.json())
+            delivered = len(sent) == len(fresh) and all(results[len(fresh):])
+            if not delivered:
+                span['outcome'] = 'failed'
+            return delivered
+
+        except requests.exceptions.SSLError:
+            raise DeliveryError('ERROR: Cannot verify SSL Certificate.')
+        except requests.exceptions.ConnectTimeout:
+            raise DeliveryError('ERROR: Cannot connect to Rocket.Chat API - connection timeout')
+        except requests.exceptions.ConnectionError as e:
+            raise DeliveryError("ERROR: Cannot connect to Rocket.Chat API {}.".format(e))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Read timeout, broken answer of Rocket.Chat or proxy
+            raise DeliveryError("ERROR: Rocket.Chat API request failed: {!r}.".format(e))
+        finally:
+            # Do not leave images in tmp dir if message is not sent. Graph error is logged by upload(),
+            # it must not replace error of delivery raised from try block
+            for graph in [graph for tasks in graphs.values() for graph in tasks]:
+                if graph_in_memory:
+                    graph.add_done_callback(lambda task: task.cancelled() or task.exception())
+                    continue
+                try:
+                    file = await graph
+                except Exception:
+                    file = None
+                if file and os.path.exists(file):
+                    os.remove(file)
+            if own_connection:
+                await transport.db(connection.close)
+            log_connections(transport)
+
+
 def send_message(url: str,
                  uid: str,
                  token: str,
@@ -169,7 +801,15 @@ def send_message(url: str,
                  zbx_server: str,
                  zbx_api_user: str,
                  zbx_api_pass: str,
-                 zbx_tmp_dir: str) -> None:
+                 zbx_tmp_dir: str,
+                 session=None,
+                 connection: 'sqlite3.Connection' = None,
+                 zbx: 'zbxgraphget.ZabbixWeb' = None,
+                 limiter: 'zbxratelimit.RateLimiter' = None,
+                 graph_in_memory: bool = False,
+                 transport: 'zbxtransport.Transport' = None,
+                 breaker: 'zbxbreaker.CircuitBreaker' = None,
+                 cache: 'zbxstore.MessageCache' = None) -> bool:
     """
     Function send message to Rocket.Chat.
 
@@ -179,7 +819,7 @@ def send_message(url: str,
     :type: str
     :param token: Authentication token for sending user
     :type: str
-    :param to: Message recipient - user or channel
+    :param to: Message recipient - user or channel, several recipients are separated by comma
     :type: str
     :param msg: Message text
     :type: str
@@ -193,138 +833,877 @@ def send_message(url: str,
     :type: str
     :param zbx_tmp_dir: tmp dir for img
     :type: str
+    :param session: Rocket.Chat client to use instead of client of transport
+    :type: HTTPClient
+    :param connection: Opened database connection to reuse
+    :type: sqlite3.Connection
+    :param zbx: Logged in ZabbixWeb object to reuse
+    :type: ZabbixWeb
+    :param limiter: Rate limiter for Rocket.Chat API
+    :type: RateLimiter
+    :param graph_in_memory: Upload graph from memory instead of temporary file
+    :type: bool
+    :param transport: Event loop to run I/O in, temporary one is created if it is not set
+    :type: Transport
+    :param breaker: Circuit breaker counting Rocket.Chat connection errors
+    :type: CircuitBreaker
+    :param cache: Cache of sent messages in front of database
+    :type: MessageCache
     :return: True or False
     :rtype: bool
     """
+    own_transport = transport is None
+    if own_transport:
+        from zbxtransport import Transport
+        transport = Transport(workers=4, pool_size=4)
+    try:
+        return transport.run(send_message_async(transport,
+                                                url=url,
+                                                uid=uid,
+                                                token=token,
+                                                to=to,
+                                                msg=msg,
+                                                subj=subj,
+                                                zbx_server=zbx_server,
+                                                zbx_api_user=zbx_api_user,
+                                                zbx_api_pass=zbx_api_pass,
+                                                zbx_tmp_dir=zbx_tmp_dir,
+                                                session=session,
+                                                connection=connection,
+                                                zbx=zbx,
+                                                limiter=limiter,
+                                                graph_in_memory=graph_in_memory,
+                                                breaker=breaker,
+                                                cache=cache))
+    finally:
+        if own_transport:
+            transport.close()
+
+
+async def send_digest_async(transport: 'zbxtransport.Transport',
+                            url: str,
+                            uid: str,
+                            token: str,
+                            to: str,
+                            alerts: list,
+                            session=None,
+                            connection: 'sqlite3.Connection' = None,
+                            limiter: 'zbxratelimit.RateLimiter' = None,
+                            breaker: 'zbxbreaker.CircuitBreaker' = None,
+                            cache: 'zbxstore.MessageCache' = None) -> bool:
+    """
+    Coroutine sends several alerts as one message, arguments are the same as of send_digest().
+    """
+    from zbxmetrics import METRICS
+    from zbxstore import connect, save_message
+    from zbxtransport import DeliveryError
+    requests = http_client()
 
     if DEBUG:
-        print("Sending message:\n"
-              "\tSending API URL: {}\n"
-              "\tRecipient name: {}\n"
-              "\tSending subject: {}\n"
-              "\tSending message: {}\n".format(url, to, subj, msg))
-    logging.info("Sending message:\n"
-                 "\tSending API URL: {}\n"
-                 "\tRecipient name: {}\n"
-                 "\tSending subject: {}\n"
-                 "\tSending message: {}\n".format(url, to, subj, msg))
+        print("Sending digest of {} alerts to {}".format(len(alerts), to))
 
     if to[0] not in ('@', '#'):
-        raise SystemExit('ERROR: Recipient name must stars with "@" or "#" symbol.')
+        raise DeliveryError('ERROR: Recipient name must stars with "@" or "#" symbol.')
 
-    connection = sqlite3.connect(DB_FILE)
-    cursor = connection.cursor()
+    own_connection = connection is None
+    if own_connection:
+        connection = await transport.db(connect, DB_FILE, check_same_thread=False)
+    http = session or transport.rocketchat
 
-    tr_ev = re.findall("triggerid=(\d+)&eventid=(\d+)", msg)
-    # get item id from msg
-    itemid = re.findall("zbx;itemid:(\d+)", msg)
-    # get img from zabbix
-    if itemid:
-        file = graph_get(itemid,
-                         subj,
-                         zbx_server,
-                         zbx_api_user,
-                         zbx_api_pass,
-                         zbx_tmp_dir)
-        msg = re.sub(r"zbx;itemid:(\d+)", ' ', msg)
-    else:
-        file = None
+    text_data = "*{} alerts*\n".format(len(alerts)) + "\n".join(DIGEST_LINE.format(subj) for subj, _ in alerts)
+    attachments = [{'title': subj, 'text': re.sub(r"zbx;(itemid:\d+|severity:\w+)", ' ', msg), 'collapsed': True}
+                   for subj, msg in alerts]
 
-    if tr_ev:
-        trigger_id, event_id = tr_ev[0]
-        query = "SELECT id, rid FROM msg WHERE event_id = {} AND trigger_id = {};".format(event_id, trigger_id)
-        res = cursor.execute(query).fetchall()
-    else:
-        trigger_id = event_id = None
-        res = None
+    def save(msg_id: str, rid: str):
+        # Every trigger/event of digest points to the same message
+        with METRICS.span('save'):
+            for part, (_, msg) in enumerate(alerts):
+                trigger_id, event_id = parse_trigger_event(msg)
+                if trigger_id:
+                    save_message(connection, msg_id, trigger_id, event_id, rid, part, recipient=to, cache=cache)
+            connection.commit()
 
     try:
-        timeout = (1, 3)
         headers = {'X-Auth-Token': token, 'X-User-Id': uid, 'Content-Type': 'application/json'}
-        text_data = "*{}*\n{}".format(subj, msg)
-
-        if not res:
-            # Make request and send new message
-            resp = requests.post(url + 'chat.postMessage', json={'channel': to, 'text': text_data}, headers=headers,
-                                 timeout=timeout)
-            if resp:
-                msg_id = resp.json()["message"]["_id"]
-                # ts = resp.json()["message"]["ts"] #  '2021-02-10T23:28:49.188Z'
-                rid = resp.json()["message"]["rid"]
-                if event_id and trigger_id:
-                    query_insert = """INSERT INTO msg (id, event_id, trigger_id, rid) VALUES ("{}", {}, {}, "{}");""".format(
-                        msg_id, event_id, trigger_id, rid)
-                    cursor.execute(query_insert)
-                    connection.commit()
-                logging.info("to={}, msg_id={}, trigger_id={}, event_id={}".format(to, msg_id, trigger_id, event_id))
-
-                # send image if get rid
-                if file:
-                    with open(file, 'rb') as img:
-                        name_img = os.path.basename(file)
-                        files = {'file': (name_img, img, 'image/png')}
-                        with requests.Session() as s:
-                            del headers['Content-Type']
-                            r = s.post(url + "rooms.upload/" + rid, files=files,
-                                       headers=headers)
-                            print(r.json())
-
-                    os.remove(file)
-
-            # Debug
-            logging.info('Result: {}'.format(resp.text))
-            if DEBUG:
-                print('Result: {}'.format(resp.text))
-        else:
-            # Make request and update message
-            msg_id, rid = res[0]
-            resp = requests.post(url + "chat.update", json={"msgId": msg_id, 'roomId': rid, 'text': text_data},
-                                 headers=headers, timeout=timeout)
+        with METRICS.span('digest', to=to, alerts=len(alerts)) as span:
+            resp = await transport.call(rc_request, http, limiter, 'POST', url + 'chat.postMessage',
+                                        breaker=breaker,
+                                        json={'channel': to, 'text': text_data, 'attachments': attachments},
+                                        headers=headers)
+            span['status'] = resp.status_code
+            if not resp:
+                span['outcome'] = 'failed'
+        if resp:
+            msg_id = resp.json()["message"]["_id"]
+            rid = resp.json()["message"]["rid"]
+            await transport.db(save, msg_id, rid)
+            logging.info("to={}, msg_id={}, digest of {} alerts".format(to, msg_id, len(alerts)))
 
-        # logging.info("resp.url=", resp.url)
-        # logging.info("resp.json=", resp.json())
-        connection.close()
+        if DEBUG:
+            print('Result: {}'.format(resp.text))
+        return bool(resp)
 
     except requests.exceptions.SSLError:
-        raise SystemExit('ERROR: Cannot verify SSL Certificate.')
+        raise DeliveryError('ERROR: Cannot verify SSL Certificate.')
     except requests.exceptions.ConnectTimeout:
-        raise SystemExit('ERROR: Cannot connect to Rocket.Chat API - connection timeout')
+        raise DeliveryError('ERROR: Cannot connect to Rocket.Chat API - connection timeout')
     except requests.exceptions.ConnectionError as e:
-        raise SystemExit("ERROR: Cannot connect to Rocket.Chat API {}.".format(e))
+        raise DeliveryError("ERROR: Cannot connect to Rocket.Chat API {}.".format(e))
+    except (requests.exceptions.RequestException, ValueError) as e:
+        raise DeliveryError("ERROR: Rocket.Chat API request failed: {!r}.".format(e))
+    finally:
+        if own_connection:
+            await transport.db(connection.close)
+        log_connections(transport)
 
 
-def check_db(group: str = "zabbix") -> bool:
+def send_digest(url: str,
+                uid: str,
+                token: str,
+                to: str,
+                alerts: list,
+                session=None,
+                connection: 'sqlite3.Connection' = None,
+                limiter: 'zbxratelimit.RateLimiter' = None,
+                transport: 'zbxtransport.Transport' = None,
+                breaker: 'zbxbreaker.CircuitBreaker' = None,
+                cache: 'zbxstore.MessageCache' = None) -> bool:
     """
-    Проверяет что База работает. Если не работает или битая, удаляет файл и создает снова чистую базу
-    Пример пустой базы в виде SQL в BLANK_DB
+    Function sends several alerts as one message. Subjects are listed in text,
+    bodies go to collapsed attachments. Graphs are not rendered for digest.
+
+    :param url: Rocket.Chat API url for sending message
+    :type: str
+    :param uid: Rocket.Chat user ID who sending message
+    :type: str
+    :param token: Authentication token for sending user
+    :type: str
+    :param to: Message recipient - user or channel
+    :type: str
+    :param alerts: List of tuples (subject, message)
+    :type: list
+    :param session: Rocket.Chat client to use instead of client of transport
+    :type: HTTPClient
+    :param connection: Opened database connection to reuse
+    :type: sqlite3.Connection
+    :param limiter: Rate limiter for Rocket.Chat API
+    :type: RateLimiter
+    :param transport: Event loop to run I/O in, temporary one is created if it is not set
+    :type: Transport
+    :param breaker: Circuit breaker counting Rocket.Chat connection errors
+    :type: CircuitBreaker
+    :param cache: Cache of sent messages in front of database
+    :type: MessageCache
+    :return: True or False
+    :rtype: bool
+    """
+    own_transport = transport is None
+    if own_transport:
+        from zbxtransport import Transport
+        transport = Transport(workers=2, pool_size=2)
+    try:
+        return transport.run(send_digest_async(transport,
+                                               url=url,
+                                               uid=uid,
+                                               token=token,
+                                               to=to,
+                                               alerts=alerts,
+                                               session=session,
+                                               connection=connection,
+                                               limiter=limiter,
+                                               breaker=breaker,
+                                               cache=cache))
+    finally:
+        if own_transport:
+            transport.close()
+
+
+class MessageSender:
+    """
+    Sends messages and digests with warm HTTP connection pool, database connection, cache of sent messages
+    and Zabbix cookie.
+    Alerts are processed concurrently in Transport event loop, alerts of one trigger/event one by one.
+    While circuit breaker of Rocket.Chat is open, submitted alerts are queued to outbox if it is set,
+    otherwise they fail at once.
+    """
+
+    def __init__(self,
+                 url: str,
+                 uid: str,
+                 token: str,
+                 zbx_server: str,
+                 zbx_api_user: str,
+                 zbx_api_pass: str,
+                 zbx_tmp_dir: str,
+                 connection: 'sqlite3.Connection',
+                 resolved_policy: str = 'send',
+                 resolve_pattern: str = RESOLVE_PATTERN,
+                 limiter: 'zbxratelimit.RateLimiter' = None,
+                 zbx: 'zbxgraphget.ZabbixWeb' = None,
+                 graph_in_memory: bool = False,
+                 retention: dict = None,
+                 transport: 'zbxtransport.Transport' = None,
+                 breaker: 'zbxbreaker.CircuitBreaker' = None,
+                 outbox: 'zbxoutbox.Outbox' = None,
+                 cache: 'zbxstore.MessageCache' = None):
+        self.url = url
+        self.uid = uid
+        self.token = token
+        self.zbx_server = zbx_server
+        self.zbx_api_user = zbx_api_user
+        self.zbx_api_pass = zbx_api_pass
+        self.zbx_tmp_dir = zbx_tmp_dir
+        self.connection = connection
+        self.resolved_policy = resolved_policy
+        self.resolve_pattern = resolve_pattern
+        self.limiter = limiter
+        self.graph_in_memory = graph_in_memory
+        self.retention = retention or {}
+        self.next_prune = 0
+        self.breaker = breaker
+        self.outbox = outbox
+        self.cache = cache
+        self.own_transport = transport is None
+        if transport is None:
+            from zbxtransport import Transport
+            transport = Transport()
+        self.transport = transport
+        if zbx is None:
+            from zbxgraphget import ZabbixWeb
+            zbx = ZabbixWeb(server=zbx_server, username=zbx_api_user, password=zbx_api_pass)
+        # Zabbix requests go through keep-alive client of transport
+        zbx.http = transport.zabbix
+        if zbx.api is not None:
+            zbx.api.http = transport.zabbix
+        self.zbx = zbx
+
+    async def prune(self) -> None:
+        """
+        Coroutine applies retention at most once per prune interval.
+        """
+        from zbxstore import maybe_prune
+        if not self.retention or time.time() < self.next_prune:
+            return
+        self.next_prune = time.time() + self.retention.get('interval', 3600)
+        await self.transport.db(maybe_prune, self.connection, cache=self.cache, **self.retention)
+
+    async def send_async(self, to: str, subj: str, msg: str) -> bool:
+        await self.prune()
+        return await send_message_async(self.transport,
+                                        url=self.url,
+                                        uid=self.uid,
+                                        token=self.token,
+                                        to=to,
+                                        msg=msg,
+                                        subj=subj,
+                                        zbx_server=self.zbx_server,
+                                        zbx_api_user=self.zbx_api_user,
+                                        zbx_api_pass=self.zbx_api_pass,
+                                        zbx_tmp_dir=self.zbx_tmp_dir,
+                                        connection=self.connection,
+                                        zbx=self.zbx,
+                                        limiter=self.limiter,
+                                        graph_in_memory=self.graph_in_memory,
+                                        breaker=self.breaker,
+                                        cache=self.cache)
+
+    async def send_digest_async(self, to: str, alerts: list) -> bool:
+        await self.prune()
+        return await send_digest_async(self.transport,
+                                       url=self.url,
+                                       uid=self.uid,
+                                       token=self.token,
+                                       to=to,
+                                       alerts=alerts,
+                                       connection=self.connection,
+                                       limiter=self.limiter,
+                                       breaker=self.breaker,
+                                       cache=self.cache)
+
+    async def submit_async(self, to: str, subj: str, msg: str) -> str:
+        """
+        Coroutine sends alert, while Rocket.Chat is known to be down alert is queued to outbox
+        without waiting for timeouts. The first alert after cooldown is sent as probe.
+
+        :return: 'ok', 'failed' or 'queued'
+        :rtype: str
+        """
+        from zbxbreaker import ROCKETCHAT
+        from zbxtransport import DeliveryError
+        if self.breaker is None or await self.transport.db(self.breaker.allow, ROCKETCHAT):
+            return 'ok' if await self.send_async(to, subj, msg) else 'failed'
+        if self.outbox is None:
+            raise DeliveryError('ERROR: Rocket.Chat is unavailable, circuit is open.')
+        try:
+            await self.transport.db(enqueue_message, self.outbox, to, subj, msg)
+        except SystemExit as e:
+            raise DeliveryError(str(e))
+        return 'queued'
+
+    async def deliver_async(self, jobs: list) -> bool:
+        """
+        Coroutine delivers outbox jobs of one digest group. Alerts which update already sent
+        messages go one by one, the rest are combined into digest. Problem resolved while
+        it was queued is sent as one final message or suppressed by resolved_policy.
+        """
+        from zbxstore import lookup_message
+        delivered = True
+        fresh = []
+        for job in jobs:
+            trigger_id, event_id = parse_trigger_event(job.message)
+            sent_before = trigger_id and recipient_rows(
+                await self.transport.db(lookup_message, self.connection, trigger_id, event_id, self.cache,
+                                        [job.recipient]),
+                job.recipient)
+            if (not sent_before and job.folded and self.resolved_policy == 'suppress'
+                    and re.search(self.resolve_pattern, job.subject)):
+                logging.info("Problem trigger_id={}, event_id={} is resolved before delivery, "
+                             "suppressed".format(trigger_id, event_id))
+                if DEBUG:
+                    print("Suppressed resolved before delivery message {}".format(job.id))
+                continue
+            if sent_before or len(jobs) == 1:
+                delivered = await self.send_async(job.recipient, job.subject, job.message) and delivered
+            else:
+                fresh.append(job)
+        if len(fresh) == 1:
+            delivered = await self.send_async(fresh[0].recipient, fresh[0].subject, fresh[0].message) and delivered
+        elif fresh:
+            delivered = await self.send_digest_async(fresh[0].recipient,
+                                                     [(job.subject, job.message) for job in fresh]) and delivered
+        return delivered
+
+    def send(self, to: str, subj: str, msg: str) -> bool:
+        return self.transport.run(self.send_async(to, subj, msg))
+
+    def submit(self, to: str, subj: str, msg: str) -> str:
+        return self.transport.run(self.submit_async(to, subj, msg))
+
+    def send_digest(self, to: str, alerts: list) -> bool:
+        return self.transport.run(self.send_digest_async(to, alerts))
+
+    def deliver(self, jobs: list) -> bool:
+        return self.transport.run(self.deliver_async(jobs))
+
+    def deliver_many(self, groups: list) -> list:
+        """
+        Function delivers several digest groups concurrently.
+
+        :param groups: List of lists of Job
+        :type: list
+        :return: List with True, False or SystemExit for every group
+        :rtype: list
+        """
+        import asyncio
+        from zbxtransport import DeliveryError
+
+        async def gather():
+            return await asyncio.gather(*(self.deliver_async(jobs) for jobs in groups), return_exceptions=True)
+
+        results = self.transport.run(gather())
+        for i, result in enumerate(results):
+            if isinstance(result, DeliveryError):
+                results[i] = SystemExit(str(result))
+            elif isinstance(result, Exception):
+                # Unexpected error is retried with backoff like refused delivery, it doesn't stop worker
+                logging.error("Cannot deliver queued messages {}: {!r}".format([job.id for job in groups[i]],
+                                                                               result))
+                results[i] = SystemExit('ERROR: {!r}'.format(result))
+            elif isinstance(result, BaseException):
+                raise result
+        return results
+
+    def close(self):
+        if self.own_transport:
+            self.transport.close()
+
+
+def parse_batch_line(line: str) -> tuple:
+    """
+    Function parses alert of batch file: JSON object with to, subject, message and optional itemids.
+    Itemids are added to message as graph markers.
+
+    :param line: JSON line
+    :type: str
+    :return: Tuple (to, subject, message)
+    :rtype: tuple
+    """
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        raise ValueError('ERROR: Malformed JSON: {}.'.format(e))
+    if not isinstance(request, dict):
+        raise ValueError('ERROR: Alert must be JSON object.')
+    missing = [field for field in ('to', 'subject', 'message') if not isinstance(request.get(field), str)]
+    if missing:
+        raise ValueError('ERROR: Missing fields: {}.'.format(', '.join(missing)))
+    itemids = request.get('itemids') or []
+    if not isinstance(itemids, list):
+        itemids = [itemids]
+    if not all(str(itemid).isdigit() for itemid in itemids):
+        raise ValueError('ERROR: Wrong itemids {}.'.format(request['itemids']))
+    message = request['message'] + ''.join(' zbx;itemid:{}'.format(itemid) for itemid in itemids)
+    return request['to'], request['subject'], message
+
+
+def enqueue_message(outbox: 'zbxoutbox.Outbox', to: str, subj: str, msg: str, window: float = 0, windows: dict = None,
+                    lease: float = 0) -> list:
+    """
+    Function queues message to outbox, one row per recipient.
+
+    :param outbox: Outbox object
+    :type: Outbox
+    :param to: Message recipients separated by comma
+    :type: str
+    :param subj: Message subject
+    :type: str
+    :param msg: Message text
+    :type: str
+    :param window: Coalescing window in seconds
+    :type: float
+    :param windows: Coalescing windows of recipients
+    :type: dict
+    :param lease: Seconds while rows are hidden from worker
+    :type: float
+    :return: List of row ids
+    :rtype: list
+    """
+    recipients = parse_recipients(to)
+    if not recipients or any(name[0] not in ('@', '#') for name in recipients):
+        raise SystemExit('ERROR: Recipient name must stars with "@" or "#" symbol.')
+    trigger_id, event_id = parse_trigger_event(msg)
+    return [outbox.put(recipient, subj, msg,
+                       window=(windows or {}).get(recipient, window),
+                       trigger_id=trigger_id,
+                       event_id=event_id,
+                       lease=lease) for recipient in recipients]
+
+
+def send_batch(file, sender: MessageSender = None, outbox: 'zbxoutbox.Outbox' = None, concurrency: int = 16,
+               window: float = 0, windows: dict = None) -> dict:
+    """
+    Function reads alerts from JSON lines file and prints result of every line as JSON line.
+    Alerts are sent by sender concurrently, alerts of the same trigger/event keep order of lines.
+    If outbox is set, alerts are only queued, sender queues them too while Rocket.Chat is down.
+    Lines are read while previous ones are sent, so file may be a pipe fed by external queue.
+
+    :param file: File object with JSON lines
+    :param sender: MessageSender object
+    :type: MessageSender
+    :param outbox: Outbox object to queue alerts instead of sending
+    :type: Outbox
+    :param concurrency: Alerts sent at once
+    :type: int
+    :param window: Coalescing window of queued alerts in seconds
+    :type: float
+    :param windows: Coalescing windows of recipients
+    :type: dict
+    :return: Number of lines per status
+    :rtype: dict
+    """
+    import asyncio
+    from zbxtransport import DeliveryError
+    totals = {'ok': 0, 'queued': 0, 'failed': 0, 'error': 0}
+
+    def report(number: int, status: str, error: str = None):
+        totals[status] += 1
+        result = {'line': number, 'status': status}
+        if error:
+            result['error'] = error
+        print(json.dumps(result), flush=True)
+
+    def read_alerts():
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield number, parse_batch_line(line)
+            except ValueError as e:
+                report(number, 'error', str(e))
+
+    if outbox is not None:
+        for number, (to, subj, msg) in read_alerts():
+            try:
+                enqueue_message(outbox, to, subj, msg, window=window, windows=windows)
+            except SystemExit as e:
+                report(number, 'error', str(e))
+            else:
+                report(number, 'queued')
+        return totals
+
+    async def send(number: int, to: str, subj: str, msg: str, previous, semaphore):
+        if previous is not None:
+            # Alert of the same trigger/event from earlier line goes first
+            await asyncio.wait([previous])
+        async with semaphore:
+            try:
+                status = await sender.submit_async(to, subj, msg)
+            except DeliveryError as e:
+                report(number, 'error', str(e))
+            except Exception as e:
+                logging.exception("Cannot send alert of line {}".format(number))
+                report(number, 'error', 'ERROR: {!r}'.format(e))
+            else:
+                report(number, status)
+
+    async def send_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        alerts = read_alerts()
+        last, tasks = {}, []
+        while True:
+            # Next line is read in thread, pipe may block
+            alert = await sender.transport.call(next, alerts, None)
+            if alert is None:
+                break
+            number, (to, subj, msg) = alert
+            trigger_id, event_id = parse_trigger_event(msg)
+            key = (trigger_id, event_id) if trigger_id else number
+            task = asyncio.ensure_future(send(number, to, subj, msg, last.get(key), semaphore))
+            last[key] = task
+            tasks.append(task)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    sender.transport.run(send_all())
+    return totals
+
+
+def run_worker(sender: MessageSender, outbox_options: dict, batch_size: int, poll_interval: float, once: bool = False,
+               stop: threading.Event = None) -> None:
+    """
+    Function drains outbox table, digest groups of one batch are delivered concurrently.
+
+    :param sender: MessageSender object
+    :type: MessageSender
+    :param outbox_options: Outbox retry options
+    :type: dict
+    :param batch_size: Messages claimed at once
+    :type: int
+    :param poll_interval: Seconds between polls of empty queue
+    :type: float
+    :param once: Exit when nothing is due
+    :type: bool
+    :param stop: Event to stop worker
+    :type: threading.Event
     :return: None
     """
-    query = """SELECT * FROM msg"""
+    from zbxoutbox import Outbox, work
+    from zbxstore import connect
+    connection = connect(DB_FILE)
+    outbox = Outbox(connection, **outbox_options)
+
+    def deliver_many(groups: list) -> list:
+        if DEBUG:
+            for jobs in groups:
+                print("Delivering queued messages {} (attempt {})".format([job.id for job in jobs],
+                                                                          jobs[0].attempts + 1))
+        return sender.deliver_many(groups)
+
+    from zbxbreaker import ROCKETCHAT
+    # Rows wait without spending attempts while circuit is open
+    ready = partial(sender.breaker.allow, ROCKETCHAT) if sender.breaker is not None else None
     try:
-        connection = sqlite3.connect(DB_FILE)
-        connection.cursor().execute(query).fetchall()
+        work(outbox, sender.deliver, batch_size=batch_size, poll_interval=poll_interval, once=once, stop=stop,
+             deliver_many=deliver_many, ready=ready)
+    finally:
         connection.close()
-        return True
-    except:
-        if os.path.exists(DB_FILE):
-            os.remove(DB_FILE)
-        else:
-            # Create directory
-            if not os.path.exists(DB_DIR):
-                os.mkdir(DB_DIR, mode=0o655)
+
+
+async def sync_acks_async(transport: 'zbxtransport.Transport', url: str, uid: str, token: str,
+                          store: 'zbxacks.AckStore', api: 'zbxapi.ZabbixAPI', reactions: tuple,
+                          unacknowledge: bool = False, limiter: 'zbxratelimit.RateLimiter' = None) -> dict:
+    """
+    Coroutine reads messages updated since cursor of every room with one chat.syncMessages call per room,
+    rooms are polled concurrently. Reactions which differ from saved ones are sent to Zabbix as
+    event.acknowledge calls of one JSON-RPC batch. Cursors and reactions are saved only after Zabbix
+    has answered, so nothing is lost if it is unavailable.
+
+    :return: Dict with numbers of rooms, updated messages, reaction changes and acknowledge calls
+    :rtype: dict
+    """
+    import asyncio
+    from zbxacks import acknowledge_calls
+    from zbxapi import ZabbixAPIError
+    from zbxmetrics import METRICS
+    from zbxtransport import DeliveryError
+    requests = http_client()
+
+    headers = {'X-Auth-Token': token, 'X-User-Id': uid}
+    rooms = await transport.db(store.rooms)
+
+    async def sync_room(rid: str, last_update: str):
+        with METRICS.span('sync_room', rid=rid) as span:
             try:
-                os.chown(DB_DIR, 0, grp.getgrnam().gr_gid)
-            except KeyError:
-                print('WARNING: Cannot find group "{}" to set rights to "{}". Using "root".'.format(group, DB_DIR))
-                os.chown(DB_DIR, 0, 0)
-                return False
-        connection = sqlite3.connect(DB_FILE)
-        cursor = connection.cursor()
-        cursor.execute(BLANK_DB)
-        connection.commit()
+                resp = await transport.call(rc_request, transport.rocketchat, limiter, 'GET',
+                                            url + 'chat.syncMessages',
+                                            params={'roomId': rid, 'lastUpdate': last_update}, headers=headers,
+                                            timeout=(transport.rocketchat.timeout[0], 10))
+            except requests.exceptions.RequestException as e:
+                resp = None
+                logging.error("Cannot sync messages of room {}: {}".format(rid, e))
+            if not resp:
+                span['outcome'] = 'failed'
+                return rid, last_update, None
+            updated = resp.json()['result']['updated']
+            span['messages'] = len(updated)
+        return rid, max([message['_updatedAt'] for message in updated] + [last_update]), updated
+
+    cursors, messages = {}, []
+    for rid, last_update, updated in await asyncio.gather(*(sync_room(rid, last_update)
+                                                            for rid, last_update in rooms)):
+        if updated is not None:
+            cursors[rid] = last_update
+            messages += updated
+
+    changes = await transport.db(store.diff, messages)
+    events = await transport.db(store.events, list({change.msg_id for change in changes}))
+    calls = acknowledge_calls(changes, events, reactions, unacknowledge)
+    if calls:
+        with METRICS.span('acknowledge', calls=len(calls)):
+            try:
+                results = await transport.call(api.batch, calls)
+            except (requests.exceptions.RequestException, ValueError, ZabbixAPIError) as e:
+                raise DeliveryError('ERROR: Cannot acknowledge events in Zabbix: {}.'.format(e))
+        for (_, params), result in zip(calls, results):
+            if isinstance(result, ZabbixAPIError):
+                # Error of one call (e.g. no permissions) is not retried
+                logging.error("Cannot acknowledge events {}: {}".format(params['eventids'], result))
+            if DEBUG:
+                print("{}: {}".format(params['message'], result))
+    await transport.db(store.commit, cursors, changes)
+    return {'rooms': len(rooms), 'messages': len(messages), 'changes': len(changes), 'calls': len(calls)}
+
+
+def run_ack_sync(transport: 'zbxtransport.Transport', url: str, uid: str, token: str, api: 'zbxapi.ZabbixAPI',
+                 reactions: tuple, unacknowledge: bool = False, limiter: 'zbxratelimit.RateLimiter' = None,
+                 interval: float = 30, once: bool = False, stop: threading.Event = None) -> None:
+    """
+    Function syncs reactions to Zabbix every interval seconds until stop event is set.
+
+    :param transport: Event loop to run I/O in
+    :type: Transport
+    :param api: Zabbix API client
+    :type: ZabbixAPI
+    :param reactions: Reactions which acknowledge problem
+    :type: tuple
+    :param unacknowledge: Removed reaction unacknowledges problem
+    :type: bool
+    :param interval: Seconds between syncs
+    :type: float
+    :param once: Sync once and exit, error is raised as SystemExit
+    :type: bool
+    :return: None
+    """
+    from zbxacks import AckStore
+    from zbxstore import connect
+    connection = connect(DB_FILE, check_same_thread=False)
+    store = AckStore(connection)
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                stats = transport.run(sync_acks_async(transport, url, uid, token, store, api, reactions,
+                                                      unacknowledge=unacknowledge, limiter=limiter))
+                if DEBUG:
+                    print("Reactions sync: {}".format(stats))
+                log_connections(transport)
+            except SystemExit as e:
+                if once:
+                    raise
+                logging.error(str(e))
+            if once:
+                return
+            if stop is not None:
+                stop.wait(interval)
+            else:
+                time.sleep(interval)
+    finally:
         connection.close()
 
 
+def serve_alerts(socket_path: str, sender: MessageSender, outbox_options: dict = None, batch_size: int = 50,
+                 poll_interval: float = 1, accept_timeout: float = 9, socket_mode: int = 0o660,
+                 socket_group: str = None, accept_outbox: 'zbxoutbox.Outbox' = None) -> None:
+    """
+    Function runs resident daemon. Config, database connection, HTTP session and Zabbix cookie
+    stay warm between alerts, 'send' command hands its arguments over Unix socket.
+    If outbox_options are set, daemon also drains outbox table in background thread.
+    Delivery which isn't finished in accept_timeout seconds (rate limit wait, slow upload) goes on
+    in background. If accept_outbox is set, alert is saved to it first and client gets 'accepted':
+    the row is hidden from worker while daemon delivers it and is delivered by worker if daemon fails
+    or dies. Otherwise client gets error and Zabbix repeats the alert, it is not lost with the daemon.
+
+    :param socket_path: Path to Unix socket to listen
+    :type: str
+    :param sender: MessageSender object
+    :type: MessageSender
+    :param outbox_options: Outbox retry options or None to disable worker
+    :type: dict
+    :param accept_timeout: Seconds to wait for delivery before answering 'accepted'
+    :type: float
+    :param socket_mode: Permissions of Unix socket
+    :type: int
+    :param socket_group: Group owning Unix socket or None
+    :type: str
+    :param accept_outbox: Outbox on sender connection for alerts answered 'accepted' or None
+    :type: Outbox
+    :return: None
+    """
+    from concurrent.futures import TimeoutError
+    import zbxdaemon
+    from zbxtransport import DeliveryError
+    stop = threading.Event()
+    if outbox_options is not None:
+        worker = threading.Thread(target=run_worker, args=(sender, outbox_options, batch_size, poll_interval),
+                                  kwargs={'stop': stop}, daemon=True)
+        worker.start()
+
+    def finished(request: dict, job_ids: list, future) -> None:
+        # Result of delivery which client doesn't wait for anymore, runs in event loop thread
+        error = None
+        try:
+            status = future.result()
+        except (DeliveryError, SystemExit) as e:
+            error = str(e)
+        except Exception as e:
+            logging.exception("Cannot send alert to {}".format(request['to']))
+            error = repr(e)
+        else:
+            if status == 'failed':
+                error = 'Rocket.Chat refused message'
+        if job_ids and error is None:
+            for job_id in job_ids:
+                sender.transport.submit(sender.transport.db(accept_outbox.done, job_id))
+        elif job_ids:
+            logging.error("Alert to {} is left to outbox worker: {}".format(request['to'], error))
+            for job_id in job_ids:
+                sender.transport.submit(sender.transport.db(accept_outbox.release, job_id, error))
+        elif error is not None:
+            logging.error("Alert to {} finished after client got error: {}".format(request['to'], error))
+
+    def handler(request: dict) -> dict:
+        missing = [field for field in ('to', 'subject', 'message') if field not in request]
+        if missing:
+            return {'status': 'error', 'error': 'ERROR: Missing fields: {}.'.format(', '.join(missing))}
+        future = sender.transport.submit(sender.submit_async(request['to'], request['subject'], request['message']))
+        try:
+            status = future.result(accept_timeout)
+        except TimeoutError:
+            return accept(request, future)
+        except (DeliveryError, SystemExit) as e:
+            return {'status': 'error', 'error': str(e)}
+        except Exception as e:
+            # Client always gets answer, unexpected error doesn't leave it waiting
+            logging.exception("Cannot send alert to {}".format(request['to']))
+            return {'status': 'error', 'error': 'ERROR: {!r}'.format(e)}
+        return {'status': status}
+
+    def accept(request: dict, future) -> dict:
+        # Delivery goes on after answer, it must survive the daemon
+        job_ids = []
+        if accept_outbox is not None:
+            try:
+                job_ids = sender.transport.run(sender.transport.db(
+                    enqueue_message, accept_outbox, request['to'], request['subject'], request['message'],
+                    lease=DAEMON_ACCEPT_LEASE))
+            except (SystemExit, Exception) as e:
+                logging.exception("Cannot save alert to {} to outbox".format(request['to']))
+                job_ids, error = [], 'ERROR: Cannot save alert to outbox: {}.'.format(e)
+        else:
+            error = 'ERROR: Alert is not delivered in {} seconds, daemon goes on sending it.'.format(accept_timeout)
+        future.add_done_callback(lambda done: finished(request, job_ids, done))
+        return {'status': 'accepted'} if job_ids else {'status': 'error', 'error': error}
+
+    try:
+        zbxdaemon.serve(socket_path, handler, mode=socket_mode, group=socket_group)
+    finally:
+        stop.set()
+
+
+def make_zabbix(config: ConfigSnapshot, debug: bool = False,
+                breaker: 'zbxbreaker.CircuitBreaker' = None) -> 'zbxgraphget.ZabbixWeb':
+    """
+    Function creates Zabbix frontend client with session cache and graph cache from config.
+
+    :param config: Config snapshot
+    :type: ConfigSnapshot
+    :param debug: Print Zabbix requests
+    :type: bool
+    :param breaker: Circuit breaker skipping graphs while Zabbix is down
+    :type: CircuitBreaker
+    :return: ZabbixWeb object
+    :rtype: ZabbixWeb
+    """
+    from zbxgraphget import DEFAULT_PROFILE, GraphCache, ZabbixWeb, severity_key
+    zbx = ZabbixWeb(server=config.get("ZABBIX", "zbx_server"),
+                    username=config.get("ZABBIX", "zbx_api_user"),
+                    password=config.get("ZABBIX", "zbx_api_pass"))
+    zbx.debug = debug
+    zbx.session_file = config.get("ZABBIX", "zbx_session_file", fallback=DB_DIR + "zbx-session.json")
+    zbx.session_ttl = config.getfloat("ZABBIX", "zbx_session_ttl", fallback=1800)
+    zbx.max_series = config.getint("ZABBIX", "zbx_graph_max_series", fallback=0)
+    zbx.timeout = (3, config.getfloat("ZABBIX", "zbx_timeout", fallback=30))
+    zbx.breaker = breaker
+    zbx.profile = parse_graph_profile("{0}x{1}/{2}".format(
+        config.get("ZABBIX", "zbx_graph_width", fallback=DEFAULT_PROFILE.width),
+        config.get("ZABBIX", "zbx_graph_height", fallback=DEFAULT_PROFILE.height),
+        config.get("ZABBIX", "zbx_graph_period", fallback=DEFAULT_PROFILE.period)), DEFAULT_PROFILE)
+    zbx.severity_profiles = parse_graph_profiles(config.get("ZABBIX", "zbx_graph_severities", fallback=""),
+                                                 zbx.profile, key=severity_key)
+    zbx.recipient_profiles = parse_graph_profiles(config.get("ZABBIX", "zbx_graph_recipients", fallback=""),
+                                                  zbx.profile)
+    zbx.recompress = config.getboolean("ZABBIX", "zbx_graph_recompress", fallback=False)
+    if config.getboolean("ZABBIX", "zbx_enrich", fallback=False):
+        from zbxapi import ZabbixAPI
+        zbx.api = ZabbixAPI(zbx.server, zbx.username, zbx.password,
+                            verify=config.getboolean("ZABBIX", "zbx_api_verify", fallback=True),
+                            token=config.get("ZABBIX", "zbx_api_token", fallback=""))
+        zbx.item_cache_ttl = config.getfloat("ZABBIX", "zbx_item_cache_ttl", fallback=60)
+    graph_cache_ttl = config.getfloat("ZABBIX", "zbx_graph_cache_ttl", fallback=60)
+    if graph_cache_ttl > 0:
+        # Not in shared zbx_tmp_dir, other users could plant images there
+        zbx.graph_cache = GraphCache(config.get("ZABBIX", "zbx_graph_cache_dir", fallback=DB_DIR + "graph-cache"),
+                                     ttl=graph_cache_ttl,
+                                     max_bytes=config.getint("ZABBIX", "zbx_graph_cache_size",
+                                                             fallback=50 * 1024 * 1024))
+    return zbx
+
+
+def retention_options(config: ConfigSnapshot) -> dict:
+    """
+    Function returns message database retention options from config.
+
+    :return: Dict with older_than, max_rows and interval keys
+    :rtype: dict
+    """
+    from zbxstore import parse_age
+    return {'older_than': parse_age(config.get("DB", "retention", fallback="30d")),
+            'max_rows': config.getint("DB", "max_rows", fallback=0),
+            'interval': parse_age(config.get("DB", "prune_interval", fallback="1h"))}
+
+
+def check_db(group: str = "zabbix") -> bool:
+    """
+    Проверяет версию схемы базы. Если базы нет или схема старая, создает или обновляет ее под файловой блокировкой.
+    Пример пустой базы в виде SQL в zbxstore.BLANK_DB, обновления схемы в zbxstore.migrate()
+    :return: True if database was ready
+    """
+    from zbxstore import init_db
+    if not os.path.exists(DB_DIR):
+        # Create directory
+        try:
+            os.makedirs(DB_DIR, mode=0o775, exist_ok=True)
+        except PermissionError:
+            raise SystemExit('PERMISSION ERROR: You have no permissions to create "{}" directory.'.format(DB_DIR))
+        try:
+            os.chown(DB_DIR, 0, grp.getgrnam(group).gr_gid)
+        except KeyError:
+            print('WARNING: Cannot find group "{}" to set rights to "{}". Using "root".'.format(group, DB_DIR))
+            os.chown(DB_DIR, 0, 0)
+        except PermissionError:
+            print('WARNING: Cannot set group "{}" to "{}".'.format(group, DB_DIR))
+    return init_db(DB_FILE)
+
+
 if __name__ == '__main__':
     # Current program version
     VERSION = '0.2'
@@ -347,9 +1726,28 @@ if __name__ == '__main__':
     auth_parser.add_argument('--update', action='store_true', help='Update current config file')
     # Send message
     send_parser = subparsers.add_parser('send', help='Send message to Rocket.Chat')
-    send_parser.add_argument('to', type=str, help='Message recipient')
-    send_parser.add_argument('subject', type=str, help='Message subject')
-    send_parser.add_argument('message', type=str, help='Message body text')
+    send_parser.add_argument('to', type=str, nargs='?',
+                             help='Message recipient, several recipients are separated by comma')
+    send_parser.add_argument('subject', type=str, nargs='?', help='Message subject')
+    send_parser.add_argument('message', type=str, nargs='?', help='Message body text')
+    send_parser.add_argument('--batch', type=str, metavar='FILE|-',
+                             help='Send alerts from JSON lines file or stdin instead of arguments')
+    # Resident daemon
+    subparsers.add_parser('serve', help='Run resident daemon to deliver messages handed by "send"')
+    # Outbox worker
+    worker_parser = subparsers.add_parser('worker', help='Deliver messages queued in outbox')
+    worker_parser.add_argument('--once', action='store_true', help='Exit when queue has no due messages')
+    # Acknowledgement by reactions
+    acks_parser = subparsers.add_parser('sync-acks', help='Acknowledge problems in Zabbix by reactions to messages')
+    acks_parser.add_argument('--once', action='store_true', help='Sync once and exit')
+    # Outbox state
+    subparsers.add_parser('queue', help='Print outbox queue depth and age')
+    # Database retention
+    prune_parser = subparsers.add_parser('prune', help='Remove old messages from database')
+    prune_parser.add_argument('--older-than', type=str, help='Age of messages to remove, e.g. 30d, 12h')
+    prune_parser.add_argument('--max-rows', type=int, help='Number of the newest messages to keep')
+    # Rate limiter state
+    subparsers.add_parser('ratelimit', help='Print throttled and delayed Rocket.Chat requests per endpoint')
     # Install script
     install_parser = subparsers.add_parser('install', help='Prepare script to work')
     install_parser.add_argument('-c', '--conf-dir', type=str, default='zbx-rc', help='Directory for script config')
@@ -360,6 +1758,9 @@ if __name__ == '__main__':
     # Debug mode marker
     DEBUG = args.debug
 
+    if args.command == 'send' and not args.batch and args.message is None:
+        send_parser.error('to, subject and message are required without --batch')
+
     # Empty argumants
     if args.command is None:
         main_parser.print_help()
@@ -372,10 +1773,15 @@ if __name__ == '__main__':
         print('INFO: Script installed successfully. Please, correct {} file for your environment.'.format(c_file))
         SystemExit(0)
 
-    if args.command in ('auth', 'send'):
+    if args.command in ('auth', 'send', 'serve', 'worker', 'sync-acks', 'queue', 'ratelimit', 'prune'):
         # Reading config file
         config = read_config(args.config)
 
+        # Message database info
+        DB_FILE = config.get("DB", "file", fallback=DB_FILE)
+        DB_CACHE_SIZE = config.getint("DB", "cache_size", fallback=10000)
+        DB_DIR = os.path.dirname(DB_FILE) + "/"
+
         # Rocket.Chat API connection info
         RC_PROTO = config.get('RCHAT', 'protocol', fallback='http')
         RC_SERVER = config.get('RCHAT', 'server', fallback='localhost')
@@ -389,33 +1795,288 @@ if __name__ == '__main__':
         zbx_api_user = config.get("ZABBIX", "zbx_api_user")
         zbx_api_pass = config.get("ZABBIX", "zbx_api_pass")
         zbx_tmp_dir = config.get("ZABBIX", "zbx_tmp_dir")
+        zbx_graph_in_memory = config.getboolean("ZABBIX", "zbx_graph_in_memory", fallback=False)
 
-        API_URL = "{proto}://{server}:{port}/api/v1/".format(proto=RC_PROTO, server=RC_SERVER, port=RC_PORT)
+        # Resident daemon info
+        DAEMON_SOCKET = config.get("DAEMON", "socket", fallback=DB_DIR + "zbx-rc.sock")
+        DAEMON_TIMEOUT = config.getfloat("DAEMON", "timeout", fallback=10)
+        DAEMON_SOCKET_MODE = int(config.get("DAEMON", "socket_mode", fallback="660"), 8)
+        DAEMON_SOCKET_GROUP = config.get("DAEMON", "socket_group", fallback="") or None
+
+        # Durable outbox info
+        OUTBOX_ENABLED = config.getboolean("OUTBOX", "enabled", fallback=False)
+        OUTBOX_BATCH = config.getint("OUTBOX", "batch_size", fallback=50)
+        OUTBOX_POLL = config.getfloat("OUTBOX", "poll_interval", fallback=1)
+        OUTBOX_OPTIONS = {'max_attempts': config.getint("OUTBOX", "max_attempts", fallback=10),
+                          'backoff': config.getfloat("OUTBOX", "backoff", fallback=5),
+                          'max_backoff': config.getfloat("OUTBOX", "max_backoff", fallback=600)}
+
+        # Alert-storm coalescing info
+        COALESCE_WINDOW = config.getfloat("COALESCE", "window", fallback=0)
+        COALESCE_WINDOWS = parse_windows(config.get("COALESCE", "recipients", fallback=""))
 
-        # check DB
-        check_db()
+        # Problem/resolve lifecycle info
+        RESOLVED_POLICY = config.get("LIFECYCLE", "resolved", fallback="send")
+        if RESOLVED_POLICY not in ('send', 'suppress'):
+            raise SystemExit('ERROR: "resolved" option must be "send" or "suppress".')
+        RESOLVE_PATTERN = config.get("LIFECYCLE", "resolve_pattern", fallback=RESOLVE_PATTERN)
+
+        # Rocket.Chat rate limits info
+        RATELIMIT_ENABLED = config.getboolean("RATELIMIT", "enabled", fallback=True)
+        RATELIMIT_OPTIONS = {'max_wait': config.getfloat("RATELIMIT", "max_wait", fallback=60),
+                             'retries': config.getint("RATELIMIT", "retries", fallback=3)}
+
+        # Circuit breaker info
+        BREAKER_ENABLED = config.getboolean("BREAKER", "enabled", fallback=True)
+        BREAKER_OPTIONS = {'failures': config.getint("BREAKER", "failures", fallback=3),
+                           'cooldown': config.getfloat("BREAKER", "cooldown", fallback=30)}
+
+        # Concurrent I/O info of daemon and worker
+        TRANSPORT_OPTIONS = {'workers': config.getint("TRANSPORT", "workers", fallback=16),
+                             'pool_size': config.getint("TRANSPORT", "pool_size", fallback=16),
+                             'retries': config.getint("TRANSPORT", "retries", fallback=2),
+                             'timeout': (config.getfloat("TRANSPORT", "connect_timeout", fallback=1),
+                                         config.getfloat("TRANSPORT", "timeout", fallback=3))}
+
+        # Phase timing output, 'send' handed to daemon or outbox has no phases to time
+        METRICS_LOG = config.get("METRICS", "log", fallback="")
+        METRICS_TEXTFILE = config.get("METRICS", "textfile", fallback="")
+        if METRICS_LOG or METRICS_TEXTFILE:
+            from zbxmetrics import METRICS
+            METRICS.configure(log=METRICS_LOG, textfile=METRICS_TEXTFILE, db_file=DB_FILE,
+                              interval=config.getfloat("METRICS", "interval", fallback=10))
+
+        API_URL = "{proto}://{server}:{port}/api/v1/".format(proto=RC_PROTO, server=RC_SERVER, port=RC_PORT)
 
         if DEBUG:
             print("Config file:\n\tUID: {}\n\tToken: {}\n\tAPI URL: {}\n".format(RC_UID, RC_TOKEN, API_URL))
 
         # Auth
         if args.command == 'auth':
-            auth_data = get_auth(API_URL + 'login', args.username, args.password)
+            from zbxhttp import HTTPClient
+            from zbxratelimit import RateLimiter
+            check_db()
+            limiter = RateLimiter(DB_FILE, **RATELIMIT_OPTIONS) if RATELIMIT_ENABLED else None
+            http = HTTPClient('rocketchat', pool_size=1, retries=TRANSPORT_OPTIONS['retries'],
+                              timeout=TRANSPORT_OPTIONS['timeout'])
+            auth_data = get_auth(API_URL + 'login', args.username, args.password, limiter=limiter, http=http)
+            http.close()
             if args.update:
                 values_to_update = {'uid': auth_data[0], 'token': auth_data[1]}
                 update_config(args.config, 'RCHAT', values_to_update)
             else:
                 print("id:\t'{}'\ntoken:\t'{}'".format(auth_data[0], auth_data[1]))
 
+        # Alerts from JSON lines file
+        if args.command == 'send' and args.batch:
+            totals = None
+            try:
+                batch_file = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+            except OSError as e:
+                raise SystemExit('ERROR: Cannot read batch file "{}": {}.'.format(args.batch, e.strerror))
+
         # Send message to chat
-        if args.command == 'send':
-            send_message(url=API_URL,
-                         uid=RC_UID,
-                         token=RC_TOKEN,
-                         to=args.to,
-                         msg=args.message,
-                         subj=args.subject,
-                         zbx_server=zbx_server,
-                         zbx_api_user=zbx_api_user,
-                         zbx_api_pass=zbx_api_pass,
-                         zbx_tmp_dir=zbx_tmp_dir)
+        if args.command == 'send' and args.batch and OUTBOX_ENABLED:
+            # Only enqueue, worker delivers messages
+            from zbxoutbox import Outbox
+            from zbxstore import connect
+            check_db()
+            db = connect(DB_FILE)
+            try:
+                totals = send_batch(batch_file, outbox=Outbox(db, **OUTBOX_OPTIONS), window=COALESCE_WINDOW,
+                                    windows=COALESCE_WINDOWS)
+            finally:
+                db.close()
+        elif args.command == 'send' and OUTBOX_ENABLED:
+            # Only enqueue, worker delivers message, one row per recipient
+            from zbxoutbox import Outbox
+            from zbxstore import connect
+            check_db()
+            db = connect(DB_FILE)
+            job_ids = enqueue_message(Outbox(db, **OUTBOX_OPTIONS), args.to, args.subject, args.message,
+                                      window=COALESCE_WINDOW, windows=COALESCE_WINDOWS)
+            db.close()
+            if DEBUG:
+                print('Queued message ids: {}'.format(job_ids))
+        elif args.command == 'send' and not args.batch:
+            import zbxdaemon
+            result = zbxdaemon.submit(DAEMON_SOCKET,
+                                      {'to': args.to, 'subject': args.subject, 'message': args.message},
+                                      timeout=DAEMON_TIMEOUT)
+            if DEBUG:
+                print('Daemon result: {}'.format(result))
+            if result is not None:
+                if result['status'] == 'error':
+                    raise SystemExit(result['error'])
+            else:
+                # Daemon is not running or its backlog is full, send in-process
+                from zbxbreaker import ROCKETCHAT, CircuitBreaker
+                from zbxratelimit import RateLimiter
+                from zbxstore import connect, maybe_prune
+                check_db()
+                breaker = CircuitBreaker(DB_FILE, **BREAKER_OPTIONS) if BREAKER_ENABLED else None
+                if breaker is not None and not breaker.allow(ROCKETCHAT):
+                    # Outbox is disabled here and nothing would deliver queued message, Zabbix retries alert
+                    breaker.close()
+                    raise SystemExit('ERROR: Rocket.Chat is unavailable, circuit is open.')
+                from zbxtransport import Transport
+                limiter = RateLimiter(DB_FILE, **RATELIMIT_OPTIONS) if RATELIMIT_ENABLED else None
+                # One alert needs few threads and connections
+                transport = Transport(**dict(TRANSPORT_OPTIONS, workers=4, pool_size=4))
+                zbx = make_zabbix(config, DEBUG, breaker)
+                zbx.http = transport.zabbix
+                if zbx.api is not None:
+                    zbx.api.http = transport.zabbix
+                try:
+                    send_message(url=API_URL,
+                                 uid=RC_UID,
+                                 token=RC_TOKEN,
+                                 to=args.to,
+                                 msg=args.message,
+                                 subj=args.subject,
+                                 zbx_server=zbx_server,
+                                 zbx_api_user=zbx_api_user,
+                                 zbx_api_pass=zbx_api_pass,
+                                 zbx_tmp_dir=zbx_tmp_dir,
+                                 zbx=zbx,
+                                 limiter=limiter,
+                                 graph_in_memory=zbx_graph_in_memory,
+                                 transport=transport,
+                                 breaker=breaker)
+                finally:
+                    transport.close()
+                db = connect(DB_FILE)
+                maybe_prune(db, **retention_options(config))
+                db.close()
+
+        # Resident daemon, outbox worker and batch sending share warm sender
+        if args.command in ('serve', 'worker') or (args.command == 'send' and args.batch and not OUTBOX_ENABLED):
+            from zbxbreaker import CircuitBreaker
+            from zbxoutbox import Outbox
+            from zbxratelimit import RateLimiter
+            from zbxstore import MessageCache, connect
+            from zbxtransport import Transport
+            check_db()
+            db = connect(DB_FILE, check_same_thread=False)
+            limiter = RateLimiter(DB_FILE, **RATELIMIT_OPTIONS) if RATELIMIT_ENABLED else None
+            breaker = CircuitBreaker(DB_FILE, **BREAKER_OPTIONS) if BREAKER_ENABLED else None
+            transport = Transport(**TRANSPORT_OPTIONS)
+            sender = MessageSender(url=API_URL,
+                                   uid=RC_UID,
+                                   token=RC_TOKEN,
+                                   zbx_server=zbx_server,
+                                   zbx_api_user=zbx_api_user,
+                                   zbx_api_pass=zbx_api_pass,
+                                   zbx_tmp_dir=zbx_tmp_dir,
+                                   connection=db,
+                                   resolved_policy=RESOLVED_POLICY,
+                                   resolve_pattern=RESOLVE_PATTERN,
+                                   limiter=limiter,
+                                   zbx=make_zabbix(config, DEBUG, breaker),
+                                   graph_in_memory=zbx_graph_in_memory,
+                                   retention=retention_options(config),
+                                   transport=transport,
+                                   breaker=breaker,
+                                   # Alerts are queued while circuit is open only if something drains outbox
+                                   outbox=(Outbox(db, **OUTBOX_OPTIONS) if breaker is not None and
+                                           (OUTBOX_ENABLED or args.command == 'serve') else None),
+                                   cache=MessageCache(DB_CACHE_SIZE) if DB_CACHE_SIZE else None)
+            try:
+                if args.command == 'serve':
+                    # Alerts queued while Rocket.Chat was down are delivered even if outbox is disabled
+                    serve_alerts(socket_path=DAEMON_SOCKET,
+                                 sender=sender,
+                                 outbox_options=OUTBOX_OPTIONS if OUTBOX_ENABLED or breaker is not None else None,
+                                 batch_size=OUTBOX_BATCH,
+                                 poll_interval=OUTBOX_POLL,
+                                 accept_timeout=max(DAEMON_TIMEOUT - DAEMON_ACCEPT_MARGIN, DAEMON_TIMEOUT / 2),
+                                 socket_mode=DAEMON_SOCKET_MODE,
+                                 socket_group=DAEMON_SOCKET_GROUP,
+                                 # Daemon drains outbox, accepted alert is delivered by it after restart
+                                 accept_outbox=(Outbox(db, **OUTBOX_OPTIONS) if OUTBOX_ENABLED or breaker is not None
+                                                else None))
+                elif args.command == 'worker':
+                    run_worker(sender, OUTBOX_OPTIONS, OUTBOX_BATCH, OUTBOX_POLL, once=args.once)
+                else:
+                    totals = send_batch(batch_file, sender=sender, concurrency=TRANSPORT_OPTIONS['workers'])
+            except KeyboardInterrupt:
+                pass
+            finally:
+                sender.close()
+                transport.close()
+                db.close()
+                if limiter is not None:
+                    limiter.close()
+                if breaker is not None:
+                    breaker.close()
+
+        if args.command == 'send' and args.batch:
+            batch_file.close()
+            if DEBUG:
+                print('Batch results: {}'.format(totals))
+            if totals is None or totals['failed'] or totals['error']:
+                raise SystemExit(1)
+
+        # Acknowledgement by reactions
+        if args.command == 'sync-acks':
+            from zbxapi import ZabbixAPI
+            from zbxratelimit import RateLimiter
+            from zbxtransport import Transport
+            check_db()
+            limiter = RateLimiter(DB_FILE, **RATELIMIT_OPTIONS) if RATELIMIT_ENABLED else None
+            transport = Transport(**TRANSPORT_OPTIONS)
+            api = ZabbixAPI(zbx_server, zbx_api_user, zbx_api_pass, http=transport.zabbix,
+                            verify=config.getboolean("ZABBIX", "zbx_api_verify", fallback=True),
+                            token=config.get("ZABBIX", "zbx_api_token", fallback=""))
+            try:
+                run_ack_sync(transport, API_URL, RC_UID, RC_TOKEN, api,
+                             reactions=tuple(name.strip() for name in config.get("ACK", "reactions",
+                                                                                fallback=":white_check_mark:")
+                                             .split(',') if name.strip()),
+                             unacknowledge=config.getboolean("ACK", "unacknowledge", fallback=False),
+                             limiter=limiter,
+                             interval=config.getfloat("ACK", "interval", fallback=30),
+                             once=args.once)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                transport.close()
+                if limiter is not None:
+                    limiter.close()
+
+        # Outbox state
+        if args.command == 'queue':
+            from zbxoutbox import Outbox
+            from zbxstore import connect
+            check_db()
+            db = connect(DB_FILE)
+            stats = Outbox(db, **OUTBOX_OPTIONS).stats()
+            db.close()
+            print("pending:\t{pending}\ndue:\t\t{due}\ndead:\t\t{dead}\noldest age:\t{oldest_age}s".format(**stats))
+
+        # Database retention
+        if args.command == 'prune':
+            from zbxstore import connect, parse_age, prune
+            check_db()
+            db = connect(DB_FILE)
+            retention = retention_options(config)
+            older_than = parse_age(args.older_than) if args.older_than else retention['older_than']
+            max_rows = args.max_rows if args.max_rows is not None else retention['max_rows']
+            print('INFO: Removed {} messages.'.format(prune(db, older_than, max_rows)))
+            db.close()
+
+        # Rate limiter state
+        if args.command == 'ratelimit':
+            from zbxratelimit import RateLimiter
+            check_db()
+            limiter = RateLimiter(DB_FILE, **RATELIMIT_OPTIONS)
+            for row in limiter.stats():
+                print("{endpoint}:\tthrottled={throttled}\tdelayed={delayed}\tdelay_total={delay_total}s\t"
+                      "remaining={remaining}".format(**row))
+            limiter.close()
+            from zbxbreaker import CircuitBreaker
+            breaker = CircuitBreaker(DB_FILE, **BREAKER_OPTIONS)
+            for row in breaker.stats():
+                print("breaker {backend}:\tstate={state}\tfailures={failures}\tretry_in={retry_in}s\t"
+                      "opened={opened}".format(**row))
+            breaker.close()
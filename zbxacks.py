@@ -0,0 +1,161 @@
+import logging
+import sqlite3
+from collections import namedtuple
+
+logging.basicConfig(level=logging.ERROR)
+
+ACKS_DB = """CREATE TABLE IF NOT EXISTS ack_cursor (
+                    rid         VARCHAR  PRIMARY KEY,
+                    last_update VARCHAR
+                );
+                CREATE TABLE IF NOT EXISTS ack_reaction (
+                    id          VARCHAR,
+                    reaction    VARCHAR,
+                    username    VARCHAR,
+                    PRIMARY KEY (id, reaction, username)
+                );"""
+
+# added - True for new reaction, False for removed one
+Reaction = namedtuple('Reaction', 'msg_id reaction username added')
+
+
+def iso_time(timestamp: str) -> str:
+    """
+    Function converts SQLite CURRENT_TIMESTAMP value (UTC) to ISO time accepted by Rocket.Chat.
+    """
+    return timestamp.replace(' ', 'T') + '.000Z'
+
+
+def message_reactions(message: dict) -> set:
+    """
+    Function returns reactions of Rocket.Chat message as set of tuples (reaction, username).
+    """
+    return {(reaction, username)
+            for reaction, value in (message.get('reactions') or {}).items()
+            for username in value.get('usernames', [])}
+
+
+class AckStore:
+    """
+    State of reaction sync in SQLite database: cursor of the last seen update per room
+    and reactions already turned into acknowledgements per message. Tables are created by zbxstore.migrate().
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def rooms(self) -> list:
+        """
+        Function returns rooms with tracked messages and their cursors. Room without cursor starts
+        from its oldest tracked message, so reactions added before the first sync are not lost.
+
+        :return: List of tuples (rid, last_update)
+        :rtype: list
+        """
+        # Margin covers clock difference of this host and Rocket.Chat, rereading is harmless
+        rows = self.connection.execute("SELECT msg.rid, ack_cursor.last_update, "
+                                       "datetime(MIN(msg.timestamp), '-5 minutes') FROM msg "
+                                       "LEFT JOIN ack_cursor ON ack_cursor.rid = msg.rid "
+                                       "WHERE msg.rid IS NOT NULL GROUP BY msg.rid;").fetchall()
+        return [(rid, last_update or iso_time(oldest)) for rid, last_update, oldest in rows]
+
+    def events(self, msg_ids: list) -> dict:
+        """
+        Function returns event ids of tracked messages, digest message has several.
+
+        :return: Dict {msg_id: [event_id, ...]}
+        :rtype: dict
+        """
+        events = {}
+        for i in range(0, len(msg_ids), 500):
+            chunk = msg_ids[i:i + 500]
+            for msg_id, event_id in self.connection.execute(
+                    "SELECT id, event_id FROM msg WHERE id IN ({}) ORDER BY rowid;".format(",".join("?" * len(chunk))),
+                    chunk):
+                if event_id not in events.setdefault(msg_id, []):
+                    events[msg_id].append(event_id)
+        return events
+
+    def diff(self, messages: list) -> list:
+        """
+        Function compares reactions of updated messages with saved ones.
+
+        :param messages: Messages returned by chat.syncMessages, untracked ones are skipped
+        :type: list
+        :return: List of Reaction
+        :rtype: list
+        """
+        tracked = self.events([message['_id'] for message in messages])
+        changes = []
+        for message in messages:
+            if message['_id'] not in tracked:
+                continue
+            saved = set(self.connection.execute("SELECT reaction, username FROM ack_reaction WHERE id = ?;",
+                                                (message['_id'],)).fetchall())
+            current = message_reactions(message)
+            changes += [Reaction(message['_id'], reaction, username, True)
+                        for reaction, username in sorted(current - saved)]
+            changes += [Reaction(message['_id'], reaction, username, False)
+                        for reaction, username in sorted(saved - current)]
+        return changes
+
+    def commit(self, cursors: dict, changes: list) -> None:
+        """
+        Function saves handled reactions and moves cursors of rooms in one transaction.
+
+        :param cursors: Dict {rid: last_update}
+        :type: dict
+        :param changes: List of Reaction
+        :type: list
+        """
+        with self.connection:
+            for change in changes:
+                if change.added:
+                    self.connection.execute("INSERT OR IGNORE INTO ack_reaction (id, reaction, username) "
+                                            "VALUES (?, ?, ?);", change[:3])
+                else:
+                    self.connection.execute("DELETE FROM ack_reaction WHERE id = ? AND reaction = ? "
+                                            "AND username = ?;", change[:3])
+            for rid, last_update in cursors.items():
+                self.connection.execute("INSERT OR REPLACE INTO ack_cursor (rid, last_update) VALUES (?, ?);",
+                                        (rid, last_update))
+            # Forget state of pruned messages and rooms
+            self.connection.execute("DELETE FROM ack_reaction WHERE id NOT IN (SELECT id FROM msg);")
+            self.connection.execute("DELETE FROM ack_cursor WHERE rid NOT IN (SELECT rid FROM msg);")
+
+
+def acknowledge_calls(changes: list, events: dict, reactions: tuple, unacknowledge: bool = False) -> list:
+    """
+    Function groups reaction changes into event.acknowledge calls, one per user and action.
+
+    :param changes: List of Reaction
+    :type: list
+    :param events: Dict {msg_id: [event_id, ...]}
+    :type: dict
+    :param reactions: Reactions which acknowledge problem, e.g. (':white_check_mark:',)
+    :type: tuple
+    :param unacknowledge: Removed reaction unacknowledges problem (Zabbix 6.0+)
+    :type: bool
+    :return: List of tuples (method, params)
+    :rtype: list
+    """
+    groups = {}
+    for change in changes:
+        if change.reaction not in reactions or not (change.added or unacknowledge):
+            continue
+        key = (change.username, change.reaction, change.added)
+        eventids = groups.setdefault(key, [])
+        for event_id in events.get(change.msg_id, []):
+            if str(event_id) not in eventids:
+                eventids.append(str(event_id))
+    calls = []
+    for (username, reaction, added), eventids in groups.items():
+        if not eventids:
+            continue
+        # 2 - acknowledge, 4 - add message, 16 - unacknowledge
+        calls.append(('event.acknowledge', {
+            'eventids': eventids,
+            'action': (2 if added else 16) | 4,
+            'message': '{0} by @{1} in Rocket.Chat with {2}'.format(
+                'Acknowledged' if added else 'Unacknowledged', username, reaction)}))
+    return calls
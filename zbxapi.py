@@ -0,0 +1,126 @@
+import logging
+
+import requests
+
+logging.basicConfig(level=logging.ERROR)
+
+
+class ZabbixAPIError(Exception):
+    """
+    Error object of Zabbix JSON-RPC answer.
+    """
+
+    def __init__(self, code: int, message: str, data: str = ""):
+        super().__init__("{0} {1}".format(message, data).strip())
+        self.code = code
+        self.data = data or ""
+
+
+class ZabbixAPI:
+    """
+    Zabbix JSON-RPC client. Several calls go in one HTTP request as JSON-RPC batch.
+    With API token (Zabbix 5.4+) there is no login, otherwise session is opened by user.login
+    on first call and once again when it is terminated.
+    """
+
+    def __init__(self, server: str, username: str = "", password: str = "", http=None, verify: bool = True,
+                 timeout: tuple = (3, 10), token: str = None):
+        self.url = server.rstrip("/") + "/api_jsonrpc.php"
+        self.username = username
+        self.password = password
+        self.http = http or requests
+        self.verify = verify
+        self.timeout = timeout
+        self.token = token or None
+        # Zabbix 6.4+ takes token in Authorization header, older versions in auth field of request
+        self.token_header = True
+        self.auth = None
+        self.next_id = 0
+
+    def post(self, payload):
+        """
+        Function posts JSON-RPC request or batch, returns decoded answer.
+        """
+        headers = {"Content-Type": "application/json-rpc"}
+        if self.token is not None and self.token_header:
+            headers["Authorization"] = "Bearer " + self.token
+        answer = self.http.post(self.url, json=payload, headers=headers, verify=self.verify, timeout=self.timeout)
+        answer.raise_for_status()
+        return answer.json()
+
+    def request(self, method: str, params, auth: bool = True) -> dict:
+        self.next_id += 1
+        request = {"jsonrpc": "2.0", "method": method, "params": params, "id": self.next_id}
+        if auth and self.token is None:
+            request["auth"] = self.auth
+        elif auth and not self.token_header:
+            request["auth"] = self.token
+        return request
+
+    def login(self) -> None:
+        """
+        Function opens API session. Zabbix before 5.4 names login parameter 'user'.
+        """
+        for name in ("username", "user"):
+            answer = self.post(self.request("user.login", {name: self.username, "password": self.password},
+                                            auth=False))
+            if "result" in answer:
+                self.auth = answer["result"]
+                return
+            error = answer.get("error", {})
+            if 'unexpected parameter "{}"'.format(name) not in error.get("data", ""):
+                break
+        raise ZabbixAPIError(error.get("code", 0), error.get("message", "Login failed."), error.get("data", ""))
+
+    def call(self, method: str, params):
+        """
+        Function makes one call, returns its result or raises ZabbixAPIError.
+        """
+        result, = self.batch([(method, params)])
+        if isinstance(result, ZabbixAPIError):
+            raise result
+        return result
+
+    def batch(self, calls: list) -> list:
+        """
+        Function makes several calls in one HTTP request.
+
+        :param calls: List of tuples (method, params)
+        :type: list
+        :return: Result or ZabbixAPIError for every call, in order of calls
+        :rtype: list
+        """
+        if not calls:
+            return []
+        for attempt in range(2):
+            if self.auth is None and self.token is None:
+                self.login()
+            payload = [self.request(method, params) for method, params in calls]
+            answers = self.post(payload)
+            if isinstance(answers, dict):
+                # Whole batch is rejected, e.g. by old Zabbix without batch support
+                answers = [dict(answers, id=request["id"]) for request in payload]
+            by_id = {answer.get("id"): answer for answer in answers}
+            results = []
+            for request in payload:
+                answer = by_id.get(request["id"], {"error": {"code": 0, "message": "No answer."}})
+                if "error" in answer:
+                    error = answer["error"]
+                    results.append(ZabbixAPIError(error.get("code", 0), error.get("message", ""),
+                                                  error.get("data", "")))
+                else:
+                    results.append(answer.get("result"))
+            expired = any(isinstance(result, ZabbixAPIError) and ("re-login" in result.data or
+                                                                   "Not authorised" in result.data)
+                          for result in results)
+            if not expired or attempt:
+                return results
+            if self.token is None:
+                logging.info("Zabbix API session is terminated, logging in again")
+                self.auth = None
+            elif self.token_header:
+                logging.info("Zabbix API doesn't take token in header, sending it in request")
+                self.token_header = False
+            else:
+                return results
+        return results
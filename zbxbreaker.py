@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+
+from zbxstore import connect
+
+logging.basicConfig(level=logging.ERROR)
+
+BREAKER_DB = """CREATE TABLE IF NOT EXISTS breaker (
+                    backend     VARCHAR  PRIMARY KEY,
+                    state       VARCHAR  DEFAULT 'closed',
+                    failures    INT      DEFAULT 0,
+                    retry_at    REAL     DEFAULT 0,
+                    probe_until REAL     DEFAULT 0,
+                    opened      INT      DEFAULT 0
+                );"""
+
+# Backends guarded by breaker
+ROCKETCHAT = 'rocketchat'
+ZABBIX = 'zabbix'
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker per backend. After failures consecutive connection errors backend is open:
+    callers skip it for cooldown seconds instead of waiting for timeouts. Then one caller gets
+    the probe (half-open), its result closes breaker or opens it for the next cooldown. State is
+    kept in SQLite database, so concurrent invocations and daemon share it.
+    """
+
+    def __init__(self, db_file: str, failures: int = 3, cooldown: float = 30, probe_timeout: float = 30):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        self.connection = connect(db_file, check_same_thread=False)
+
+    def allow(self, backend: str) -> bool:
+        """
+        Function checks if backend may be called. When cooldown of open breaker is over,
+        only the first caller gets True, it is the probe.
+
+        :param backend: Backend name
+        :type: str
+        :return: True if backend may be called
+        :rtype: bool
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE;")
+            row = self.connection.execute("SELECT state, retry_at, probe_until FROM breaker WHERE backend = ?;",
+                                          (backend,)).fetchone()
+            if row is None or row[0] == 'closed':
+                return True
+            state, retry_at, probe_until = row
+            if (state == 'open' and now < retry_at) or (state == 'half-open' and now < probe_until):
+                return False
+            self.connection.execute("UPDATE breaker SET state = 'half-open', probe_until = ? WHERE backend = ?;",
+                                    (now + self.probe_timeout, backend))
+        logging.info("Probing {} after cooldown".format(backend))
+        return True
+
+    def success(self, backend: str) -> None:
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT state FROM breaker WHERE backend = ? AND "
+                                          "(state != 'closed' OR failures > 0);", (backend,)).fetchone()
+            if row is None:
+                return
+            self.connection.execute("UPDATE breaker SET state = 'closed', failures = 0 WHERE backend = ?;",
+                                    (backend,))
+        if row[0] != 'closed':
+            logging.warning("{} is available again, circuit is closed".format(backend))
+
+    def failure(self, backend: str) -> None:
+        """
+        Function counts connection error, opens breaker after failures errors in a row or failed probe.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE;")
+            self.connection.execute("INSERT OR IGNORE INTO breaker (backend) VALUES (?);", (backend,))
+            state, failures = self.connection.execute("SELECT state, failures FROM breaker WHERE backend = ?;",
+                                                      (backend,)).fetchone()
+            failures += 1
+            if state == 'open' or (state == 'closed' and failures < self.failures):
+                self.connection.execute("UPDATE breaker SET failures = ? WHERE backend = ?;", (failures, backend))
+                return
+            self.connection.execute("UPDATE breaker SET state = 'open', failures = ?, retry_at = ?, "
+                                    "opened = opened + 1 WHERE backend = ?;", (failures, now + self.cooldown, backend))
+        logging.error("{} is unavailable, circuit is open for {}s".format(backend, self.cooldown))
+
+    def stats(self) -> list:
+        """
+        Function returns state of every backend.
+
+        :return: List of dicts
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT backend, state, failures, retry_at, opened FROM breaker "
+                                           "ORDER BY backend;").fetchall()
+        now = time.time()
+        return [{'backend': row[0],
+                 'state': row[1],
+                 'failures': row[2],
+                 'retry_in': max(0, round(row[3] - now, 1)) if row[1] == 'open' else 0,
+                 'opened': row[4]} for row in rows]
+
+    def close(self):
+        self.connection.close()
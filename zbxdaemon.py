@@ -0,0 +1,131 @@
+import grp
+import json
+import logging
+import os
+import socket
+import socketserver
+
+logging.basicConfig(level=logging.ERROR)
+
+
+class AlertRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON line with alert fields from the client and writes back one JSON line with the result.
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.endswith(b'\n'):
+            # Client failed to send the whole line and delivers alert itself
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+        except ValueError:
+            result = {'status': 'error', 'error': 'Malformed request'}
+        else:
+            result = self.server.handler(request)
+        self.wfile.write(json.dumps(result).encode('utf-8') + b'\n')
+
+
+class AlertServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Zabbix starts many 'send' processes at once during alert storm, default backlog of 5 refuses them
+    request_queue_size = 128
+
+    def __init__(self, path, handler, mode=0o660, group=None):
+        self.handler = handler
+        remove_stale_socket(path)
+        super().__init__(path, AlertRequestHandler)
+        try:
+            if group:
+                os.chown(path, -1, grp.getgrnam(group).gr_gid)
+            os.chmod(path, mode)
+        except (KeyError, OSError) as e:
+            self.server_close()
+            os.remove(path)
+            raise SystemExit('ERROR: Cannot set group "{}" and mode {:o} of "{}": {}.'.format(group, mode, path, e))
+
+
+def remove_stale_socket(path: str) -> None:
+    """
+    Function removes socket file left by a daemon that is not running anymore.
+
+    :param path: Path to Unix socket
+    :type: str
+    :return: None
+    """
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+    else:
+        raise SystemExit('ERROR: Daemon is already listening on "{}".'.format(path))
+    finally:
+        sock.close()
+
+
+def serve(path: str, handler, mode: int = 0o660, group: str = None) -> None:
+    """
+    Function runs daemon loop and passes every received alert to handler.
+
+    :param path: Path to Unix socket
+    :type: str
+    :param handler: Callable which gets request dict and returns result dict
+    :type: callable
+    :param mode: Permissions of socket file
+    :type: int
+    :param group: Group owning socket file, e.g. group of Zabbix server user, None keeps group of daemon
+    :type: str
+    :return: None
+    """
+    server = AlertServer(path, handler, mode, group)
+    logging.info("Listening on {}".format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def submit(path: str, request: dict, timeout: float = 10) -> dict:
+    """
+    Function hands request to running daemon.
+
+    :param path: Path to Unix socket
+    :type: str
+    :param request: Alert fields
+    :type: dict
+    :param timeout: Seconds to wait for daemon answer
+    :type: float
+    :return: Daemon result or None if request didn't reach daemon (not running, backlog is full, no permission)
+    :rtype: dict
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+    except OSError as e:
+        # Request didn't reach daemon, caller sends it itself. Line cut by error has no newline,
+        # daemon doesn't handle it.
+        logging.info("Cannot hand alert to daemon on {}: {!r}".format(path, e))
+        sock.close()
+        return None
+    try:
+        with sock.makefile('rb') as answer:
+            line = answer.readline()
+    except socket.timeout:
+        raise SystemExit('ERROR: Daemon did not answer in {} seconds.'.format(timeout))
+    except OSError as e:
+        raise SystemExit('ERROR: Daemon connection failed: {}.'.format(e))
+    finally:
+        sock.close()
+    if not line:
+        raise SystemExit('ERROR: Daemon closed connection without answer.')
+    return json.loads(line.decode('utf-8'))
@@ -1,14 +1,264 @@
+import colorsys
+import fcntl
+import hashlib
 import logging
 import json
 import os
+import shutil
+import stat
 import string
+import tempfile
+import threading
+import time
+from collections import namedtuple
 from configparser import ConfigParser
 from random import choice
 
 import requests
 
+from zbxmetrics import METRICS
+
 logging.basicConfig(level=logging.ERROR)
 
+# Graph attached to alert
+IMAGE_PERIOD = "14400"
+IMAGE_WIDTH = "900"
+IMAGE_HEIGHT = "200"
+
+# Size and period in seconds of graphs, None profile disables graphs
+GraphProfile = namedtuple("GraphProfile", "width height period")
+DEFAULT_PROFILE = GraphProfile(IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_PERIOD)
+
+# Names of Zabbix severities, index is value of {EVENT.NSEVERITY}
+SEVERITIES = ("not classified", "information", "warning", "average", "high", "disaster")
+
+# Colors of the first series, the next ones are generated by graph_color()
+COLORS = ("00CC00", "CC0000", "0000CC", "CCCC00", "00CCCC", "CC00CC")
+
+
+def temp_name(tmp_dir):
+    return "{0}/{1}.png".format(tmp_dir, "".join(choice(string.ascii_letters) for _ in range(10)))
+
+
+def graph_color(index):
+    """
+    Returns color of series number index. Hues of generated colors are spread by golden ratio,
+    so neighbour series differ for any number of items.
+    """
+    if index < len(COLORS):
+        return COLORS[index]
+    hue = (index - len(COLORS)) * 0.618033988749895 % 1
+    value = 0.8 if (index - len(COLORS)) % 2 else 0.55
+    return "".join("{0:02X}".format(int(channel * 255)) for channel in colorsys.hsv_to_rgb(hue, 0.9, value))
+
+
+def severity_key(value):
+    """
+    Returns index of Zabbix severity name or number, unknown (custom) name is returned in lower case.
+    """
+    value = str(value).strip().lower().replace("_", " ")
+    if value.isdigit():
+        return int(value)
+    return SEVERITIES.index(value) if value in SEVERITIES else value
+
+
+def group_items(itemids, max_series=0):
+    """
+    Splits itemids into charts of at most max_series series, 0 means one chart with all items.
+    Items are spread evenly, e.g. 7 items with max_series=6 give charts of 4 and 3 series.
+    """
+    if not itemids:
+        return []
+    if max_series <= 0 or len(itemids) <= max_series:
+        return [list(itemids)]
+    charts = -(-len(itemids) // max_series)
+    size, extra = divmod(len(itemids), charts)
+    groups, start = [], 0
+    for i in range(charts):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(itemids[start:end]))
+        start = end
+    return groups
+
+
+class GraphCache:
+    """
+    Rendered graphs stored under directory by hash of chart parameters. Entry lives ttl seconds,
+    when cache grows over max_bytes least recently used entries are removed. Processes rendering
+    the same graph wait for each other, so graph is rendered only once. Images of the cache are posted
+    to chat, so directory is used only if it belongs to current user and others can't write to it.
+    """
+
+    def __init__(self, directory, ttl=60, max_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = {"hit": 0, "miss": 0}
+        self.safe = None
+
+    def ready(self):
+        """
+        Creates cache directory, returns False if it is a symlink, belongs to other user or is writable by others.
+        """
+        if self.safe is None:
+            try:
+                os.makedirs(self.directory, mode=0o700, exist_ok=True)
+                info = os.lstat(self.directory)
+            except OSError as e:
+                logging.error("Graph cache is disabled, cannot create {0}: {1}".format(self.directory, e))
+                self.safe = False
+                return self.safe
+            self.safe = (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and
+                         not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+            if not self.safe:
+                logging.error("Graph cache is disabled, {0} is not a directory of current user "
+                              "writable only by it".format(self.directory))
+        return self.safe
+
+    @staticmethod
+    def key(itemid, period, width, height, title):
+        params = json.dumps([list(itemid), str(period), str(width), str(height), title])
+        return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".png")
+
+    def get(self, key):
+        """
+        Returns path of cached image or None, access time of entry is updated for LRU.
+        """
+        path = self.path(key)
+        try:
+            created = os.stat(path).st_mtime
+            if created + self.ttl <= time.time():
+                return None
+            os.utime(path, (time.time(), created))
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, content):
+        path = self.path(key)
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp", prefix=key + ".", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(content)
+            os.replace(tmp_file, path)
+        except OSError:
+            os.remove(tmp_file)
+            raise
+        self.evict()
+        return path
+
+    def lock(self, path):
+        """
+        Returns descriptor of locked file. Eviction could remove the file while we were waiting,
+        then lock is taken again on the new file, so all processes lock the same one.
+        """
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def fetch(self, key, render):
+        """
+        Returns path of cached image, calls render() to get PNG bytes on miss.
+        """
+        if not self.ready():
+            return None
+        path = self.get(key)
+        if path:
+            self.stats["hit"] += 1
+            return path
+        lock = self.lock(self.path(key) + ".lock")
+        try:
+            # Other process could render it while we were waiting
+            path = self.get(key)
+            if path:
+                self.stats["hit"] += 1
+                return path
+            self.stats["miss"] += 1
+            content = render()
+            if not content:
+                return None
+            return self.put(key, content)
+        finally:
+            os.close(lock)
+
+    def get_file(self, key, render, tmp_dir):
+        """
+        Returns temporary file with image which can be removed after upload, it is a hard link to cache entry.
+        """
+        path = self.fetch(key, render)
+        logging.debug("graph cache stats: {0}".format(self.stats))
+        if not path:
+            return False
+        file_img = temp_name(tmp_dir)
+        try:
+            os.link(path, file_img)
+        except OSError:
+            shutil.copyfile(path, file_img)
+        return file_img
+
+    def evict(self):
+        """
+        Removes expired entries, then least recently used ones while cache is bigger than max_bytes.
+        """
+        lock = self.lock(os.path.join(self.directory, ".evict.lock"))
+        try:
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    info = os.lstat(path)
+                except OSError:
+                    continue
+                if name.endswith(".png") and info.st_mtime + self.ttl > now:
+                    entries.append((info.st_atime, info.st_size, path))
+                elif name.endswith(".lock") and not name.startswith(".") and info.st_mtime + self.ttl <= now:
+                    self.remove_lock(path)
+                elif not name.startswith(".") and info.st_mtime + self.ttl <= now:
+                    # Expired image or temporary file left by killed process
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        finally:
+            os.close(lock)
+
+    @staticmethod
+    def remove_lock(path):
+        """
+        Removes lock file which nobody holds. Process which opened it before removal notices it in lock().
+        """
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+        except OSError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(path)
+        except OSError:
+            # Graph is being rendered
+            pass
+        finally:
+            os.close(fd)
+
 
 class ZabbixWeb:
     def __init__(self, server, username, password):
@@ -22,14 +272,124 @@ class ZabbixWeb:
         self.basic_auth_user = None
         self.basic_auth_pass = None
         self.tmp_dir = None
+        self.session_file = None
+        self.session_ttl = 1800
+        self.session_stats = {"hit": 0, "miss": 0, "refresh": 0}
+        # Result of the last graph_png() call of current thread, charts are rendered concurrently
+        self.local = threading.local()
+        self.graph_cache = None
+        # Series of one chart, items over it are split to several charts, 0 - no limit
+        self.max_series = 0
+        # requests module or shared HTTPClient with keep-alive connections
+        self.http = requests
+        self.login_lock = threading.Lock()
+        # Seconds to connect and to read answer of login form and chart3.php
+        self.timeout = (3, 30)
+        # CircuitBreaker skipping graphs while Zabbix is down
+        self.breaker = None
+        # Default graph profile and ones of severities (by severity_key()) and recipients
+        self.profile = DEFAULT_PROFILE
+        self.severity_profiles = {}
+        self.recipient_profiles = {}
+        # Shrink PNG before caching and upload
+        self.recompress = False
+        # ZabbixAPI adding hosts, names and last values of items to alert text, None - disabled
+        self.api = None
+        self.item_cache_ttl = 60
+
+    @property
+    def auth_failed(self):
+        return getattr(self.local, "auth_failed", False)
+
+    @auth_failed.setter
+    def auth_failed(self, value):
+        self.local.auth_failed = value
+
+    def graph_profile(self, recipient=None, severity=None):
+        """
+        Returns GraphProfile of alert, profile of recipient wins over profile of severity.
+        None means that recipient doesn't get graphs.
+        """
+        if recipient in self.recipient_profiles:
+            return self.recipient_profiles[recipient]
+        if severity is not None and severity_key(severity) in self.severity_profiles:
+            return self.severity_profiles[severity_key(severity)]
+        return self.profile
+
+    def session_key(self):
+        return "{0}@{1}".format(self.username, self.server)
+
+    def load_session(self):
+        """
+        Reads cookie saved by previous invocation, returns False if there is no unexpired one.
+        """
+        if not self.session_file:
+            return False
+        try:
+            with open(self.session_file, "r") as fd:
+                entry = json.load(fd).get(self.session_key())
+        except (OSError, ValueError):
+            entry = None
+        if not entry or entry.get("expires", 0) <= time.time():
+            return False
+        self.cookie = requests.utils.cookiejar_from_dict(entry["cookies"])
+        return True
+
+    def save_session(self):
+        """
+        Writes cookie to session file readable only by owner, file is replaced atomically.
+        """
+        if not self.session_file:
+            return
+        try:
+            with open(self.session_file, "r") as fd:
+                sessions = json.load(fd)
+        except (OSError, ValueError):
+            sessions = {}
+        now = time.time()
+        sessions = {key: entry for key, entry in sessions.items() if entry.get("expires", 0) > now}
+        if self.cookie:
+            sessions[self.session_key()] = {"cookies": requests.utils.dict_from_cookiejar(self.cookie),
+                                            "expires": now + self.session_ttl}
+        else:
+            sessions.pop(self.session_key(), None)
+        tmp_file = "{0}.{1}".format(self.session_file, os.getpid())
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as file:
+                json.dump(sessions, file)
+            os.replace(tmp_file, self.session_file)
+        except OSError as e:
+            logging.warning("can't save zabbix session to '{0}': {1}".format(self.session_file, e))
+
+    def log_session(self, event):
+        self.session_stats[event] += 1
+        message = "zabbix session {0}, stats: {1}".format(event, self.session_stats)
+        logging.debug(message)
+        if self.debug:
+            print(message)
+
+    def login(self, force=False):
+        """
+        Reuses cookie from session file when possible, otherwise posts login form.
+        force=True skips session file, it is used when saved cookie is rejected.
+        Returns True if cookie is taken from session file.
+        """
+        if not force and self.load_session():
+            self.log_session("hit")
+            return True
+        self.log_session("refresh" if force else "miss")
 
-    def login(self):
         if not self.verify:
             requests.packages.urllib3.disable_warnings()
 
         data_api = {"name": self.username, "password": self.password, "enter": "Sign in"}
-        answer = requests.post(self.server + "/", data=data_api, proxies=self.proxies, verify=self.verify,
-                               auth=requests.auth.HTTPBasicAuth(self.basic_auth_user, self.basic_auth_pass))
+        with METRICS.span("zabbix_login", server=self.server) as span:
+            answer = self.http.post(self.server + "/", data=data_api, proxies=self.proxies, verify=self.verify,
+                                    auth=requests.auth.HTTPBasicAuth(self.basic_auth_user, self.basic_auth_pass),
+                                    timeout=self.timeout)
+            if not answer.cookies:
+                span["outcome"] = "failed"
         cookie = answer.cookies
         if len(answer.history) > 1 and answer.history[0].status_code == 302:
             logging.warning("probably the server in your config file has not full URL (for example "
@@ -39,21 +399,68 @@ class ZabbixWeb:
             cookie = None
 
         self.cookie = cookie
+        self.save_session()
+        return False
 
     def graph_get(self, itemid, period, title, width, height, version=3):
-        file_img = "{0}/{1}.png".format(self.tmp_dir, "".join(choice(string.ascii_letters) for _ in range(10)))
+        res_img = self.graph_png(itemid, period, title, width, height, version)
+        if not res_img:
+            return False
+        file_img = temp_name(self.tmp_dir)
+        with open(file_img, "wb") as fd:
+            fd.write(res_img)
+        return file_img
 
+    def render(self, itemid, period, title, width, height, version=3):
+        """
+        Returns PNG bytes, logs in if there is no cookie yet and once again if reused cookie is expired.
+        Concurrent calls log in once. Returns False without request while breaker of Zabbix is open.
+        With recompress set PNG is shrunk losslessly.
+        """
+        if self.breaker is None:
+            res_img = self.render_graph(itemid, period, title, width, height, version)
+        else:
+            from zbxbreaker import ZABBIX
+            if not self.breaker.allow(ZABBIX):
+                logging.warning("Zabbix is unavailable, graph is skipped")
+                return False
+            try:
+                res_img = self.render_graph(itemid, period, title, width, height, version)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.breaker.failure(ZABBIX)
+                raise
+            self.breaker.success(ZABBIX)
+        if res_img and self.recompress:
+            from zbxpng import recompress_png
+            with METRICS.span("recompress", bytes=len(res_img)) as span:
+                smaller = recompress_png(res_img)
+                span["saved"] = len(res_img) - len(smaller)
+            METRICS.count("recompress_saved_bytes", span["saved"])
+            if self.debug:
+                print("graph recompressed: {0} -> {1} bytes".format(len(res_img), len(smaller)))
+            res_img = smaller
+        return res_img
+
+    def render_graph(self, itemid, period, title, width, height, version=3):
+        with self.login_lock:
+            reused = self.cookie is not None
+            if not reused:
+                reused = self.login()
+                if not self.cookie:
+                    logging.error("Login to Zabbix web UI has failed (web url, user or password are incorrect) unable to send graphs check manually")
+            cookie = self.cookie
+        res_img = self.graph_png(itemid, period, title, width, height, version)
+        if not res_img and self.auth_failed and reused:
+            # Reused cookie is expired, login once again unless other call has done it
+            with self.login_lock:
+                if self.cookie is cookie:
+                    self.login(force=True)
+            res_img = self.graph_png(itemid, period, title, width, height, version)
+        return res_img
+
+    def graph_png(self, itemid, period, title, width, height, version=3):
         title = requests.utils.quote(title)
 
-        colors = {
-            0: "00CC00",
-            1: "CC0000",
-            2: "0000CC",
-            3: "CCCC00",
-            4: "00CCCC",
-            5: "CC00CC",
-        }
-
         drawtype = 5
         if len(itemid) > 1:
             drawtype = 2
@@ -61,7 +468,7 @@ class ZabbixWeb:
         zbx_img_url_itemids = []
         for i in range(0, len(itemid)):
             itemid_url = "&items[{0}][itemid]={1}&items[{0}][sortorder]={0}&" \
-                         "items[{0}][drawtype]={3}&items[{0}][color]={2}".format(i, itemid[i], colors[i], drawtype)
+                         "items[{0}][drawtype]={3}&items[{0}][color]={2}".format(i, itemid[i], graph_color(i), drawtype)
             zbx_img_url_itemids.append(itemid_url)
 
         zbx_img_url = self.server + "/chart3.php?"
@@ -74,24 +481,34 @@ class ZabbixWeb:
 
         logging.info(zbx_img_url)
 
-        answer = requests.get(zbx_img_url, cookies=self.cookie, proxies=self.proxies, verify=self.verify,
-                              auth=requests.auth.HTTPBasicAuth(self.basic_auth_user, self.basic_auth_pass))
-        status_code = answer.status_code
-        if status_code == 404:
-            logging.error("can't get image from '{0}'".format(zbx_img_url))
-            return False
-        res_img = answer.content
-
-        with open(file_img, "wb") as fd:
-            fd.write(res_img)
-        return file_img
+        with METRICS.span("chart", items=len(itemid)) as span:
+            answer = self.http.get(zbx_img_url, cookies=self.cookie, proxies=self.proxies, verify=self.verify,
+                                   auth=requests.auth.HTTPBasicAuth(self.basic_auth_user, self.basic_auth_pass),
+                                   timeout=self.timeout)
+            span["bytes"] = len(answer.content)
+            METRICS.count("chart_bytes", len(answer.content))
+            status_code = answer.status_code
+            self.auth_failed = False
+            if status_code == 404:
+                logging.error("can't get image from '{0}'".format(zbx_img_url))
+                span["outcome"] = "failed"
+                return False
+            if status_code in (401, 403) or answer.history or \
+                    not answer.headers.get("Content-Type", "").startswith("image/"):
+                # Expired session is redirected to login page
+                logging.warning("'{0}' returned no image, probably session has expired".format(zbx_img_url))
+                self.auth_failed = True
+                span["outcome"] = "expired"
+                return False
+            return answer.content
 
     def api_test(self):
         headers = {'Content-type': 'application/json'}
         api_data = json.dumps({"jsonrpc": "2.0", "method": "user.login", "params":
                               {"user": self.username, "password": self.password}, "id": 1})
         api_url = self.server + "/api_jsonrpc.php"
-        api = requests.post(api_url, data=api_data, proxies=self.proxies, headers=headers)
+        api = self.http.post(api_url, data=api_data, proxies=self.proxies, headers=headers, verify=self.verify,
+                             timeout=self.timeout)
         return api.text
 
 
@@ -100,20 +517,67 @@ def graph_get(itemid: list,
               zbx_server: str,
               zbx_api_user: str,
               zbx_api_pass: str,
-              zbx_tmp_dir: str) -> str:
+              zbx_tmp_dir: str,
+              zbx: ZabbixWeb = None,
+              profile: GraphProfile = DEFAULT_PROFILE) -> str:
+    """
+    Function renders graph for itemids and saves it to zbx_tmp_dir.
+    Pass logged in ZabbixWeb object as zbx to reuse its cookie between calls,
+    set its session_file to reuse cookie between invocations and graph_cache
+    to reuse rendered images. Size and period of graph are taken from profile.
+    """
 
-    image_period = "14400"
-    image_width = "900"
-    image_height = "200"
-    zbx = ZabbixWeb(server=zbx_server, username=zbx_api_user, password=zbx_api_pass)
-    zbx.login()
-    if not zbx.cookie:
-        logging.error("Login to Zabbix web UI has failed (web url, user or password are incorrect) unable to send graphs check manually")
+    if zbx is None:
+        zbx = ZabbixWeb(server=zbx_server, username=zbx_api_user, password=zbx_api_pass)
     zbx.tmp_dir = zbx_tmp_dir
-    file_img = zbx.graph_get(itemid, image_period, title, image_width, image_height)
+
+    def render():
+        return zbx.render(itemid, profile.period, title, profile.width, profile.height)
+
+    if zbx.graph_cache is not None and zbx.graph_cache.ready():
+        key = zbx.graph_cache.key(itemid, profile.period, profile.width, profile.height, title)
+        file_img = zbx.graph_cache.get_file(key, render, zbx_tmp_dir)
+        if zbx.debug:
+            print("graph cache stats: {0}".format(zbx.graph_cache.stats))
+        return file_img
+    res_img = render()
+    if not res_img:
+        return False
+    file_img = temp_name(zbx_tmp_dir)
+    with open(file_img, "wb") as fd:
+        fd.write(res_img)
     return file_img
 
 
+def graph_bytes(itemid: list,
+                title: str,
+                zbx_server: str,
+                zbx_api_user: str,
+                zbx_api_pass: str,
+                zbx: ZabbixWeb = None,
+                profile: GraphProfile = DEFAULT_PROFILE) -> bytes:
+    """
+    Function renders graph for itemids and returns PNG bytes without writing temporary file.
+    """
+
+    if zbx is None:
+        zbx = ZabbixWeb(server=zbx_server, username=zbx_api_user, password=zbx_api_pass)
+
+    def render():
+        return zbx.render(itemid, profile.period, title, profile.width, profile.height)
+
+    if zbx.graph_cache is None or not zbx.graph_cache.ready():
+        return render()
+    key = zbx.graph_cache.key(itemid, profile.period, profile.width, profile.height, title)
+    path = zbx.graph_cache.fetch(key, render)
+    if zbx.debug:
+        print("graph cache stats: {0}".format(zbx.graph_cache.stats))
+    if not path:
+        return False
+    with open(path, "rb") as fd:
+        return fd.read()
+
+
 def main():
     """
     для теста
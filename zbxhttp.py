@@ -0,0 +1,67 @@
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logging.basicConfig(level=logging.ERROR)
+
+
+class HTTPClient:
+    """
+    Keep-alive HTTP client of one backend (Rocket.Chat or Zabbix frontend). Connections of its pool
+    are reused by all calls of the process, so TCP and TLS handshakes are paid once per connection,
+    not per request. Connection errors are retried, read errors are not: POST may have been handled.
+    Has request(), get() and post() of requests.Session, so it is passed wherever session is expected.
+    """
+
+    def __init__(self, name: str, pool_size: int = 16, retries: int = 2, timeout: tuple = None):
+        """
+        :param name: Backend name shown in stats
+        :type: str
+        :param pool_size: Keep-alive connections kept per host
+        :type: int
+        :param retries: Attempts to connect again after connection error
+        :type: int
+        :param timeout: Default (connect, read) timeout of requests without their own one
+        :type: tuple
+        """
+        self.name = name
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=0, status=0, other=0, redirect=False,
+                      backoff_factor=0.1, raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Function counts requests and connections opened for them by pools of the client.
+
+        :return: Dict with requests, connections and reused (requests sent over already open connection)
+        :rtype: dict
+        """
+        pools = self.adapter.poolmanager.pools
+        requests_count = connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                connections += pool.num_connections
+        return {'requests': requests_count, 'connections': connections,
+                'reused': max(0, requests_count - connections)}
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,92 @@
+import json
+import sqlite3
+import time
+
+# Value types which chart3.php can draw: numeric float and numeric unsigned
+NUMERIC_TYPES = ("0", "3")
+
+# Line added to alert text for every item
+ITEM_LINE = "{host}: {name}: {value}"
+
+ITEMS_DB = """CREATE TABLE IF NOT EXISTS item_cache (
+                    itemid     INT      PRIMARY KEY,
+                    item       VARCHAR,
+                    expires    REAL
+             );"""
+
+
+def item_calls(itemids: list) -> list:
+    """
+    Function returns JSON-RPC calls reading hosts, names, last values and value types of items.
+
+    :param itemids: Item ids
+    :type: list
+    :return: List of tuples (method, params) for ZabbixAPI.batch()
+    :rtype: list
+    """
+    return [("item.get", {"itemids": list(itemids),
+                          "output": ["itemid", "name", "key_", "lastvalue", "units", "value_type"],
+                          "selectHosts": ["host", "name"],
+                          "webitems": True})]
+
+
+def parse_items(result: list) -> dict:
+    """
+    Function converts item.get result to dict {itemid: item}, item is dict with host, name,
+    key, lastvalue, units and value_type keys.
+    """
+    items = {}
+    for item in result or []:
+        hosts = item.get("hosts") or [{}]
+        items[str(item["itemid"])] = {"host": hosts[0].get("name") or hosts[0].get("host", ""),
+                                      "name": item.get("name", ""),
+                                      "key": item.get("key_", ""),
+                                      "lastvalue": item.get("lastvalue", ""),
+                                      "units": item.get("units", ""),
+                                      "value_type": str(item.get("value_type", ""))}
+    return items
+
+
+def cached_items(connection: sqlite3.Connection, itemids: list) -> dict:
+    """
+    Function returns unexpired items of item_cache table.
+
+    :return: Dict {itemid: item}
+    :rtype: dict
+    """
+    rows = connection.execute("SELECT itemid, item FROM item_cache WHERE itemid IN ({}) AND expires > ?;".format(
+        ",".join("?" * len(itemids))), [int(itemid) for itemid in itemids] + [time.time()]).fetchall()
+    return {str(itemid): json.loads(item) for itemid, item in rows}
+
+
+def cache_items(connection: sqlite3.Connection, items: dict, ttl: float = 60) -> None:
+    """
+    Function saves items for ttl seconds and removes expired ones.
+    """
+    now = time.time()
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO item_cache (itemid, item, expires) VALUES (?, ?, ?);",
+                               [(int(itemid), json.dumps(item), now + ttl) for itemid, item in items.items()])
+        connection.execute("DELETE FROM item_cache WHERE expires <= ?;", (now,))
+
+
+def describe_items(items: dict, itemids: list) -> str:
+    """
+    Function returns lines of alert text with host, name and last value of every known item.
+    """
+    lines = []
+    for itemid in dict.fromkeys(itemids):
+        item = items.get(str(itemid))
+        if item is None:
+            continue
+        value = "{0} {1}".format(item["lastvalue"], item["units"]).strip() if item["lastvalue"] != "" else "-"
+        lines.append(ITEM_LINE.format(host=item["host"], name=item["name"], value=value))
+    return "\n".join(lines)
+
+
+def chart_items(items: dict, itemids: list) -> list:
+    """
+    Function drops items which chart3.php can't draw (text, log, character), unknown items are kept.
+    """
+    return [itemid for itemid in itemids
+            if str(itemid) not in items or items[str(itemid)]["value_type"] in NUMERIC_TYPES]
@@ -0,0 +1,241 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from zbxstore import connect
+
+logging.basicConfig(level=logging.ERROR)
+
+METRICS_DB = """CREATE TABLE IF NOT EXISTS metrics (
+                    phase   VARCHAR,
+                    outcome VARCHAR,
+                    buckets VARCHAR,
+                    sum     REAL     DEFAULT 0,
+                    count   INT      DEFAULT 0,
+                    PRIMARY KEY (phase, outcome)
+                );"""
+
+COUNTERS_DB = """CREATE TABLE IF NOT EXISTS counters (
+                    name    VARCHAR  PRIMARY KEY,
+                    value   REAL     DEFAULT 0
+                );"""
+
+# Help text of counters added by Metrics.count(), exported as zbx_rc_<name>_total
+COUNTERS = {"chart_bytes": "Bytes of charts received from Zabbix.",
+            "recompress_saved_bytes": "Bytes of charts saved by PNG recompression."}
+
+# Upper bounds of histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def bucket_index(seconds: float) -> int:
+    """
+    Function returns index of histogram bucket for duration, len(BUCKETS) for +Inf bucket.
+    """
+    for index, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return index
+    return len(BUCKETS)
+
+
+def render_textfile(rows: list, counters: list = ()) -> str:
+    """
+    Function renders Prometheus text format of aggregated phases: duration histogram per phase
+    and counter of finished phases per phase and outcome, then other counters.
+
+    :param rows: List of tuples (phase, outcome, buckets, sum, count)
+    :type: list
+    :param counters: List of tuples (name, value)
+    :type: list
+    :return: Text for textfile collector
+    :rtype: str
+    """
+    counts, totals, outcomes = {}, {}, []
+    for phase, outcome, buckets, total, count in sorted(rows):
+        phase_counts = counts.setdefault(phase, [0] * (len(BUCKETS) + 1))
+        for index, value in enumerate(buckets.split(',')):
+            phase_counts[index] += int(value)
+        totals[phase] = totals.get(phase, 0) + total
+        outcomes.append((phase, outcome, count))
+
+    lines = ["# HELP zbx_rc_phase_seconds Duration of zbx-rc alert delivery phases.",
+             "# TYPE zbx_rc_phase_seconds histogram"]
+    for phase, phase_counts in counts.items():
+        cumulative = 0
+        for bound, value in zip(BUCKETS + ('+Inf',), phase_counts):
+            cumulative += value
+            lines.append('zbx_rc_phase_seconds_bucket{{phase="{0}",le="{1}"}} {2}'.format(phase, bound, cumulative))
+        lines.append('zbx_rc_phase_seconds_sum{{phase="{0}"}} {1:.6f}'.format(phase, totals[phase]))
+        lines.append('zbx_rc_phase_seconds_count{{phase="{0}"}} {1}'.format(phase, cumulative))
+    lines += ["# HELP zbx_rc_phase_total Finished zbx-rc alert delivery phases by outcome.",
+              "# TYPE zbx_rc_phase_total counter"]
+    for phase, outcome, count in outcomes:
+        lines.append('zbx_rc_phase_total{{phase="{0}",outcome="{1}"}} {2}'.format(phase, outcome, count))
+    for name, value in sorted(counters):
+        lines += ["# HELP zbx_rc_{0}_total {1}".format(name, COUNTERS.get(name, "zbx-rc counter.")),
+                  "# TYPE zbx_rc_{0}_total counter".format(name),
+                  "zbx_rc_{0}_total {1:g}".format(name, value)]
+    return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """
+    Timer of alert delivery phases. Every finished span is written as JSON line to log and
+    aggregated into histogram kept in SQLite database, so all invocations add to the same
+    Prometheus textfile with counters of count(). Disabled until configure() is called, span() costs
+    a clock read then.
+    """
+
+    def __init__(self):
+        self.log = None
+        self.textfile = None
+        self.db_file = None
+        self.interval = 10
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.counters = {}
+        self.next_flush = 0
+        self.timer = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.log is not None or self.textfile is not None
+
+    def configure(self, log: str = "", textfile: str = "", db_file: str = None, interval: float = 10) -> None:
+        """
+        Function enables metrics output.
+
+        :param log: File to append JSON lines to, "-" for stderr, empty to disable
+        :type: str
+        :param textfile: Prometheus textfile collector file, empty to disable
+        :type: str
+        :param db_file: Database keeping aggregated histograms
+        :type: str
+        :param interval: Seconds between textfile updates
+        :type: float
+        :return: None
+        """
+        if log == "-":
+            self.log = sys.stderr
+        elif log:
+            try:
+                self.log = open(log, "a", buffering=1)
+            except OSError as e:
+                raise SystemExit('ERROR: Cannot open metrics log "{}": {}.'.format(log, e.strerror))
+        self.textfile = textfile or None
+        self.db_file = db_file
+        self.interval = interval
+        if self.enabled:
+            atexit.register(self.flush, True)
+
+    @contextmanager
+    def span(self, phase: str, **fields):
+        """
+        Context manager timing phase. Yields dict of fields written to log, its "outcome"
+        ("ok" by default, "error" if exception is raised) labels the counter.
+        """
+        span = {"outcome": "ok"}
+        span.update(fields)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span["outcome"] = "error"
+            raise
+        finally:
+            if self.enabled:
+                self.record(phase, time.perf_counter() - started, span)
+
+    def record(self, phase: str, seconds: float, fields: dict) -> None:
+        """
+        Function writes finished span to log and adds it to pending aggregates.
+        """
+        if self.log is not None:
+            line = {"ts": round(time.time(), 3), "pid": os.getpid(), "phase": phase, "ms": round(seconds * 1000, 2)}
+            line.update(fields)
+            try:
+                with self.lock:
+                    self.log.write(json.dumps(line, default=str) + "\n")
+            except (OSError, ValueError) as e:
+                logging.error("Cannot write metrics log: {}".format(e))
+        if self.textfile is None:
+            return
+        with self.lock:
+            entry = self.pending.setdefault((phase, fields["outcome"]), [[0] * (len(BUCKETS) + 1), 0, 0])
+            entry[0][bucket_index(seconds)] += 1
+            entry[1] += seconds
+            entry[2] += 1
+        self.flush()
+
+    def count(self, name: str, value: float) -> None:
+        """
+        Function adds value to counter exported to textfile, e.g. bytes of rendered charts.
+        """
+        if self.textfile is None:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.flush()
+
+    def flush(self, force: bool = False) -> None:
+        """
+        Function adds pending aggregates to database and rewrites textfile, not more often
+        than once per interval unless force is set. Skipped flush is scheduled for later.
+        """
+        with self.lock:
+            if not self.pending and not self.counters:
+                return
+            now = time.time()
+            if not force and now < self.next_flush:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.next_flush - now, self.flush, (True,))
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+            pending, self.pending = self.pending, {}
+            counters, self.counters = self.counters, {}
+            self.next_flush = now + self.interval
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        try:
+            # Tables are created by zbxstore.migrate()
+            connection = connect(self.db_file)
+            try:
+                with connection:
+                    connection.execute("BEGIN IMMEDIATE;")
+                    for (phase, outcome), (counts, total, count) in pending.items():
+                        row = connection.execute("SELECT buckets FROM metrics WHERE phase = ? AND outcome = ?;",
+                                                 (phase, outcome)).fetchone()
+                        if row is not None:
+                            counts = [a + int(b) for a, b in zip(counts, row[0].split(','))]
+                        connection.execute("INSERT OR IGNORE INTO metrics (phase, outcome) VALUES (?, ?);",
+                                           (phase, outcome))
+                        connection.execute("UPDATE metrics SET buckets = ?, sum = sum + ?, count = count + ? "
+                                           "WHERE phase = ? AND outcome = ?;",
+                                           (",".join(map(str, counts)), total, count, phase, outcome))
+                    for name, value in counters.items():
+                        connection.execute("INSERT OR IGNORE INTO counters (name) VALUES (?);", (name,))
+                        connection.execute("UPDATE counters SET value = value + ? WHERE name = ?;", (value, name))
+                    rows = connection.execute("SELECT phase, outcome, buckets, sum, count FROM metrics;").fetchall()
+                    totals = connection.execute("SELECT name, value FROM counters;").fetchall()
+            finally:
+                connection.close()
+            # Collector must never read half-written file
+            temp = "{0}.{1}.tmp".format(self.textfile, os.getpid())
+            with open(temp, "w") as file:
+                file.write(render_textfile(rows, totals))
+            os.chmod(temp, 0o644)
+            os.replace(temp, self.textfile)
+        except (OSError, sqlite3.Error) as e:
+            logging.error("Cannot update metrics textfile {}: {}".format(self.textfile, e))
+
+
+# Process-wide timer, configured by zbx-rc.py from [METRICS] section
+METRICS = Metrics()
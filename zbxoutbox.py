@@ -0,0 +1,277 @@
+import logging
+import sqlite3
+import time
+from collections import OrderedDict, namedtuple
+
+logging.basicConfig(level=logging.ERROR)
+
+OUTBOX_DB = """CREATE TABLE IF NOT EXISTS outbox (
+                    id           INTEGER  PRIMARY KEY AUTOINCREMENT,
+                    recipient    VARCHAR,
+                    subject      VARCHAR,
+                    message      VARCHAR,
+                    created      REAL,
+                    next_attempt REAL,
+                    locked_until REAL     DEFAULT 0,
+                    attempts     INT      DEFAULT 0,
+                    status       VARCHAR  DEFAULT 'pending',
+                    last_error   VARCHAR,
+                    digest       INT,
+                    trigger_id   INT,
+                    event_id     INT
+                );
+                CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+                CREATE INDEX IF NOT EXISTS outbox_event ON outbox (trigger_id, event_id);"""
+
+JOB_COLUMNS = 'id, recipient, subject, message, created, attempts, digest, trigger_id, event_id'
+
+# folded - number of queued rows of the same trigger/event replaced by this one
+Job = namedtuple('Job', 'id recipient subject message created attempts digest trigger_id event_id folded')
+
+
+class Outbox:
+    """
+    Durable queue of messages in SQLite database. Delivery is at-least-once: claimed rows are leased,
+    rows of crashed worker become due again when lease expires.
+    Rows put with coalescing window share 'digest' column with the first row of the window
+    and are claimed together.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, max_attempts: int = 10, backoff: float = 5,
+                 max_backoff: float = 600):
+        self.connection = connection
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def put(self, recipient: str, subject: str, message: str, window: float = 0, trigger_id: str = None,
+            event_id: str = None, lease: float = 0) -> int:
+        """
+        Function queues message. With window > 0 message waits up to window seconds
+        to be delivered together with other messages to the same recipient.
+
+        :param recipient: Message recipient - user or channel
+        :type: str
+        :param subject: Message subject
+        :type: str
+        :param message: Message text
+        :type: str
+        :param window: Coalescing window in seconds
+        :type: float
+        :param trigger_id: Zabbix trigger id from message
+        :type: str
+        :param event_id: Zabbix event id from message
+        :type: str
+        :param lease: Seconds while row is hidden from workers, e.g. daemon is still delivering it
+        :type: float
+        :return: Row id
+        :rtype: int
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE;")
+            leader = None
+            if window > 0:
+                leader = self.connection.execute(
+                    "SELECT digest, next_attempt FROM outbox WHERE recipient = ? AND status = 'pending' "
+                    "AND attempts = 0 AND locked_until = 0 AND digest IS NOT NULL AND next_attempt > ? "
+                    "ORDER BY id DESC LIMIT 1;", (recipient, now)).fetchone()
+            cursor = self.connection.execute(
+                "INSERT INTO outbox (recipient, subject, message, created, next_attempt, digest, trigger_id, event_id, "
+                "locked_until) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                (recipient, subject, message, now, leader[1] if leader else now + window,
+                 leader[0] if leader else None, trigger_id, event_id, now + lease if lease else 0))
+            if window > 0 and not leader:
+                self.connection.execute("UPDATE outbox SET digest = id WHERE id = ?;", (cursor.lastrowid,))
+        return cursor.lastrowid
+
+    def claim(self, limit: int = 50, lease: float = 60) -> list:
+        """
+        Function takes due rows and leases them for lease seconds.
+
+        :param limit: Batch size
+        :type: int
+        :param lease: Seconds while rows are hidden from other workers
+        :type: float
+        :return: List of Job
+        :rtype: list
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE;")
+            rows = self.connection.execute(
+                "SELECT {} FROM outbox WHERE status = 'pending' AND next_attempt <= ? AND locked_until <= ? "
+                "ORDER BY id LIMIT ?;".format(JOB_COLUMNS), (now, now, limit)).fetchall()
+            claimed = {row[0] for row in rows}
+            # Take the rest of digest groups cut by limit
+            digests = sorted({row[6] for row in rows if row[6] is not None})
+            if digests:
+                rows += [row for row in self.connection.execute(
+                    "SELECT {} FROM outbox WHERE status = 'pending' AND locked_until <= ? AND digest IN ({}) "
+                    "ORDER BY id;".format(JOB_COLUMNS, ', '.join('?' * len(digests))),
+                    [now] + digests).fetchall() if row[0] not in claimed]
+                claimed = {row[0] for row in rows}
+            # Take queued rows of the same trigger/event even if they are not due yet, they will be folded
+            for trigger_id, event_id in sorted({(row[7], row[8]) for row in rows if row[7] is not None}):
+                rows += [row for row in self.connection.execute(
+                    "SELECT {} FROM outbox WHERE status = 'pending' AND locked_until <= ? AND trigger_id = ? "
+                    "AND event_id = ? ORDER BY id;".format(JOB_COLUMNS), (now, trigger_id, event_id)).fetchall()
+                    if row[0] not in claimed]
+            self.connection.executemany("UPDATE outbox SET locked_until = ? WHERE id = ?;",
+                                        [(now + lease, row[0]) for row in rows])
+        return [Job(*row, folded=0) for row in sorted(rows)]
+
+    def has_due(self) -> bool:
+        """
+        Function checks if any row may be claimed now.
+        """
+        now = time.time()
+        return self.connection.execute("SELECT 1 FROM outbox WHERE status = 'pending' AND next_attempt <= ? "
+                                       "AND locked_until <= ? LIMIT 1;", (now, now)).fetchone() is not None
+
+    def done(self, job_id: int) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM outbox WHERE id = ?;", (job_id,))
+
+    def release(self, job_id: int, error: str = None) -> None:
+        """
+        Function ends lease of row without counting attempt, worker takes it at once.
+        """
+        with self.connection:
+            self.connection.execute("UPDATE outbox SET locked_until = 0, last_error = ? WHERE id = ?;",
+                                    (error, job_id))
+
+    def retry(self, job: Job, error: str = None) -> None:
+        """
+        Function returns row to queue with exponential backoff or marks it dead after max_attempts.
+        """
+        attempts = job.attempts + 1
+        if attempts >= self.max_attempts:
+            status, delay = 'dead', 0
+            logging.error("Giving up message {} to {} after {} attempts: {}".format(job.id, job.recipient,
+                                                                                   attempts, error))
+        else:
+            status, delay = 'pending', min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        with self.connection:
+            self.connection.execute(
+                "UPDATE outbox SET attempts = ?, status = ?, next_attempt = ?, locked_until = 0, last_error = ? "
+                "WHERE id = ?;", (attempts, status, time.time() + delay, error, job.id))
+
+    def stats(self) -> dict:
+        """
+        Function returns queue depth and age of the oldest pending message in seconds.
+        """
+        now = time.time()
+        pending, due, oldest = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(next_attempt <= ?), 0), MIN(created) FROM outbox "
+            "WHERE status = 'pending';", (now,)).fetchone()
+        dead, = self.connection.execute("SELECT COUNT(*) FROM outbox WHERE status = 'dead';").fetchone()
+        return {'pending': pending,
+                'due': due,
+                'dead': dead,
+                'oldest_age': round(now - oldest, 1) if oldest else 0}
+
+
+def drain(outbox: Outbox, deliver, batch_size: int = 50, deliver_many=None) -> int:
+    """
+    Function delivers one batch of due messages.
+
+    :param outbox: Outbox object
+    :type: Outbox
+    :param deliver: Callable which gets list of Job of one digest group and returns True if it is delivered
+    :type: callable
+    :param batch_size: Batch size
+    :type: int
+    :param deliver_many: Callable which gets list of digest groups, delivers them concurrently and returns
+                         True, False or exception for every group. If it is set, deliver is not used
+    :type: callable
+    :return: Number of claimed messages
+    :rtype: int
+    """
+    jobs = outbox.claim(batch_size)
+    jobs, superseded = collapse(jobs)
+    for job in superseded:
+        logging.info("Message {} is folded into newer message of the same trigger/event".format(job.id))
+        outbox.done(job.id)
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(job.digest or -job.id, []).append(job)
+    if deliver_many is not None:
+        try:
+            results = deliver_many(list(groups.values())) if groups else []
+        except (SystemExit, Exception) as e:
+            logging.exception("Cannot deliver queued messages")
+            results = [e] * len(groups)
+    else:
+        results = []
+        for group in groups.values():
+            try:
+                results.append(deliver(group))
+            except SystemExit as e:
+                results.append(e)
+            except Exception as e:
+                logging.exception("Cannot deliver queued messages {}".format([job.id for job in group]))
+                results.append(e)
+    for group, result in zip(groups.values(), results):
+        # Claimed rows always go back to queue with attempt counted, so broken delivery backs off
+        if isinstance(result, (SystemExit, Exception)):
+            delivered, error = False, str(result) if isinstance(result, SystemExit) else repr(result)
+        else:
+            delivered, error = result, None if result else 'Rocket.Chat refused message'
+        for job in group:
+            if delivered:
+                outbox.done(job.id)
+            else:
+                outbox.retry(job, error)
+    return len(jobs) + len(superseded)
+
+
+def collapse(jobs: list) -> tuple:
+    """
+    Function folds queued messages of the same trigger/event to the same recipient: only the latest one
+    stays and gets number of replaced messages in 'folded' field.
+
+    :param jobs: List of Job
+    :type: list
+    :return: Tuple with list of Job to deliver and list of superseded Job
+    :rtype: tuple
+    """
+    latest = {}
+    for job in jobs:
+        if job.trigger_id is not None:
+            key = (job.recipient, job.trigger_id, job.event_id)
+            if key not in latest or latest[key].id < job.id:
+                latest[key] = job
+    keep, superseded = [], []
+    for job in jobs:
+        if job.trigger_id is None:
+            keep.append(job)
+        elif latest[(job.recipient, job.trigger_id, job.event_id)] is job:
+            folded = sum(1 for other in jobs if (other.recipient, other.trigger_id, other.event_id) ==
+                         (job.recipient, job.trigger_id, job.event_id))
+            keep.append(job._replace(folded=folded - 1))
+        else:
+            superseded.append(job)
+    return keep, superseded
+
+
+def work(outbox: Outbox, deliver, batch_size: int = 50, poll_interval: float = 1, once: bool = False,
+         stop=None, deliver_many=None, ready=None) -> None:
+    """
+    Function drains queue in batches until stop event is set. With once=True returns when nothing is due.
+    ready() is asked before due rows are claimed, while it returns False (e.g. circuit breaker
+    is open) rows wait without spending attempts.
+    """
+    while stop is None or not stop.is_set():
+        if ready is not None and outbox.has_due() and not ready():
+            claimed = 0
+        else:
+            claimed = drain(outbox, deliver, batch_size, deliver_many)
+        if claimed:
+            continue
+        if once:
+            return
+        if stop is not None:
+            stop.wait(poll_interval)
+        else:
+            time.sleep(poll_interval)
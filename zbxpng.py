@@ -0,0 +1,85 @@
+import logging
+import struct
+import zlib
+
+logging.basicConfig(level=logging.ERROR)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Chunks needed to draw image the same way, the rest (text, time, color profiles) are dropped
+KEEP_CHUNKS = (b"IHDR", b"PLTE", b"tRNS", b"IDAT", b"IEND")
+
+# Deflate strategies tried on image data, the smallest result is kept
+STRATEGIES = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED)
+
+
+def png_chunks(data: bytes) -> list:
+    """
+    Function splits PNG into chunks.
+
+    :param data: PNG bytes
+    :type: bytes
+    :return: List of tuples (type, data)
+    :rtype: list
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("not a PNG image")
+    chunks = []
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length, kind = struct.unpack(">I4s", data[position:position + 8])
+        if position + 12 + length > len(data):
+            raise ValueError("truncated {} chunk".format(kind.decode("latin-1")))
+        chunks.append((kind, data[position + 8:position + 8 + length]))
+        position += 12 + length
+        if kind == b"IEND":
+            break
+    return chunks
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+def deflate(raw: bytes, level: int = 9) -> bytes:
+    """
+    Function compresses image data with every strategy, returns the smallest zlib stream.
+    """
+    best = None
+    for strategy in STRATEGIES:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, strategy)
+        compressed = compressor.compress(raw) + compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+    return best
+
+
+def recompress_png(data: bytes, level: int = 9) -> bytes:
+    """
+    Function losslessly shrinks PNG: ancillary chunks are stripped, image data is deflated again
+    with maximal compression as one IDAT chunk. Pixels are not touched, so result is drawn the same.
+    Original bytes are returned if result is not smaller or image can't be parsed.
+
+    :param data: PNG bytes
+    :type: bytes
+    :param level: zlib compression level
+    :type: int
+    :return: PNG bytes
+    :rtype: bytes
+    """
+    try:
+        chunks = png_chunks(data)
+        raw = zlib.decompress(b"".join(chunk for kind, chunk in chunks if kind == b"IDAT"))
+    except (ValueError, struct.error, zlib.error) as e:
+        logging.warning("can't recompress graph: {0}".format(e))
+        return data
+    result = [PNG_SIGNATURE]
+    for kind, chunk in chunks:
+        if kind == b"IDAT":
+            if raw is not None:
+                result.append(png_chunk(b"IDAT", deflate(raw, level)))
+                raw = None
+        elif kind in KEEP_CHUNKS:
+            result.append(png_chunk(kind, chunk))
+    result = b"".join(result)
+    return result if len(result) < len(data) else data
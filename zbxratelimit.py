@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+
+from zbxstore import connect
+
+logging.basicConfig(level=logging.ERROR)
+
+RATELIMIT_DB = """CREATE TABLE IF NOT EXISTS ratelimit (
+                    endpoint    VARCHAR  PRIMARY KEY,
+                    remaining   INT,
+                    reset       REAL,
+                    throttled   INT      DEFAULT 0,
+                    delayed     INT      DEFAULT 0,
+                    delay_total REAL     DEFAULT 0
+                );"""
+
+
+def endpoint_name(url: str) -> str:
+    """
+    Function returns Rocket.Chat REST method from URL, e.g. 'rooms.upload' for '.../api/v1/rooms.upload/<rid>'.
+
+    :param url: Rocket.Chat API URL
+    :type: str
+    :return: Method name
+    :rtype: str
+    """
+    path = url.split('?', 1)[0]
+    if '/api/v1/' in path:
+        path = path.split('/api/v1/', 1)[1]
+    return path.split('/', 1)[0]
+
+
+def reset_time(value: str, now: float) -> float:
+    """
+    Function converts X-RateLimit-Reset header to unix time. Rocket.Chat sends milliseconds
+    since epoch, seconds since epoch and seconds to wait are accepted too.
+    """
+    reset = float(value)
+    if reset > 1e12:
+        return reset / 1000
+    if reset > 1e9:
+        return reset
+    return now + reset
+
+
+class RateLimiter:
+    """
+    Token bucket per Rocket.Chat endpoint sized from X-RateLimit-Remaining/X-RateLimit-Reset headers.
+    State is kept in SQLite database, so concurrent invocations share it. Requests are delayed
+    until bucket refills instead of failing with 429. Table is created by zbxstore.migrate().
+    """
+
+    def __init__(self, db_file: str, max_wait: float = 60, retries: int = 3):
+        self.max_wait = max_wait
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.connection = connect(db_file, check_same_thread=False)
+
+    def acquire(self, endpoint: str) -> float:
+        """
+        Function takes token from bucket of endpoint, waits for reset if bucket is empty.
+
+        :param endpoint: Rocket.Chat REST method
+        :type: str
+        :return: Seconds waited
+        :rtype: float
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE;")
+            row = self.connection.execute("SELECT remaining, reset FROM ratelimit WHERE endpoint = ?;",
+                                          (endpoint,)).fetchone()
+            if row is None or row[0] is None or row[1] is None or row[1] <= now:
+                return 0
+            remaining, reset = row
+            if remaining > 0:
+                self.connection.execute("UPDATE ratelimit SET remaining = remaining - 1 WHERE endpoint = ?;",
+                                        (endpoint,))
+                return 0
+            wait = min(reset - now, self.max_wait)
+            self.connection.execute("UPDATE ratelimit SET delayed = delayed + 1, delay_total = delay_total + ? "
+                                    "WHERE endpoint = ?;", (wait, endpoint))
+        logging.info("Rate limit of {} is exhausted, waiting {:.2f}s".format(endpoint, wait))
+        time.sleep(wait)
+        return wait
+
+    def update(self, endpoint: str, response) -> None:
+        """
+        Function saves bucket state from response headers and counts 429 answers.
+        """
+        now = time.time()
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        throttled = response.status_code == 429
+        if remaining is None and not throttled:
+            return
+        try:
+            remaining = 0 if throttled else int(remaining)
+            reset = reset_time(reset, now) if reset is not None else now + 1
+        except ValueError:
+            return
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO ratelimit (endpoint) VALUES (?);", (endpoint,))
+            self.connection.execute("UPDATE ratelimit SET remaining = ?, reset = ?, throttled = throttled + ? "
+                                    "WHERE endpoint = ?;", (remaining, reset, int(throttled), endpoint))
+
+    def request(self, http, method: str, url: str, **kwargs):
+        """
+        Function makes request through rate limiter, request answered with 429 is repeated after reset.
+
+        :param http: requests module or requests.Session object
+        :param method: HTTP method
+        :type: str
+        :param url: Rocket.Chat API URL
+        :type: str
+        :return: requests.Response
+        """
+        endpoint = endpoint_name(url)
+        for attempt in range(self.retries + 1):
+            self.acquire(endpoint)
+            response = http.request(method, url, **kwargs)
+            self.update(endpoint, response)
+            if response.status_code != 429 or attempt == self.retries:
+                return response
+            logging.warning("Rocket.Chat throttled {}, retrying".format(endpoint))
+            # Rewind uploaded files before repeating request
+            for value in (kwargs.get('files') or {}).values():
+                if isinstance(value, tuple) and hasattr(value[1], 'seek'):
+                    value[1].seek(0)
+        return response
+
+    def stats(self) -> list:
+        """
+        Function returns counters of throttled and delayed requests per endpoint.
+
+        :return: List of dicts
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT endpoint, remaining, reset, throttled, delayed, delay_total "
+                                           "FROM ratelimit ORDER BY endpoint;").fetchall()
+        return [{'endpoint': row[0],
+                 'remaining': row[1],
+                 'reset': row[2],
+                 'throttled': row[3],
+                 'delayed': row[4],
+                 'delay_total': round(row[5], 2)} for row in rows]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,328 @@
+import fcntl
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.ERROR)
+
+BLANK_DB = """CREATE TABLE msg (
+                    id         VARCHAR,
+                    trigger_id INT,
+                    event_id   INT,
+                    timestamp  DATETIME DEFAULT (CURRENT_TIMESTAMP),
+                    rid        VARCHAR,
+                    part       INT,
+                    recipient  VARCHAR,
+                    UNIQUE (id, trigger_id, event_id) ON CONFLICT IGNORE
+                );"""
+
+INDEXES = """CREATE INDEX IF NOT EXISTS msg_event ON msg (trigger_id, event_id);
+             CREATE INDEX IF NOT EXISTS msg_timestamp ON msg (timestamp);
+             CREATE INDEX IF NOT EXISTS msg_id ON msg (id);"""
+
+# Maintenance state, e.g. time of the last pruning
+META_DB = """CREATE TABLE IF NOT EXISTS meta (
+                    key        VARCHAR  PRIMARY KEY,
+                    value      VARCHAR
+             );"""
+
+LOOKUP_QUERY = "SELECT id, rid, part, recipient FROM msg WHERE trigger_id = ? AND event_id = ? ORDER BY rowid;"
+
+INSERT_QUERY = "INSERT INTO msg (id, trigger_id, event_id, rid, part, recipient) VALUES (?, ?, ?, ?, ?, ?);"
+
+# Stored in PRAGMA user_version, increase it when migrate() or service_tables() gets new step
+SCHEMA_VERSION = 9
+
+# Seconds to wait for lock of other process
+BUSY_TIMEOUT = 10
+
+# Pages returned to file system by one pruning
+VACUUM_PAGES = 1000
+
+
+def connect(db_file: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Function opens database in WAL mode, so readers don't wait for writer, and writers wait
+    for each other up to BUSY_TIMEOUT seconds instead of failing with 'database is locked'.
+
+    :param db_file: Path to database
+    :type: str
+    :param check_same_thread: Allow connection only in thread which created it
+    :type: bool
+    :return: Connection
+    :rtype: sqlite3.Connection
+    """
+    connection = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread)
+    connection.execute("PRAGMA journal_mode = WAL;")
+    connection.execute("PRAGMA synchronous = NORMAL;")
+    return connection
+
+
+def service_tables() -> tuple:
+    """
+    Function returns schemas of tables which other modules keep in the database. They are created
+    by migrate() only, so schema of the whole database is versioned by SCHEMA_VERSION.
+
+    :return: Tuple of SQL scripts
+    :rtype: tuple
+    """
+    from zbxacks import ACKS_DB
+    from zbxbreaker import BREAKER_DB
+    from zbxitems import ITEMS_DB
+    from zbxmetrics import COUNTERS_DB, METRICS_DB
+    from zbxoutbox import OUTBOX_DB
+    from zbxratelimit import RATELIMIT_DB
+    return RATELIMIT_DB, METRICS_DB, COUNTERS_DB, ACKS_DB, BREAKER_DB, OUTBOX_DB, ITEMS_DB
+
+
+def migrate(connection: sqlite3.Connection) -> None:
+    """
+    Function converts msg table of older versions where message id was primary key,
+    digest messages need several rows with the same id. Recipient column is added, one trigger/event
+    may be sent to several rooms. Indexes, service tables and incremental vacuum are enabled.
+    """
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(msg);")]
+    if 'part' not in columns:
+        connection.executescript("BEGIN;"
+                                 "ALTER TABLE msg RENAME TO msg_old;" + BLANK_DB +
+                                 "INSERT INTO msg (id, trigger_id, event_id, timestamp, rid) "
+                                 "SELECT id, trigger_id, event_id, timestamp, rid FROM msg_old;"
+                                 "DROP TABLE msg_old;"
+                                 "COMMIT;")
+    elif 'recipient' not in columns:
+        connection.execute("ALTER TABLE msg ADD COLUMN recipient VARCHAR;")
+        connection.commit()
+    connection.executescript(INDEXES)
+    connection.executescript(META_DB)
+    for script in service_tables():
+        connection.executescript(script)
+    auto_vacuum, = connection.execute("PRAGMA auto_vacuum;").fetchone()
+    if auto_vacuum != 2:
+        # Mode of existing database is changed by full vacuum only, it is done once
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        connection.execute("VACUUM;")
+
+
+def schema_version(db_file: str) -> int:
+    connection = connect(db_file)
+    try:
+        return connection.execute("PRAGMA user_version;").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def init_db(db_file: str) -> bool:
+    """
+    Function checks that database has actual schema version, it costs one pragma read.
+    Otherwise database is created or migrated under file lock, so concurrent invocations
+    don't race. Broken database file is moved aside instead of removing, it is never
+    touched because of lock contention.
+
+    :param db_file: Path to database
+    :type: str
+    :return: True if database was ready, False if it was created or migrated
+    :rtype: bool
+    """
+    try:
+        if os.path.exists(db_file) and schema_version(db_file) == SCHEMA_VERSION:
+            return True
+    except sqlite3.OperationalError as e:
+        raise SystemExit('ERROR: Cannot open database "{}": {}.'.format(db_file, e))
+    except sqlite3.DatabaseError:
+        pass
+
+    with open(db_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Other process could do it while we were waiting for lock
+            if os.path.exists(db_file) and schema_version(db_file) == SCHEMA_VERSION:
+                return True
+        except sqlite3.OperationalError as e:
+            raise SystemExit('ERROR: Cannot open database "{}": {}.'.format(db_file, e))
+        except sqlite3.DatabaseError as e:
+            broken = "{}.broken-{}".format(db_file, int(time.time()))
+            logging.error("Database {} is broken ({}), moved to {}".format(db_file, e, broken))
+            os.replace(db_file, broken)
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(db_file + suffix):
+                    os.replace(db_file + suffix, broken + suffix)
+
+        connection = connect(db_file)
+        try:
+            if not connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'msg';").fetchone():
+                # Set before tables are created, so vacuum is not needed
+                connection.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+                connection.execute(BLANK_DB)
+                connection.commit()
+            migrate(connection)
+            connection.execute("PRAGMA user_version = {};".format(SCHEMA_VERSION))
+            connection.commit()
+        except sqlite3.OperationalError as e:
+            raise SystemExit('ERROR: Cannot prepare database "{}": {}.'.format(db_file, e))
+        finally:
+            connection.close()
+    return False
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Context manager holding exclusive lock of file, processes and threads taking it run one by one.
+
+    :param path: Path to lock file, it is created if it is missing
+    :type: str
+    """
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+class MessageCache:
+    """
+    Least recently used map of (trigger_id, event_id) to tuple of rows returned by lookup_message(),
+    kept by long-living processes in front of the database. Rows saved by this process are written
+    through, so resolve finds message of its problem without reading database. Only known messages
+    are cached, lookup of new trigger/event always reads database and sees rows of other processes.
+    Entry without a room of some recipient is a miss too: other process or daemon could send the
+    message of this trigger/event to that recipient after entry was cached.
+    """
+
+    __slots__ = ("size", "entries", "stats")
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.stats = {"hit": 0, "miss": 0}
+
+    def get(self, key: tuple, recipients: list = None):
+        rows = self.entries.get(key)
+        # Rows saved by older versions have no recipient and are used for any recipient
+        if rows is None or (recipients and all(row[3] is not None for row in rows) and
+                            not set(recipients) <= {row[3] for row in rows}):
+            self.stats["miss"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hit"] += 1
+        return rows
+
+    def put(self, key: tuple, rows) -> None:
+        self.entries[key] = tuple(rows)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def add(self, key: tuple, row: tuple) -> None:
+        """
+        Function appends saved row to entry, duplicate of message row is ignored like by UNIQUE constraint.
+        """
+        rows = self.entries.get(key, ())
+        if any(cached[:3] == row[:3] for cached in rows):
+            return
+        self.put(key, rows + (row,))
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+def lookup_message(connection: sqlite3.Connection, trigger_id: str, event_id: str,
+                   cache: MessageCache = None, recipients: list = None) -> list:
+    """
+    Function returns messages sent for trigger and event, one per room or digest part.
+
+    :param cache: Cache to look in before database
+    :type: MessageCache
+    :param recipients: Recipients of alert, cached entry without some of them is read from database again
+    :type: list
+    :return: List of tuples (id, rid, part, recipient), recipient is None for messages saved by older versions
+    :rtype: list
+    """
+    key = (int(trigger_id), int(event_id))
+    if cache is not None:
+        rows = cache.get(key, recipients)
+        if rows is not None:
+            return list(rows)
+    rows = connection.execute(LOOKUP_QUERY, key).fetchall()
+    if cache is not None and rows:
+        cache.put(key, rows)
+    return rows
+
+
+def save_message(connection: sqlite3.Connection, msg_id: str, trigger_id: str, event_id: str, rid: str,
+                 part: int = None, recipient: str = None, cache: MessageCache = None) -> None:
+    """
+    Function saves message sent for trigger and event, transaction is committed by caller.
+    """
+    connection.execute(INSERT_QUERY, (msg_id, int(trigger_id), int(event_id), rid, part, recipient))
+    if cache is not None:
+        cache.add((int(trigger_id), int(event_id)), (msg_id, rid, part, recipient))
+
+
+def prune(connection: sqlite3.Connection, older_than: float = None, max_rows: int = None,
+          cache: MessageCache = None) -> int:
+    """
+    Function removes messages older than older_than seconds and the oldest ones over max_rows,
+    freed pages are returned to file system with incremental vacuum.
+
+    :param connection: Database connection
+    :type: sqlite3.Connection
+    :param older_than: Age in seconds
+    :type: float
+    :param max_rows: Maximum number of rows to keep
+    :type: int
+    :param cache: Cache of messages, it is cleared if rows are removed
+    :type: MessageCache
+    :return: Number of removed rows
+    :rtype: int
+    """
+    removed = 0
+    with connection:
+        if older_than:
+            removed += connection.execute("DELETE FROM msg WHERE timestamp < datetime('now', ?);",
+                                          ('-{} seconds'.format(int(older_than)),)).rowcount
+        if max_rows:
+            removed += connection.execute("DELETE FROM msg WHERE rowid IN (SELECT rowid FROM msg "
+                                          "ORDER BY rowid DESC LIMIT -1 OFFSET ?);", (max_rows,)).rowcount
+        connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_prune', ?);", (time.time(),))
+    if removed and cache is not None:
+        cache.clear()
+    connection.execute("PRAGMA incremental_vacuum({});".format(VACUUM_PAGES)).fetchall()
+    logging.info("Pruned {} messages".format(removed))
+    return removed
+
+
+def maybe_prune(connection: sqlite3.Connection, older_than: float = None, max_rows: int = None,
+                interval: float = 3600, cache: MessageCache = None) -> int:
+    """
+    Function runs prune() if it was not run for interval seconds by any process.
+
+    :return: Number of removed rows
+    :rtype: int
+    """
+    if not older_than and not max_rows:
+        return 0
+    row = connection.execute("SELECT value FROM meta WHERE key = 'last_prune';").fetchone()
+    if row and float(row[0]) + interval > time.time():
+        return 0
+    return prune(connection, older_than, max_rows, cache)
+
+
+def parse_age(value: str) -> float:
+    """
+    Function converts age like "30d", "12h", "15m" or "90s" to seconds, number without suffix is days.
+
+    :param value: Age
+    :type: str
+    :return: Seconds
+    :rtype: float
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = value.strip().lower()
+    try:
+        if value and value[-1] in units:
+            return float(value[:-1]) * units[value[-1]]
+        return float(value) * units['d'] if value else 0
+    except ValueError:
+        raise SystemExit('ERROR: Wrong age "{}", use number with s, m, h or d suffix.'.format(value))
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from zbxhttp import HTTPClient
+
+logging.basicConfig(level=logging.ERROR)
+
+
+class DeliveryError(Exception):
+    """
+    Error of alert delivery raised inside coroutines. SystemExit raised in asyncio task stops
+    event loop, so coroutines raise this exception and Transport.run() converts it to SystemExit.
+    """
+
+
+class Transport:
+    """
+    Event loop in background thread which runs alert I/O as concurrent tasks. Blocking calls
+    (Rocket.Chat requests, Zabbix graph rendering) go to thread pool sharing keep-alive clients
+    of Rocket.Chat and Zabbix. Database calls go to a single thread, so sqlite3 connection is never
+    used by two threads at once. run() may be called from any number of threads.
+    """
+
+    def __init__(self, workers: int = 16, pool_size: int = 16, retries: int = 2, timeout: tuple = (1, 3)):
+        self.rocketchat = HTTPClient('rocketchat', pool_size=pool_size, retries=retries, timeout=timeout)
+        # Zabbix calls set their own timeouts
+        self.zabbix = HTTPClient('zabbix', pool_size=pool_size, retries=retries)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zbx-rc-io')
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='zbx-rc-db')
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='zbx-rc-loop', daemon=True)
+        self.thread.start()
+        # Key -> [asyncio.Lock, number of tasks using it], touched only in loop thread
+        self.locks = {}
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Function runs blocking I/O call in thread pool.
+        """
+        return await self.loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def db(self, func, *args, **kwargs):
+        """
+        Function runs database call in database thread.
+        """
+        return await self.loop.run_in_executor(self.db_executor, partial(func, *args, **kwargs))
+
+    @asynccontextmanager
+    async def exclusive(self, key):
+        """
+        Context manager which runs tasks with the same key one by one, e.g. problem and resolve
+        of one trigger/event, so resolve finds message saved by problem. None key isn't locked.
+        """
+        if key is None:
+            yield
+            return
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    def submit(self, coro) -> Future:
+        """
+        Function schedules coroutine in event loop without waiting for it.
+
+        :param coro: Coroutine
+        :return: Future of coroutine result, DeliveryError is not converted
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: float = None):
+        """
+        Function runs coroutine in event loop and waits for its result.
+
+        :param coro: Coroutine
+        :param timeout: Seconds to wait for result
+        :type: float
+        :return: Result of coroutine
+        """
+        try:
+            return self.submit(coro).result(timeout)
+        except DeliveryError as e:
+            raise SystemExit(str(e))
+
+    def stats(self) -> dict:
+        """
+        Function returns connection reuse stats of HTTP clients.
+
+        :return: Dict {client name: stats}
+        :rtype: dict
+        """
+        return {client.name: client.stats() for client in (self.rocketchat, self.zabbix)}
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
+        self.db_executor.shutdown()
+        self.rocketchat.close()
+        self.zabbix.close()